@@ -26,17 +26,27 @@ from instance_extraction.RPN import RPN
 from instance_extraction.FPN_heads import Classifier,Mask,Semantic
 from interest_estimation.Saliency import SaNet
 from instance_extraction.Proposal import proposal_layer
-from instance_extraction.Detection import detection_layer, generate_stuff
+from instance_extraction.Detection import detection_layer, generate_stuff, semantic_labels, subset_semantic_labels
 from instance_extraction.DetectionTarget import detection_target_layer
 from utils.formatting_utils import mold_image, compose_image_meta
-from DatasetLib import Dataset
+from DatasetLib import Dataset, build_data_loader, compact_inputs
 from utils.log_utils import log, printProgressBar
 from utils.loss_utils import compute_losses_CIN, compute_losses_PFPN, compute_saliency_loss, compute_interest_loss, compute_semantic_loss
-from ioi_selection.CIEDN import CIEDN
-from utils.Selection import extract_piece_group, map_pred_with_gt_mask, resize_influence_map,resize_semantic_label,filter_stuff_masks,filter_thing_masks
+from ioi_selection.CIEDN import CIEDN, select_partners, pad_instance_groups
+from ioi_selection.corpus import SelectionCorpus, SelectionCorpusWriter, build_pair_label
+from utils.Selection import extract_piece_group, map_pred_with_gt_mask, resize_influence_map,resize_semantic_label,filter_stuff_masks,filter_thing_masks,saliency_overlap
 from utils.utils import IdGenerator
+from utils.feature_cache import FeatureCache, FEATURE_LEVELS
+from utils.sample_cache import SampleCache
+from utils.pytorch_utils import get_device, configure_cpu
 from compute_metric import maxminnorm
 
+# The feature groups each frozen-backbone training stage reads from the cache
+FEATURE_CACHE_GROUPS = {"semantic": ["p"], "p_interest": ["c"], "selection": ["c", "p"]}
+
+# The training stages that run on padded batches of IMAGES_PER_GPU images
+BATCHED_STAGES = ["semantic", "p_interest"]
+
 ############################################################
 #  MaskRCNN
 ############################################################
@@ -53,6 +63,7 @@ class CIN(nn.Module):
         super(CIN, self).__init__()
         self.config = config
         self.model_dir = model_dir
+        configure_cpu(config)
         self.set_log_dir()
         self.build(config=config)
         self.initialize_weights()
@@ -66,6 +77,9 @@ class CIN(nn.Module):
 
         self.id_generator = IdGenerator(json.load(open("data/class_dict.json",'r')))
 
+        # instances seen / decided without CIEDN by the saliency cascade
+        self.cascade_stats = {"instances": 0, "skipped": 0}
+
     def build(self, config):
         """Build Mask R-CNN architecture.
         """
@@ -113,7 +127,7 @@ class CIN(nn.Module):
         self.semantic = Semantic(self.config.NUM_CLASSES)
 
         # OOI Selection
-        self.ciedn = CIEDN()
+        self.ciedn = CIEDN(max_pairs=config.SELECTION_MAX_PAIRS)
 
         # Fix batch norm layers
         def set_bn_fix(m):
@@ -220,8 +234,11 @@ class CIN(nn.Module):
         exlude: list of layer names to excluce
         """
         if os.path.exists(filepath):
-            state_dict = torch.load(filepath)
+            state_dict = torch.load(filepath, map_location=get_device(self.config))
             self.load_state_dict(state_dict, strict=False)
+            self.ciedn.clear_folded_decoder()
+            if self.config.SELECTION_FOLD_DECODER:
+                self.ciedn.fold_decoder()
         else:
             print("Weight file not found ...")
 
@@ -232,7 +249,7 @@ class CIN(nn.Module):
 
     def load_part_weights(self,filepath,mode="instance"):
         if os.path.exists(filepath):
-            state_dict = torch.load(filepath)
+            state_dict = torch.load(filepath, map_location=get_device(self.config))
             if mode == "p_interest":
                 state_dict_to_load = dict()
                 for name in state_dict:
@@ -262,6 +279,9 @@ class CIN(nn.Module):
                 self.load_state_dict(state_dict, strict=False)
             else:
                 self.load_state_dict(state_dict, strict=False)
+            self.ciedn.clear_folded_decoder()
+            if self.config.SELECTION_FOLD_DECODER:
+                self.ciedn.fold_decoder()
         else:
             print("Weight file not found ...")
             exit()
@@ -271,7 +291,7 @@ class CIN(nn.Module):
         print(self.log_dir)
 
     def load_from_maskrcnn(self):
-        state_dict = torch.load("models/mask_rcnn_coco.pth")
+        state_dict = torch.load("models/mask_rcnn_coco.pth", map_location=get_device(self.config))
         resnet_dict=dict()
         other_dict=dict()
         for name in state_dict:
@@ -295,21 +315,45 @@ class CIN(nn.Module):
         if layers in layer_regex.keys():
             layers = layer_regex[layers]
 
-        def my_collate_fn(batch):
-            batch = list(filter(lambda x: x is not None, batch))
-            if len(batch) == 0:
-                print("No valid data!!!")
-                batch = [[torch.from_numpy(np.zeros([1,1]))]]
-            return default_collate(batch)
-
-        train_set = Dataset(train_dataset, self.config)
-        train_generator = TorchDataLoader(train_set, collate_fn=my_collate_fn, batch_size=1, shuffle=True, num_workers=0)
-
-        val_set = Dataset(val_dataset, self.config)
-        val_generator = TorchDataLoader(val_set, collate_fn=my_collate_fn, batch_size=1, shuffle=True, num_workers=0)
+        # The selection stage trains from the packed corpus when one is configured
+        if self.training_layers == "selection" and self.config.SELECTION_CORPUS_DIR:
+            train_corpus = self.build_selection_corpus(train_dataset, os.path.join(self.config.SELECTION_CORPUS_DIR, "train"),
+                                                       self.load_sample_cache("train"))
+            val_corpus = self.build_selection_corpus(val_dataset, os.path.join(self.config.SELECTION_CORPUS_DIR, "val"),
+                                                     self.load_sample_cache("val"))
+            self.set_trainable(layers)
+            self.ciedn.clear_folded_decoder()
+            self.train_selection(train_corpus, val_corpus, learning_rate, epochs)
+            return
+
+        # The cached features are those of the unflipped images, so the
+        # augmentation is disabled when training from the cache
+        train_cache, val_cache = None, None
+        if self.config.FEATURE_CACHE_DIR and self.training_layers in FEATURE_CACHE_GROUPS:
+            groups = FEATURE_CACHE_GROUPS[self.training_layers]
+            train_cache = self.cache_features(train_dataset, os.path.join(self.config.FEATURE_CACHE_DIR, "train"), groups,
+                                              self.load_sample_cache("train"))
+            val_cache = self.cache_features(val_dataset, os.path.join(self.config.FEATURE_CACHE_DIR, "val"), groups,
+                                            self.load_sample_cache("val"))
+
+        # The steps of the config count images, the epochs below count batches
+        images_per_batch = self.config.IMAGES_PER_GPU if self.training_layers in BATCHED_STAGES else 1
+        train_steps = max(1, self.config.STEPS_PER_EPOCH // images_per_batch)
+        val_steps = max(1, self.config.VALIDATION_STEPS // images_per_batch)
+
+        train_set = Dataset(train_dataset, self.config, augment=train_cache is None,
+                            sample_cache=self.load_sample_cache("train"))
+        train_generator = build_data_loader(train_set, self.config, batch_size=images_per_batch)
+
+        val_set = Dataset(val_dataset, self.config, augment=val_cache is None,
+                          sample_cache=self.load_sample_cache("val"))
+        val_generator = build_data_loader(val_set, self.config, batch_size=images_per_batch)
 
         self.set_trainable(layers)
 
+        # The folded decoder goes stale once the CIEDN weights are updated
+        self.ciedn.clear_folded_decoder()
+
         optimizers=[]
         if self.training_layers == "semantic":
             trainables_wo_bn = [param for name, param in self.named_parameters() if param.requires_grad and not 'bn' in name]
@@ -340,24 +384,24 @@ class CIN(nn.Module):
             log("Epoch {}/{}.".format(epoch, epochs))
 
             if self.training_layers == "semantic":
-                loss, loss_semantic = self.train_epoch(train_generator, optimizers, self.config.STEPS_PER_EPOCH)
-                val_loss, val_loss_semantic = self.valid_epoch(val_generator, self.config.VALIDATION_STEPS)
+                loss, loss_semantic = self.train_epoch(train_generator, optimizers, train_steps, train_cache)
+                val_loss, val_loss_semantic = self.valid_epoch(val_generator, val_steps, val_cache)
                 
                 self.loss_history.append([loss, loss_semantic])
                 self.val_loss_history.append([val_loss, val_loss_semantic])
                 
                 visualize.plot_loss("semantic_loss", 1, self.loss_history, self.val_loss_history, save=True, log_dir=self.log_dir)
             elif self.training_layers=='p_interest':
-                loss,loss_influence = self.train_epoch(train_generator, optimizers, self.config.STEPS_PER_EPOCH)
-                val_loss, val_loss_influence = self.valid_epoch(val_generator, self.config.VALIDATION_STEPS)
+                loss,loss_influence = self.train_epoch(train_generator, optimizers, train_steps, train_cache)
+                val_loss, val_loss_influence = self.valid_epoch(val_generator, val_steps, val_cache)
 
                 self.loss_history.append([loss, loss_influence])
                 self.val_loss_history.append([val_loss,val_loss_influence])
 
                 visualize.plot_loss("p_interest", 1, self.loss_history, self.val_loss_history, save=True, log_dir=self.log_dir)
             elif self.training_layers=='selection':
-                loss, loss_interest = self.train_epoch(train_generator, optimizers, self.config.STEPS_PER_EPOCH)
-                val_loss, val_loss_interest = self.valid_epoch(val_generator, self.config.VALIDATION_STEPS)
+                loss, loss_interest = self.train_epoch(train_generator, optimizers, train_steps, train_cache)
+                val_loss, val_loss_interest = self.valid_epoch(val_generator, val_steps, val_cache)
 
                 self.loss_history.append([loss, loss_interest])
                 self.val_loss_history.append([val_loss, val_loss_interest])
@@ -372,7 +416,97 @@ class CIN(nn.Module):
 
         self.epoch = epochs
 
-    def train_epoch(self, datagenerator, optimizers, steps):
+    def build_selection_corpus(self, dataset, corpus_dir, sample_cache=None):
+        """Runs insttr, predict_segment, map_instance_to_gt and
+        construct_dataset once over the unflipped images of the dataset and
+        packs the CIEDN samples into corpus_dir. An existing corpus is reused.
+
+        Returns: the SelectionCorpus.
+        """
+        if SelectionCorpus.exists(corpus_dir):
+            return SelectionCorpus(corpus_dir)
+
+        data_set = Dataset(dataset, self.config, augment=False, sample_cache=sample_cache)
+        data_generator = build_data_loader(data_set, self.config, shuffle=False)
+
+        writer = SelectionCorpusWriter(corpus_dir, self.config.SELECTION_CORPUS_SHARD_IMAGES)
+        step = 0
+        for inputs in data_generator:
+            step += 1
+            printProgressBar(step, len(data_set), prefix="\tcorpus {}/{}".format(step, len(data_set)), length=10)
+            if len(inputs) != 17:
+                continue
+            try:
+                images = Variable(inputs[0], volatile=True)
+                image_metas = inputs[1].int().data.numpy()
+                gt_segmentation = Variable(inputs[15], volatile=True)
+                if self.config.GPU_COUNT:
+                    images = images.cuda()
+                    gt_segmentation = gt_segmentation.cuda()
+
+                detection_result = self.predict_front([images, image_metas], mode='inference', limit="insttr")
+                instance_groups, labels, pair_label = self.selection_sample(detection_result, gt_segmentation,
+                                                                            inputs[16], image_metas)
+                writer.add(image_metas[0][0], instance_groups, labels)
+            except Exception as e:
+                print("Error - "+str(step))
+                print(e)
+        writer.close()
+        return SelectionCorpus(corpus_dir)
+
+    def train_selection(self, train_corpus, val_corpus, learning_rate, epochs):
+        """Trains CIEDN from packed corpora on mini-batches of
+        SELECTION_TRAIN_IMAGES images. The loss of a batch is the mean over
+        its images of the MSE between the pair scores and pair_label."""
+        optimizer = torch.optim.Adam(self.ciedn.parameters(), lr=learning_rate)
+        loss_func = nn.MSELoss()
+
+        def batch_loss(batch):
+            instance_groups = Variable(torch.from_numpy(np.concatenate([groups for groups, labels in batch], axis=0)))
+            pair_labels = [Variable(torch.from_numpy(build_pair_label(labels))) for groups, labels in batch]
+            if self.config.GPU_COUNT:
+                instance_groups = instance_groups.cuda()
+                pair_labels = [pair_label.cuda() for pair_label in pair_labels]
+            predictions = self.ciedn.forward_images(instance_groups, [groups.shape[0] for groups, labels in batch])
+            losses = [loss_func(prediction, pair_label) for prediction, pair_label in zip(predictions, pair_labels)]
+            return sum(losses) / len(losses)
+
+        for epoch in range(self.epoch + 1, epochs + 1):
+            log("Epoch {}/{}.".format(epoch, epochs))
+
+            self.ciedn.train()
+            loss_sum = 0
+            steps = 0
+            for batch in train_corpus.iter_batches(self.config.SELECTION_TRAIN_IMAGES):
+                loss = batch_loss(batch)
+                optimizer.zero_grad()
+                loss.backward()
+                torch.nn.utils.clip_grad_norm(self.ciedn.parameters(), 5.0)
+                optimizer.step()
+                loss_sum += float(loss.data.cpu().numpy())
+                steps += 1
+            loss = loss_sum / max(steps, 1)
+
+            self.ciedn.eval()
+            val_loss_sum = 0
+            val_steps = 0
+            with torch.no_grad():
+                for batch in val_corpus.iter_batches(self.config.SELECTION_TRAIN_IMAGES, shuffle=False):
+                    val_loss_sum += float(batch_loss(batch).data.cpu().numpy())
+                    val_steps += 1
+            val_loss = val_loss_sum / max(val_steps, 1)
+            print("\tloss: {:.5f} - val_loss: {:.5f}".format(loss, val_loss))
+
+            self.loss_history.append([loss, loss])
+            self.val_loss_history.append([val_loss, val_loss])
+            visualize.plot_loss("loss_interest", 1, self.loss_history, self.val_loss_history, save=True, log_dir=self.log_dir)
+
+            # Save model
+            torch.save(self.state_dict(), self.checkpoint_path.format(epoch))
+
+        self.epoch = epochs
+
+    def train_epoch(self, datagenerator, optimizers, steps, feature_cache=None):
         batch_count = 0
         loss_sum = 0
         loss_rpn_class_sum = 0
@@ -391,7 +525,8 @@ class CIN(nn.Module):
             if len(inputs)!=17:
                 continue
             try:
-                batch_count += 1
+                # Count images, the optimizers step once BATCH_SIZE images are accumulated
+                batch_count += inputs[0].shape[0]
 
                 images = inputs[0]
                 image_metas = inputs[1].int().data.numpy()
@@ -429,7 +564,7 @@ class CIN(nn.Module):
 
                 # To GPU
                 if self.config.GPU_COUNT:
-                    images = images.cuda()
+                    images = images.cuda(non_blocking=True)
                     rpn_match = rpn_match.cuda()
                     rpn_bbox = rpn_bbox.cuda()
                     gt_class_ids = gt_class_ids.cuda()
@@ -445,17 +580,22 @@ class CIN(nn.Module):
                     gt_interest_masks = gt_interest_masks.cuda()
                     gt_segmentation = gt_segmentation.cuda()
 
+                gt_masks, gt_stuff_masks, gt_semantic_label, gt_influence_map, gt_interest_masks = \
+                    compact_inputs(gt_masks, gt_stuff_masks, gt_semantic_label, gt_influence_map, gt_interest_masks)
+
+                features = self.load_features(feature_cache, image_metas)
+
                 if self.training_layers == "semantic":
                     # Run object detection
                     predict_input = [images, image_metas]
-                    semantic_label = self.predict_front(predict_input, mode='training', limit="semantic")
+                    semantic_label = self.predict_front(predict_input, mode='training', limit="semantic", features=features)
                     semantic_loss = compute_semantic_loss(semantic_label, gt_semantic_label)
                     loss = semantic_loss
 
                     # Backpropagation
                     loss.backward()
                     torch.nn.utils.clip_grad_norm(self.parameters(), 5.0)
-                    if (batch_count % self.config.BATCH_SIZE) == 0:
+                    if batch_count >= self.config.BATCH_SIZE:
                         for optimizer in optimizers:
                             optimizer.step()
                             optimizer.zero_grad()
@@ -482,14 +622,14 @@ class CIN(nn.Module):
                 elif self.training_layers=='p_interest':
                     # Run object detection
                     predict_input = [images, image_metas]
-                    influence_preds = self.predict_front(predict_input, mode='training', limit="p_interest")
+                    influence_preds = self.predict_front(predict_input, mode='training', limit="p_interest", features=features)
                     influence_loss = compute_saliency_loss(influence_preds,gt_influence_map)
                     loss=influence_loss
 
                     # Backpropagation
                     loss.backward()
                     torch.nn.utils.clip_grad_norm(self.parameters(), 5.0)
-                    if (batch_count % self.config.BATCH_SIZE) == 0:
+                    if batch_count >= self.config.BATCH_SIZE:
                         for optimizer in optimizers:
                             optimizer.step()
                             optimizer.zero_grad()
@@ -511,7 +651,7 @@ class CIN(nn.Module):
                         step += 1
                 elif self.training_layers=='selection':
                     loss_func = nn.MSELoss()
-                    detection_result = self.predict_front([images, image_metas],mode='inference', limit="insttr")
+                    detection_result = self.predict_front([images, image_metas],mode='inference', limit="insttr", features=features)
                     predict_input = [images, image_metas, detection_result, gt_segmentation, gt_image_instances]
                     predictions, pair_labels, labels = self.predict_front(predict_input, mode="training", limit="selection")
 
@@ -521,7 +661,7 @@ class CIN(nn.Module):
                     # Backpropagation
                     loss.backward()
                     torch.nn.utils.clip_grad_norm(self.parameters(), 5.0)
-                    if (batch_count % self.config.BATCH_SIZE) == 0:
+                    if batch_count >= self.config.BATCH_SIZE:
                         for optimizer in optimizers:
                             optimizer.step()
                             optimizer.zero_grad()
@@ -554,7 +694,7 @@ class CIN(nn.Module):
                 print("Error - "+str(step))
                 print(e)
 
-    def valid_epoch(self, datagenerator, steps):
+    def valid_epoch(self, datagenerator, steps, feature_cache=None):
         step = 0
         loss_sum = 0
         loss_rpn_class_sum = 0
@@ -608,7 +748,7 @@ class CIN(nn.Module):
 
                 # To GPU
                 if self.config.GPU_COUNT:
-                    images = images.cuda()
+                    images = images.cuda(non_blocking=True)
                     rpn_match = rpn_match.cuda()
                     rpn_bbox = rpn_bbox.cuda()
                     gt_class_ids = gt_class_ids.cuda()
@@ -624,10 +764,15 @@ class CIN(nn.Module):
                     gt_interest_masks = gt_interest_masks.cuda()
                     gt_segmentation = gt_segmentation.cuda()
 
+                gt_masks, gt_stuff_masks, gt_semantic_label, gt_influence_map, gt_interest_masks = \
+                    compact_inputs(gt_masks, gt_stuff_masks, gt_semantic_label, gt_influence_map, gt_interest_masks)
+
+                features = self.load_features(feature_cache, image_metas)
+
                 if self.training_layers == "semantic":
                     # Run object detection
                     predict_input = [images, image_metas]
-                    semantic_label = self.predict_front(predict_input, mode='training', limit="semantic")
+                    semantic_label = self.predict_front(predict_input, mode='training', limit="semantic", features=features)
                     semantic_loss = compute_semantic_loss(semantic_label, gt_semantic_label)
                     loss = semantic_loss
 
@@ -654,7 +799,7 @@ class CIN(nn.Module):
                 elif self.training_layers == 'p_interest':
                     # Run object detection
                     predict_input = [images, image_metas]
-                    influence_preds = self.predict_front(predict_input, mode='training', limit="p_interest")
+                    influence_preds = self.predict_front(predict_input, mode='training', limit="p_interest", features=features)
 
                     influence_loss = compute_saliency_loss(influence_preds, gt_influence_map)
                     loss = influence_loss
@@ -682,7 +827,7 @@ class CIN(nn.Module):
                         step += 1
                 elif self.training_layers=='selection':
                     # Run object detection
-                    detection_result=self.predict_front([images, image_metas], mode="inference", limit="insttr")
+                    detection_result=self.predict_front([images, image_metas], mode="inference", limit="insttr", features=features)
                     predictions, pair_labels, labels = self.predict_front([images, image_metas, detection_result, gt_segmentation, gt_image_instances], mode="training", limit="selection")
                     loss_func = nn.MSELoss()
                     interest_loss = loss_func(predictions, pair_labels)
@@ -714,7 +859,92 @@ class CIN(nn.Module):
                 print("Error - "+str(step))
                 print(e)
 
+    def load_sample_cache(self, subset):
+        """Returns the SampleCache of the subset written by preprocess.py, or
+        None if SAMPLE_CACHE_DIR is not set or the cache was not built."""
+        if not self.config.SAMPLE_CACHE_DIR:
+            return None
+        cache_dir = os.path.join(self.config.SAMPLE_CACHE_DIR, subset)
+        if not SampleCache.exists(cache_dir):
+            print("Sample cache not found: " + cache_dir)
+            return None
+        return SampleCache(cache_dir)
+
+    def cache_features(self, dataset, cache_dir, groups, sample_cache=None):
+        """Runs the backbone once over the unflipped images of the dataset and
+        stores the requested feature groups ("c" and/or "p") in cache_dir.
+        An existing complete cache is reused.
+
+        Returns: the opened FeatureCache.
+        """
+        feature_cache = FeatureCache(cache_dir, groups)
+        if feature_cache.exists():
+            feature_cache.open()
+            return feature_cache
+
+        data_set = Dataset(dataset, self.config, augment=False, sample_cache=sample_cache)
+        data_generator = build_data_loader(data_set, self.config, shuffle=False)
+
+        # The cached features come from the backbone with frozen batchnorm statistics
+        self.eval()
+        written_ids = []
+        step = 0
+        for inputs in data_generator:
+            step += 1
+            printProgressBar(step, len(data_set), prefix="\tcache {}/{}".format(step, len(data_set)), length=10)
+            if len(inputs) != 17:
+                continue
+            images = Variable(inputs[0], volatile=True)
+            if self.config.GPU_COUNT:
+                images = images.cuda()
+            image_id = int(inputs[1][0][0])
+
+            with torch.no_grad():
+                outputs = {}
+                c_outs = self.resnet(images)
+                if "c" in groups:
+                    outputs.update(zip(FEATURE_LEVELS["c"], c_outs))
+                if "p" in groups:
+                    outputs.update(zip(FEATURE_LEVELS["p"], self.fpn(*c_outs)[:4]))
+            outputs = {name: outputs[name].data.cpu().numpy()[0] for name in outputs}
+
+            if not feature_cache.shards:
+                feature_cache.create(dataset.image_ids, {name: outputs[name].shape for name in outputs})
+            feature_cache.write(image_id, outputs)
+            written_ids.append(image_id)
+
+        if feature_cache.shards:
+            feature_cache.close(written_ids)
+        return feature_cache
+
+    def load_features(self, feature_cache, image_metas):
+        """Returns the cached features of the image as predict_front()
+        expects them, or None if there is no cache or the image is missing."""
+        if feature_cache is None:
+            return None
+        features = {}
+        for group in feature_cache.groups:
+            image_feature_maps = []
+            for image_meta in image_metas:
+                feature_maps = feature_cache.read(image_meta[0], group)
+                if feature_maps is None:
+                    return None
+                image_feature_maps.append(feature_maps)
+            # Stack the levels of the images of the batch
+            feature_maps = [Variable(torch.from_numpy(np.stack(level_maps, axis=0)))
+                            for level_maps in zip(*image_feature_maps)]
+            if self.config.GPU_COUNT:
+                feature_maps = [feature_map.cuda() for feature_map in feature_maps]
+            features[group] = feature_maps
+        return features
+
     def detect(self, images, limit="instance"):
+        """Runs the inference on a list of images. The backbone, FPN, RPN and
+        the semantic/saliency heads process all images as one batch, the
+        proposals, detections and post-processing run per image.
+
+        Returns: a list with the result of every image, in the order of images.
+        """
         # Mold inputs to format expected by the neural network
         print(images[0].shape)
         molded_images, image_metas = self.mold_inputs(images)
@@ -726,32 +956,41 @@ class CIN(nn.Module):
         else:
             molded_images = Variable(molded_images, volatile=True)
 
-        image_id, image_shape, window = image_metas[0][0], image_metas[0][1:4], image_metas[0][4:8]
-        top_pad, left_pad, top_pad_h, left_pad_w = window[0], window[1], window[2], window[3]
-
-        if limit in ["instance","p_interest","insttr"]:
-            result = self.predict_front([molded_images, image_metas], mode='inference', limit=limit)
-            return [result]
-        elif limit=="selection":
-            result = self.predict_front([molded_images, image_metas], mode='inference', limit="insttr")  # [x,5],[x,28,28,81]
-            predictions, segments_info, panoptic_result, instance_list = self.predict_front([molded_images, image_metas, result], mode='inference', limit=limit)
-            num = len(segments_info)  # the num of the instances
-            prediction_list = []
-            for i in range(0, num):
-                avg = np.sum(predictions[i * num:(i + 1) * num]) / num
-                prediction_list.append(avg)
-            idx = 0
-            CIRNN_pred_dict = {}
-            ioid_result=np.zeros_like(panoptic_result)
-            panoptic_result_instance_id_map=utils.rgb2id(panoptic_result)
-            for segment_info_id in segments_info:
-                if prediction_list[idx] > self.config.SELECTION_THRESHOLD:
-                    CIRNN_pred_dict[segment_info_id] = segments_info[segment_info_id]
-                    ioid_result[panoptic_result_instance_id_map==int(segment_info_id)]=utils.id2rgb(int(segment_info_id))
-                idx += 1
-            return CIRNN_pred_dict, ioid_result, segments_info,panoptic_result_instance_id_map, prediction_list, instance_list
-
-    def predict_front(self, input, mode, limit=""): #image_metas is a int numpy array
+        # volatile has no effect since torch 0.4: without no_grad autograd
+        # keeps every activation of the backbone and heads alive
+        with torch.no_grad():
+            if limit in ["instance","p_interest","insttr"]:
+                return self.predict_front([molded_images, image_metas], mode='inference', limit=limit, batched=True)
+            elif limit=="selection":
+                results = self.predict_front([molded_images, image_metas], mode='inference', limit="insttr", batched=True)  # [x,5],[x,28,28,81]
+                segments = [self.predict_segment(result, image_metas[i:i + 1]) for i, result in enumerate(results)]
+                selections = self.select_instances_batch(results, segments, image_metas)
+                selection_results = []
+                for (semantic_result, panoptic_result, segments_info), (prediction_list, instance_list) in zip(segments, selections):
+                    CIRNN_pred_dict, ioid_result, panoptic_result_instance_id_map = self.threshold_selection(prediction_list, segments_info, panoptic_result)
+                    selection_results.append((CIRNN_pred_dict, ioid_result, segments_info,panoptic_result_instance_id_map, prediction_list, instance_list))
+                return selection_results
+            elif limit=="all":
+                # Everything predict.py writes, from one backbone pass: the insttr
+                # result with the panoptic/semantic images and the selection added
+                results = self.predict_front([molded_images, image_metas], mode='inference', limit="insttr", batched=True)
+                segments = [self.predict_segment(result, image_metas[i:i + 1]) for i, result in enumerate(results)]
+                selections = self.select_instances_batch(results, segments, image_metas)
+                for result, (semantic_result, panoptic_result, segments_info), (prediction_list, instance_list) in zip(results, segments, selections):
+                    CIRNN_pred_dict, ioid_result, panoptic_result_instance_id_map = self.threshold_selection(prediction_list, segments_info, panoptic_result)
+                    result.update({"semantic_result": semantic_result, "panoptic_result": panoptic_result,
+                                   "segments_info": segments_info, "prediction_list": prediction_list,
+                                   "instance_list": instance_list, "selection": CIRNN_pred_dict,
+                                   "ioid_result": ioid_result})
+                return results
+
+    def predict_front(self, input, mode, limit="", features=None, batched=False): #image_metas is a int numpy array
+        """features: optional dict with the cached "c" ([c1..c5]) and/or "p"
+        ([p2..p5]) feature maps of the image, see load_features(). The
+        backbone and/or FPN are skipped for the cached groups.
+        batched: in the instance/insttr/p_interest inference, return the list
+        of the results of every image of the batch instead of the first one.
+        """
         molded_images = input[0]
         image_metas = input[1]
         image_id = image_metas[0][0]
@@ -775,31 +1014,14 @@ class CIN(nn.Module):
                 detection_result = input[2]
                 gt_segmentation = input[3]
                 image_info = input[4]
-                gt_instance_dict = image_info['instances']
-
-                semantic_labels, panoptic_result, segments_info = self.predict_segment(detection_result, image_metas)
-                ioi_image_dict = self.map_instance_to_gt(gt_instance_dict, segments_info,gt_segmentation, panoptic_result, image_metas)
-
-                ioi_segments_info = ioi_image_dict['segments_info']
 
-                image_shape = image_metas[0][1:4].astype('int32')  # 420,640,3
-                instance_groups, boxes, class_ids, labels, pair_label, instance_list = self.construct_dataset(semantic_labels,
-                                                                                               detection_result['influence_map'],
-                                                                                               panoptic_result,
-                                                                                               ioi_segments_info,
-                                                                                               image_shape,
-                                                                                               mode)
+                instance_groups, labels, pair_label = self.selection_sample(detection_result, gt_segmentation,
+                                                                            image_info, image_metas)
                 instance_groups = Variable(torch.unsqueeze(torch.from_numpy(instance_groups), 0)).float()
-                boxes = Variable(torch.unsqueeze(torch.from_numpy(boxes), 0)).float()
-                class_ids = Variable(torch.unsqueeze(torch.from_numpy(class_ids), 0)).float()
-                gt = Variable(torch.unsqueeze(torch.from_numpy(labels), 0)).float()
                 labels = Variable(torch.unsqueeze(torch.from_numpy(labels), 0)).float()
                 pair_label = Variable(torch.from_numpy(pair_label)).float().squeeze(0)
                 if self.config.GPU_COUNT:
                     instance_groups=instance_groups.cuda()
-                    boxes=boxes.cuda()
-                    class_ids=class_ids.cuda()
-                    gt=gt.cuda()
                     labels=labels.cuda()
                     pair_label=pair_label.cuda()
 
@@ -808,40 +1030,47 @@ class CIN(nn.Module):
             elif mode=="inference":
                 detection_result = input[2]
 
-                semantic_labels, panoptic_result, segments_info = self.predict_segment(detection_result, image_metas)
-
-                image_shape = image_metas[0][1:4].astype('int32')  # 420,640,3
-                instance_groups, boxes, class_ids, labels, pair_label, instance_list = self.construct_dataset(semantic_labels,
-                                                         detection_result['influence_map'],
-                                                         panoptic_result,
-                                                         segments_info,
-                                                         image_shape,
-                                                         mode)
-
-                if self.config.GPU_COUNT:
-                    instance_groups = Variable(FloatTensor(instance_groups)).float().cuda().unsqueeze(0)  # 1,19,2,56,56
-                    predictions = self.ciedn(instance_groups).squeeze(1).data.cpu().numpy()
-                else:
-                    instance_groups = Variable(FloatTensor(instance_groups)).float().unsqueeze(0)  # 1,19,2,56,56
-                    predictions = self.ciedn(instance_groups).squeeze(1).data.numpy()
+                semantic_result, panoptic_result, segments_info = self.predict_segment(detection_result, image_metas)
+                predictions, instance_list = self.select_instances(detection_result, semantic_result, panoptic_result,
+                                                                   segments_info, image_metas)
                 return predictions, segments_info, panoptic_result, instance_list
         else: # training - semantic/p_interest ; inference - instance/p_interest/insttr
-            [c1_out, c2_out, c3_out, c4_out, c5_out] = self.resnet(molded_images)
+            features = features or {}
+            if "c" in features:
+                [c1_out, c2_out, c3_out, c4_out, c5_out] = features["c"]
+            elif limit == "semantic" and "p" in features:
+                # the semantic head only needs the cached FPN outputs
+                c1_out = c2_out = c3_out = c4_out = c5_out = None
+            else:
+                [c1_out, c2_out, c3_out, c4_out, c5_out] = self.resnet(molded_images)
 
             if limit == "p_interest":
                 influence_preds = self.saliency(c1_out, c2_out, c3_out, c4_out, c5_out)  # (1,4,128,128)
                 if mode == "training":
                     return influence_preds
                 elif mode == "inference":
-                    influence_map=self.unmold_p_interest(influence_preds[4], image_metas)
-                    return {"influence_map":influence_map}
+                    results = [{"influence_map": self.unmold_p_interest(influence_preds[4][i:i + 1], image_metas[i:i + 1])}
+                               for i in range(len(image_metas))]
+                    return results if batched else results[0]
             else: # training - semantic ; inference - instance/insttr
-                [p2_out, p3_out, p4_out, p5_out, p6_out] = self.fpn(c1_out, c2_out, c3_out, c4_out, c5_out)
+                if "p" in features:
+                    [p2_out, p3_out, p4_out, p5_out] = features["p"]
+                    p6_out = self.fpn.P6(p5_out)
+                else:
+                    [p2_out, p3_out, p4_out, p5_out, p6_out] = self.fpn(c1_out, c2_out, c3_out, c4_out, c5_out)
 
                 # Note that P6 is used in RPN, but not in the classifier heads.
                 rpn_feature_maps = [p2_out, p3_out, p4_out, p5_out, p6_out]
                 mrcnn_feature_maps = [p2_out, p3_out, p4_out, p5_out]
 
+                # The semantic head does not use the proposals
+                if limit == "semantic":
+                    if mode == "training":
+                        return self.semantic(mrcnn_feature_maps)
+                    else:
+                        print("inference semantic not exists")
+                        exit()
+
                 # Loop through pyramid layers
                 layer_outputs = []  # list of lists
                 for p in rpn_feature_maps:
@@ -855,92 +1084,262 @@ class CIN(nn.Module):
                 outputs = [torch.cat(list(o), dim=1) for o in outputs]
                 rpn_class_logits, rpn_class, rpn_bbox = outputs
 
-                # Generate proposals
-                # Proposals are [batch, N, (y1, x1, y2, x2)] in normalized coordinates
-                # and zero padded.
-                proposal_count = self.config.POST_NMS_ROIS_TRAINING if mode == "training" \
-                    else self.config.POST_NMS_ROIS_INFERENCE
-                rpn_rois = proposal_layer([rpn_class, rpn_bbox],
-                                          proposal_count=proposal_count,
-                                          nms_threshold=self.config.RPN_NMS_THRESHOLD,
-                                          anchors=self.anchors,
-                                          config=self.config)
+                # Only the uint8 label map leaves the device
+                if self.config.SEMANTIC_STUFF_ONLY:
+                    # background and stuff, the channels generate_stuff uses
+                    classes = [0] + list(range(self.config.THING_NUM_CLASSES, self.config.NUM_CLASSES))
+                    semantic_segment = subset_semantic_labels(self.semantic(mrcnn_feature_maps, upsample=False), classes)
+                else:
+                    semantic_segment = semantic_labels(self.semantic(mrcnn_feature_maps))
+
+                # inference - instance/insttr
+                influence_map = None
+                if limit == "insttr":
+                    influence_map = self.saliency(c1_out, c2_out, c3_out, c4_out, c5_out)[4]  # (batch,1,128,128)
+                elif limit != "instance":
+                    print("mode not exists")
+                    exit()
 
-                semantic_segment = self.semantic(mrcnn_feature_maps)
+                # The proposals, detections and post-processing run per image
+                results = []
+                for i in range(len(image_metas)):
+                    results.append(self.detect_image(limit, mode, image_metas[i:i + 1], rpn_class[i:i + 1], rpn_bbox[i:i + 1],
+                                                     [feature_map[i:i + 1] for feature_map in mrcnn_feature_maps],
+                                                     semantic_segment[i:i + 1],
+                                                     None if influence_map is None else influence_map[i:i + 1]))
+                return results if batched else results[0]
+
+    def detect_image(self, limit, mode, image_metas, rpn_class, rpn_bbox, mrcnn_feature_maps, semantic_segment,
+                     influence_map=None):
+        """The per-image part of the instance/insttr inference of
+        predict_front(): proposals, detections, masks and post-processing.
+        The inputs are those of one image of the batch, with a batch
+        dimension of 1.
+        """
+        # Generate proposals
+        # Proposals are [batch, N, (y1, x1, y2, x2)] in normalized coordinates
+        # and zero padded.
+        proposal_count = self.config.POST_NMS_ROIS_TRAINING if mode == "training" \
+            else self.config.POST_NMS_ROIS_INFERENCE
+        rpn_rois = proposal_layer([rpn_class, rpn_bbox],
+                                  proposal_count=proposal_count,
+                                  nms_threshold=self.config.RPN_NMS_THRESHOLD,
+                                  anchors=self.anchors,
+                                  config=self.config)
+
+        mrcnn_class_logits, mrcnn_class, mrcnn_bbox = self.classifier(mrcnn_feature_maps, rpn_rois)
+        detections = detection_layer(self.config, rpn_rois, mrcnn_class, mrcnn_bbox, image_metas)  # 34,6
+
+        if len(detections.shape)>1:
+            h, w = self.config.IMAGE_SHAPE[:2]
+            scale = Variable(torch.from_numpy(np.array([h, w, h, w])).float(), requires_grad=False)
+            if self.config.GPU_COUNT:
+                scale = scale.cuda()
 
-                if limit == "semantic":
-                    if mode == "training":
-                        return semantic_segment
-                    else:
-                        print("inference semantic not exists")
-                        exit()
-                else: # inference - instance/insttr
-                    if limit == "instance":
-                        mrcnn_class_logits, mrcnn_class, mrcnn_bbox = self.classifier(mrcnn_feature_maps, rpn_rois)
-                        detections = detection_layer(self.config, rpn_rois, mrcnn_class, mrcnn_bbox, image_metas)  # 34,6
-                        h, w = self.config.IMAGE_SHAPE[:2]
-                        scale = Variable(torch.from_numpy(np.array([h, w, h, w])).float(), requires_grad=False)
-                        if self.config.GPU_COUNT:
-                            scale=scale.cuda()
-                        if len(detections.shape)>1:
-                            detection_boxes = detections[:, :4] / scale
-
-                            # Add back batch dimension
-                            detection_boxes = detection_boxes.unsqueeze(0)
-
-                            # Create masks for detections
-                            mrcnn_mask = self.mask(mrcnn_feature_maps, detection_boxes)  # x, 134, 28, 28
-
-                            # Add back batch dimension
-                            detections = detections.unsqueeze(0)  # [1, x, 6]
-                            mrcnn_mask = mrcnn_mask.unsqueeze(0)  # [1, x, 81, 28, 28]
-                        # ！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！ THING
-                        else:
-                            detections=torch.Tensor()
-                            mrcnn_mask=torch.Tensor()
-                            if self.config.GPU_COUNT:
-                                detections=detections.cuda()
-                                mrcnn_mask=mrcnn_mask.cuda()
-
-                        # ！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！ THING
-                        result=self.detect_objects(image_metas, detections, mrcnn_mask, semantic_segment)
-                        return result
-                    elif limit == "insttr":
-                        influence_map = self.saliency(c1_out, c2_out, c3_out, c4_out, c5_out)[4]  # (1,1,128,128)
-                        mrcnn_class_logits, mrcnn_class, mrcnn_bbox = self.classifier(mrcnn_feature_maps, rpn_rois)
-                        detections = detection_layer(self.config, rpn_rois, mrcnn_class, mrcnn_bbox, image_metas)  # 34,6
-
-                        if len(detections.shape)>1:
-                            h, w = self.config.IMAGE_SHAPE[:2]
-                            scale = Variable(torch.from_numpy(np.array([h, w, h, w])).float(), requires_grad=False)
-                            if self.config.GPU_COUNT:
-                                scale = scale.cuda()
-
-                            detection_boxes = detections[:, :4] / scale
-
-                            # Add back batch dimension
-                            detection_boxes = detection_boxes.unsqueeze(0)
-
-                            # Create masks for detections
-                            mrcnn_mask = self.mask(mrcnn_feature_maps, detection_boxes)  # x, 134, 28, 28
-
-                            # Add back batch dimension
-                            detections = detections.unsqueeze(0)  # [1, x, 6]
-                            mrcnn_mask = mrcnn_mask.unsqueeze(0)  # [1, x, 81, 28, 28]
-                        else:
-                            detections=torch.Tensor()
-                            mrcnn_mask=torch.Tensor()
-                            if self.config.GPU_COUNT:
-                                detections=detections.cuda()
-                                mrcnn_mask=mrcnn_mask.cuda()
-
-                        result = self.detect_objects(image_metas, detections, mrcnn_mask, semantic_segment)
-                        influence_map = self.unmold_p_interest(influence_map,image_metas)
-                        result['influence_map']=influence_map
-                        return result
-                    else:
-                        print("mode not exists")
-                        exit()
+            detection_boxes = detections[:, :4] / scale
+
+            # Add back batch dimension
+            detection_boxes = detection_boxes.unsqueeze(0)
+
+            # Create masks for detections
+            mrcnn_mask = self.mask(mrcnn_feature_maps, detection_boxes)  # x, 134, 28, 28
+
+            # Add back batch dimension
+            detections = detections.unsqueeze(0)  # [1, x, 6]
+            mrcnn_mask = mrcnn_mask.unsqueeze(0)  # [1, x, 81, 28, 28]
+        else:
+            detections=torch.Tensor()
+            mrcnn_mask=torch.Tensor()
+            if self.config.GPU_COUNT:
+                detections=detections.cuda()
+                mrcnn_mask=mrcnn_mask.cuda()
+
+        result = self.detect_objects(image_metas, detections, mrcnn_mask, semantic_segment)
+        if limit == "insttr":
+            result['influence_map'] = self.unmold_p_interest(influence_map, image_metas)
+        return result
+
+    def select_instances(self, detection_result, semantic_labels, panoptic_result, segments_info, image_metas):
+        """Scores the instances of the predict_segment() result of one image
+        with CIEDN, or with the cascade if SELECTION_CASCADE is set.
+
+        Returns: the list of scores and the instance ids, in the same order.
+        """
+        image_shape = image_metas[0][1:4].astype('int32')  # 420,640,3
+        instance_groups, boxes, class_ids, labels, pair_label, instance_list = self.construct_dataset(semantic_labels,
+                                                 detection_result['influence_map'],
+                                                 panoptic_result,
+                                                 segments_info,
+                                                 image_shape,
+                                                 "inference")
+
+        if self.config.SELECTION_CASCADE:
+            predictions = self.cascade_selection(instance_groups, detection_result['influence_map'],
+                                                 panoptic_result, instance_list)
+        else:
+            predictions = self.score_selection(instance_groups)
+        return predictions, instance_list
+
+    def select_instances_batch(self, detection_results, segments, image_metas):
+        """select_instances() for the images of a batch. The exact scores of
+        the images come from one CIEDN.score_batch() call per
+        SELECTION_BATCH_IMAGES images. SELECTION_CASCADE and
+        SELECTION_PARTNERS choose the pairs per image, so with either of them
+        the images are still scored one by one.
+
+        segments: the (semantic_result, panoptic_result, segments_info) of
+            predict_segment() for every image
+        Returns: the list of (scores, instance ids) of every image.
+        """
+        if self.config.SELECTION_CASCADE or self.config.SELECTION_PARTNERS:
+            return [self.select_instances(detection_result, semantic_result, panoptic_result, segments_info,
+                                          image_metas[i:i + 1])
+                    for i, (detection_result, (semantic_result, panoptic_result, segments_info))
+                    in enumerate(zip(detection_results, segments))]
+
+        instance_groups_list = []
+        instance_lists = []
+        for i, (detection_result, (semantic_result, panoptic_result, segments_info)) in enumerate(zip(detection_results, segments)):
+            image_shape = image_metas[i][1:4].astype('int32')
+            instance_groups, boxes, class_ids, labels, pair_label, instance_list = self.construct_dataset(semantic_result,
+                                                     detection_result['influence_map'],
+                                                     panoptic_result,
+                                                     segments_info,
+                                                     image_shape,
+                                                     "inference")
+            instance_groups_list.append(instance_groups)
+            instance_lists.append(instance_list)
+        return list(zip(self.score_selection_batch(instance_groups_list), instance_lists))
+
+    def score_selection_batch(self, instance_groups_list):
+        """score_selection(exact=True) of several images, scored
+        SELECTION_BATCH_IMAGES images per CIEDN.score_batch() call.
+
+        instance_groups_list: the [n_b, 2, 56, 56] numpy arrays of the images
+        Returns: the list of the n_b scores of every image.
+        """
+        prediction_lists = []
+        for start in range(0, len(instance_groups_list), self.config.SELECTION_BATCH_IMAGES):
+            instance_groups, lengths = pad_instance_groups(instance_groups_list[start:start + self.config.SELECTION_BATCH_IMAGES])
+            with torch.no_grad():
+                instance_groups = Variable(FloatTensor(instance_groups)).float()  # B,N,2,56,56
+                if self.config.GPU_COUNT:
+                    instance_groups = instance_groups.cuda()
+                scores = self.ciedn.score_batch(instance_groups, lengths, folded=self.config.SELECTION_FOLD_DECODER)
+                if self.config.GPU_COUNT:
+                    scores = scores.data.cpu().numpy()
+                else:
+                    scores = scores.data.numpy()
+            for b, length in enumerate(lengths):
+                prediction_lists.append(list(scores[b, :length]))
+        return prediction_lists
+
+    def threshold_selection(self, prediction_list, segments_info, panoptic_result):
+        """Keeps the instances scored above SELECTION_THRESHOLD.
+
+        Returns: the kept segments_info entries, the panoptic image of the
+        kept instances and the instance id map of panoptic_result.
+        """
+        idx = 0
+        CIRNN_pred_dict = {}
+        ioid_result=np.zeros_like(panoptic_result)
+        panoptic_result_instance_id_map=utils.rgb2id(panoptic_result)
+        for segment_info_id in segments_info:
+            if prediction_list[idx] > self.config.SELECTION_THRESHOLD:
+                CIRNN_pred_dict[segment_info_id] = segments_info[segment_info_id]
+                ioid_result[panoptic_result_instance_id_map==int(segment_info_id)]=utils.id2rgb(int(segment_info_id))
+            idx += 1
+        return CIRNN_pred_dict, ioid_result, panoptic_result_instance_id_map
+
+    def selection_sample(self, detection_result, gt_segmentation, image_info, image_metas):
+        """Builds the CIEDN training sample of one image from the insttr
+        detection result and the GT.
+
+        Returns: instance_groups [n, 2, 56, 56], labels [n], pair_label [n*n]
+        """
+        gt_instance_dict = image_info['instances']
+
+        semantic_labels, panoptic_result, segments_info = self.predict_segment(detection_result, image_metas)
+        ioi_image_dict = self.map_instance_to_gt(gt_instance_dict, segments_info,gt_segmentation, panoptic_result, image_metas)
+
+        ioi_segments_info = ioi_image_dict['segments_info']
+
+        image_shape = image_metas[0][1:4].astype('int32')  # 420,640,3
+        instance_groups, boxes, class_ids, labels, pair_label, instance_list = self.construct_dataset(semantic_labels,
+                                                                                       detection_result['influence_map'],
+                                                                                       panoptic_result,
+                                                                                       ioi_segments_info,
+                                                                                       image_shape,
+                                                                                       'training')
+        return instance_groups, labels, pair_label
+
+    def score_selection(self, instance_groups, exact=False):
+        """Scores every instance by the average of its pairwise CIEDN scores.
+
+        instance_groups: [n, 2, 56, 56] numpy array from construct_dataset()
+        exact: ignore SELECTION_PARTNERS and average over all n partners
+
+        Returns: list of n scores, in the order of instance_groups.
+        """
+        num = instance_groups.shape[0]  # the num of the instances
+        partners = None
+        if not exact and self.config.SELECTION_PARTNERS and num > self.config.SELECTION_PARTNERS:
+            saliency = instance_groups[:, 1].mean(axis=(1, 2))
+            partners = select_partners(saliency, self.config.SELECTION_PARTNERS,
+                                       self.config.SELECTION_PARTNER_MODE, self.config.SELECTION_PARTNER_SEED)
+        with torch.no_grad():
+            instance_groups = Variable(FloatTensor(instance_groups)).float().unsqueeze(0)  # 1,n,2,56,56
+            if self.config.GPU_COUNT:
+                instance_groups = instance_groups.cuda()
+            if partners is not None:
+                # O(n*k): pair each instance with the selected partners only
+                partners = Variable(torch.from_numpy(partners).long())
+                if self.config.GPU_COUNT:
+                    partners = partners.cuda()
+                scores = self.ciedn.score_partners(instance_groups, partners, folded=self.config.SELECTION_FOLD_DECODER)
+            elif self.config.SELECTION_FOLD_DECODER:
+                # O(n): the decoder is a single affine map
+                scores = self.ciedn.score_instances(instance_groups)
+            if partners is not None or self.config.SELECTION_FOLD_DECODER:
+                if self.config.GPU_COUNT:
+                    scores = scores.data.cpu().numpy()
+                else:
+                    scores = scores.data.numpy()
+                return list(scores)
+
+            predictions = self.ciedn(instance_groups).squeeze(1)
+            if self.config.GPU_COUNT:
+                predictions = predictions.data.cpu().numpy()
+            else:
+                predictions = predictions.data.numpy()
+        prediction_list = []
+        for i in range(0, num):
+            avg = np.sum(predictions[i * num:(i + 1) * num]) / num
+            prediction_list.append(avg)
+        return prediction_list
+
+    def cascade_selection(self, instance_groups, saliency_map, panoptic_result, instance_list):
+        """Decides the clear instances from their saliency overlap and scores
+        only the ambiguous ones with CIEDN.
+
+        instance_groups: [n, 2, 56, 56] numpy array from construct_dataset()
+        saliency_map: [H, W] influence map of the image
+        panoptic_result: [H, W, 3] panoptic result from predict_segment()
+        instance_list: the instance ids, in the order of instance_groups
+
+        Returns: list of n scores, 0/1 for the instances decided by the
+        cascade. Updates self.cascade_stats.
+        """
+        overlaps = saliency_overlap(saliency_map, utils.rgb2id(panoptic_result), instance_list)
+        predictions = np.where(overlaps >= self.config.SELECTION_CASCADE_HIGH, 1.0, 0.0)
+        ambiguous = np.where((overlaps > self.config.SELECTION_CASCADE_LOW) &
+                             (overlaps < self.config.SELECTION_CASCADE_HIGH))[0]
+        if ambiguous.shape[0] > 0:
+            predictions[ambiguous] = self.score_selection(instance_groups[ambiguous])
+
+        self.cascade_stats["instances"] += len(instance_list)
+        self.cascade_stats["skipped"] += len(instance_list) - ambiguous.shape[0]
+        return list(predictions)
 
     def mold_inputs(self, images):
         """Takes a list of images and modifies them to the format expected
@@ -983,19 +1382,18 @@ class CIN(nn.Module):
 
         result = {}
         
-        semantic_segment, stuff_detections, stuff_masks = generate_stuff(self.config, semantic_segment)  # [y, 5],[y, 500, 500] [1, 134, 512, 512]
+        semantic_segment, stuff_detections = generate_stuff(self.config, semantic_segment)  # [500, 500],[y, 5] [1, 500, 500]
+        stuff_label = semantic_segment  # the stuff masks are cut from it
 
-        if len(thing_detections.shape) > 1 and len(stuff_detections.shape) > 1 and self.config.GPU_COUNT:
+        if len(thing_detections.shape) > 1 and len(stuff_detections.shape) > 1:
             if self.config.GPU_COUNT:
                 thing_detections = thing_detections.data.cpu().numpy()
                 thing_masks = thing_masks.permute(0, 1, 3, 4, 2).data.cpu().numpy()
                 stuff_detections = stuff_detections.data.cpu().numpy()  # [y,5]
-                stuff_masks = stuff_masks.data.cpu().numpy()  # [y,500,500]
             else:
                 thing_detections = thing_detections.data.numpy()
                 thing_masks = thing_masks.permute(0, 1, 3, 4, 2).data.numpy()
                 stuff_detections = stuff_detections.data.numpy()  # [y,5]
-                stuff_masks = stuff_masks.data.numpy()  # [y,500,500]
             thing_detections = thing_detections.squeeze(0)  # [x,6]
             thing_masks = thing_masks.squeeze(0)  # [x,28,28,81]
 
@@ -1008,7 +1406,7 @@ class CIN(nn.Module):
             thing_class_ids, thing_boxes, thing_masks_unmold, thing_scores = filter_thing_masks(thing_detections,
                                                                                                 thing_masks,
                                                                                                 image_shape, window)
-            stuff_class_ids, stuff_boxes, stuff_masks_unmold = filter_stuff_masks(stuff_detections, stuff_masks,
+            stuff_class_ids, stuff_boxes, stuff_masks_unmold = filter_stuff_masks(stuff_detections, stuff_label,
                                                                                   image_shape, window)
             result={
                 "thing_boxes": thing_boxes,
@@ -1020,13 +1418,9 @@ class CIN(nn.Module):
                 "stuff_masks": stuff_masks_unmold,
                 "semantic_segment": semantic_segment
             }
-        elif len(thing_detections.shape) == 1 and len(stuff_detections.shape) > 1 and self.config.GPU_COUNT:
-            if self.config.GPU_COUNT:
-                stuff_detections = stuff_detections.data.cpu().numpy()  # [y,5]
-                stuff_masks = stuff_masks.data.cpu().numpy()  # [y,500,500]
-            else:
-                stuff_detections = stuff_detections.data.numpy()  # [y,5]
-                stuff_masks = stuff_masks.data.numpy()  # [y,500,500]
+        elif len(thing_detections.shape) == 1 and len(stuff_detections.shape) > 1:
+            # generate_stuff returns the detections on the CPU
+            stuff_detections = stuff_detections.data.numpy()  # [y,5]
 
             semantic_segment = resize_semantic_label(semantic_segment, (self.config.IMAGE_SIZE, self.config.IMAGE_SIZE))
             semantic_segment = semantic_segment[top_pad:top_pad_h, left_pad:left_pad_w]
@@ -1034,7 +1428,7 @@ class CIN(nn.Module):
                                                                      image_shape[1] / (left_pad_w - left_pad)],
                                                   mode='nearest', order=0)
 
-            stuff_class_ids, stuff_boxes, stuff_masks_unmold = filter_stuff_masks(stuff_detections, stuff_masks,
+            stuff_class_ids, stuff_boxes, stuff_masks_unmold = filter_stuff_masks(stuff_detections, stuff_label,
                                                                                   image_shape, window)
 
             result={
@@ -1043,7 +1437,7 @@ class CIN(nn.Module):
                 "stuff_masks": stuff_masks_unmold,
                 "semantic_segment": semantic_segment
             }
-        elif len(thing_detections.shape) > 1 and len(stuff_detections.shape) == 1 and self.config.GPU_COUNT:
+        elif len(thing_detections.shape) > 1 and len(stuff_detections.shape) == 1:
             if self.config.GPU_COUNT:
                 thing_detections = thing_detections.data.cpu().numpy()
                 thing_masks = thing_masks.permute(0, 1, 3, 4, 2).data.cpu().numpy()
@@ -1105,9 +1499,9 @@ class CIN(nn.Module):
                 category_id=class_dict[str(int(class_id))]['category_id']
                 category_name=class_dict[str(int(class_id))]['name']
                 id,color = id_generator.get_id_and_color(str(category_id))
-                mask=stuff_masks[i]==1
-                panoptic_result[mask]=color
-                semantic_result[mask] = [int(class_id),int(class_id),int(class_id)]
+                mask=stuff_masks[i]  # utils.BoxMask
+                mask.paint(panoptic_result, color)
+                mask.paint(semantic_result, [int(class_id),int(class_id),int(class_id)])
                 information_collector[str(id)]={"id":int(id),"bbox":[int(stuff_boxes[i][0]),int(stuff_boxes[i][1]),int(stuff_boxes[i][2]),int(stuff_boxes[i][3])], \
                                                 "class_id": int(class_id), "category_id":int(category_id),"category_name":category_name, \
                                                 'mask': mask}
@@ -1117,9 +1511,9 @@ class CIN(nn.Module):
                 category_id=class_dict[str(int(class_id))]['category_id']
                 category_name=class_dict[str(int(class_id))]['name']
                 id, color = id_generator.get_id_and_color(str(category_id))
-                mask=thing_masks[i]==1          # 426,640
-                panoptic_result[mask]=color     # 426,640,3
-                semantic_result[mask] = [int(class_id),int(class_id),int(class_id)]
+                mask=thing_masks[i]             # utils.BoxMask in 426,640
+                mask.paint(panoptic_result, color)  # 426,640,3
+                mask.paint(semantic_result, [int(class_id),int(class_id),int(class_id)])
                 information_collector[str(id)]={"id": int(id), "bbox": [int(thing_boxes[i][0]),int(thing_boxes[i][1]),int(thing_boxes[i][2]),int(thing_boxes[i][3])], \
                                                 "class_id": int(class_id), "category_id": int(category_id),"category_name":category_name, \
                                                 'mask': mask}
@@ -1217,29 +1611,34 @@ class CIN(nn.Module):
         return instance_groups, boxes, class_ids, labels, pair_label, instance_list
 
     def map_instance_to_gt(self, gt_instance_dict, instance_dict, gt_segmentation, segmentation, image_metas):
-        def compute_pixel_iou(bool_mask_pred, bool_mask_gt):
-            intersection = bool_mask_pred * bool_mask_gt
-            union = bool_mask_pred + bool_mask_gt
-            return np.count_nonzero(intersection) / np.count_nonzero(union)  # np.count_nonzero: 计算数组中非零元素的个数
-
         instance_pred_gt_dict = {}
         instance_gt_pred_dict = {}
 
+        # gt_segmentation is the id map Dataset builds
         if self.config.GPU_COUNT:
-            gt_segmentation = gt_segmentation.squeeze(0).data.cpu().numpy()
+            gt_segmentation_id = gt_segmentation.squeeze(0).data.cpu().numpy()
         else:
-            gt_segmentation = gt_segmentation.squeeze(0).data.numpy()
+            gt_segmentation_id = gt_segmentation.squeeze(0).data.numpy()
 
-        gt_segmentation_id = utils.rgb2id(gt_segmentation)
         segmentation_id = utils.rgb2id(segmentation)
 
-        for instance_id in instance_dict:
-            mask = segmentation_id == int(instance_id)
-            instance_dict[instance_id]['mask'] = mask
-
-        for gt_instance_id in gt_instance_dict:
-            gt_mask = gt_segmentation_id == int(gt_instance_id)
-            gt_instance_dict[gt_instance_id]['mask'] = gt_mask
+        # The pixel counts of every (prediction id, gt id) pair in one pass,
+        # instead of a full-image mask per instance. The ids are below 256**3.
+        pairs = segmentation_id.astype(np.int64) * 256 ** 3 + gt_segmentation_id.astype(np.int64)
+        pair_keys, pair_counts = np.unique(pairs, return_counts=True)
+        intersections = {(int(key // 256 ** 3), int(key % 256 ** 3)): int(count)
+                         for key, count in zip(pair_keys, pair_counts)}
+        areas = defaultdict(int)
+        gt_areas = defaultdict(int)
+        for (instance_id, gt_instance_id), count in intersections.items():
+            areas[instance_id] += count
+            gt_areas[gt_instance_id] += count
+
+        def compute_pixel_iou(instance_id, gt_instance_id):
+            instance_id, gt_instance_id = int(instance_id), int(gt_instance_id)
+            intersection = intersections.get((instance_id, gt_instance_id), 0)
+            union = areas[instance_id] + gt_areas[gt_instance_id] - intersection
+            return intersection / union
 
         if len(instance_dict)==0:
             for gt_instance_id in gt_instance_dict:
@@ -1249,7 +1648,7 @@ class CIN(nn.Module):
                 max_iou = -1
                 max_gt_instance_id = ""
                 for gt_instance_id in gt_instance_dict:
-                    i_iou = compute_pixel_iou(instance_dict[instance_id]['mask'], gt_instance_dict[gt_instance_id]['mask'])
+                    i_iou = compute_pixel_iou(instance_id, gt_instance_id)
                     if gt_instance_id not in instance_gt_pred_dict:
                         instance_gt_pred_dict[gt_instance_id] = {"labeled": gt_instance_dict[gt_instance_id]['labeled'].data.numpy()[0]==1, "pred": []}
                     if i_iou >= self.config.MAP_IOU and instance_dict[instance_id]['category_id'] == gt_instance_dict[gt_instance_id]['category_id'].data.numpy()[0] and i_iou > max_iou:
@@ -1267,11 +1666,9 @@ class CIN(nn.Module):
             if instance_gt_pred_dict[instance_id]['labeled'] == True and len(instance_gt_pred_dict[instance_id]['pred']) == 0:
                 base += 1
 
+        # The masks of predict_segment() are not part of the result
         for instance_id in instance_dict:
-            del instance_dict[instance_id]['mask']
-
-        for gt_instance_id in gt_instance_dict:
-            del gt_instance_dict[gt_instance_id]['mask']
+            instance_dict[instance_id].pop('mask', None)
 
         for instance_id in instance_dict:
             if instance_id in instance_pred_gt_dict:
@@ -1,6 +1,7 @@
 import os
 import random
 import json
+import inspect
 
 import torch
 from torch.utils.data.dataset import Dataset as TorchDataset
@@ -15,8 +16,9 @@ from PIL import Image
 from matplotlib import pyplot as plt
 
 from utils.utils import generate_pyramid_anchors, rgb2id, resize_image, resize_mask, resize_map, minimize_mask, \
-    compute_overlaps, extract_bboxes
+    compute_overlaps_max, extract_bboxes
 from utils.formatting_utils import compose_image_meta, mold_image
+from utils.sample_cache import SampleCacheWriter
 from config import Config
 
 
@@ -25,7 +27,44 @@ from config import Config
 ############################################################
 
 
-def load_image_gt(dataset, config, image_id, augment=False, use_mini_mask=False):
+# The arrays prepare_image_gt() returns, in order; the sample cache stores them under these names
+SAMPLE_ARRAYS = ["image", "image_meta", "thing_class_ids", "thing_bbox", "thing_mask", "stuff_class_ids",
+                 "stuff_bbox", "stuff_mask", "semantic_label", "segmentation", "influence_class_ids",
+                 "influence_bbox", "influence_mask"]
+
+
+def load_image_gt(dataset, config, image_id, augment=False, use_mini_mask=False, sample_cache=None):
+    """Loads the resized image and GT of an image, from sample_cache if it
+    holds the image, and applies the random flip.
+    """
+    if sample_cache is not None and image_id in sample_cache:
+        arrays = sample_cache.read(image_id)
+        image, image_meta, thing_class_ids, thing_bbox, thing_mask, stuff_class_ids, stuff_bbox, stuff_mask, \
+        semantic_label, segmentation, influence_class_ids, influence_bbox, influence_mask = \
+            [arrays[name] for name in SAMPLE_ARRAYS]
+    else:
+        image, image_meta, thing_class_ids, thing_bbox, thing_mask, stuff_class_ids, stuff_bbox, stuff_mask, \
+        semantic_label, segmentation, influence_class_ids, influence_bbox, influence_mask = \
+            prepare_image_gt(dataset, config, image_id, use_mini_mask)
+
+    image_info = dataset.image_info[str(image_id)]
+
+    # Random horizontal flips.
+    if augment:
+        if random.randint(0, 1):
+            image = np.fliplr(image)
+            thing_mask = np.fliplr(thing_mask)
+            semantic_label = np.fliplr(semantic_label)
+            segmentation = np.fliplr(segmentation)
+    return image, image_meta, thing_class_ids, thing_bbox, thing_mask, stuff_class_ids, stuff_bbox, stuff_mask, \
+           semantic_label, segmentation, image_info, influence_class_ids, influence_bbox, influence_mask
+
+
+def prepare_image_gt(dataset, config, image_id, use_mini_mask=False):
+    """The deterministic part of load_image_gt(): decodes the image and the
+    panoptic annotation and builds the resized image, masks, boxes and
+    semantic label. Returns the arrays in the order of SAMPLE_ARRAYS.
+    """
     # Load image and mask
     image_name = dataset.image_info[str(image_id)]['image_name']
     # print(image_name)
@@ -38,7 +77,8 @@ def load_image_gt(dataset, config, image_id, augment=False, use_mini_mask=False)
         padding=config.IMAGE_PADDING)
     image_meta = compose_image_meta(image_id, shape, window)
 
-    thing_mask, thing_class_ids, stuff_mask, stuff_class_ids, influence_mask, influence_class_ids = dataset.load_mask(image_id)
+    thing_mask, thing_class_ids, stuff_mask, stuff_class_ids, influence_mask, influence_class_ids, \
+    semantic_label, segmentation = dataset.load_gt(image_id)
     thing_mask = resize_mask(thing_mask, scale, padding)  # 1024
     stuff_mask = resize_mask(stuff_mask, scale, padding)  # 1024
     influence_mask = resize_mask(influence_mask, scale, padding)  # 1024
@@ -54,17 +94,6 @@ def load_image_gt(dataset, config, image_id, augment=False, use_mini_mask=False)
         stuff_mask = minimize_mask(
             stuff_bbox, stuff_mask, config.MINI_MASK_SHAPE)
 
-    segmentation = skimage.io.imread(os.path.join(dataset.annotation_dir, image_name.replace("jpg", "png")))
-
-    semantic_label = np.zeros_like(segmentation)
-    segmentation_instance_id_map=rgb2id(segmentation)
-    instance_id_list=list(dataset.image_info[str(image_id)]['instances'].keys())
-    for instance_id in instance_id_list:
-        instance=dataset.image_info[str(image_id)]['instances'][instance_id]
-        instance_mask=segmentation_instance_id_map==int(instance_id)
-        semantic_label[instance_mask]=dataset.category_info[str(instance['category_id'])]['class_id']
-    semantic_label=semantic_label[:,:,0]
-
     semantic_label_h = semantic_label.shape[0]
     semantic_label_w = semantic_label.shape[1]
     semantic_label_scale = min(500 / semantic_label_h, 500 / semantic_label_w)
@@ -79,17 +108,24 @@ def load_image_gt(dataset, config, image_id, augment=False, use_mini_mask=False)
     padding = [(top_pad, bottom_pad), (left_pad, right_pad)]
     semantic_label = np.pad(semantic_label, padding, mode='constant', constant_values=0)
 
-    image_info = dataset.image_info[str(image_id)]
-
-    # Random horizontal flips.
-    if augment:
-        if random.randint(0, 1):
-            image = np.fliplr(image)
-            thing_mask = np.fliplr(thing_mask)
-            semantic_label = np.fliplr(semantic_label)
-            segmentation = np.fliplr(segmentation)
     return image, image_meta, thing_class_ids, thing_bbox, thing_mask, stuff_class_ids, stuff_bbox, stuff_mask, \
-           semantic_label, segmentation, image_info, influence_class_ids, influence_bbox, influence_mask
+           semantic_label, segmentation, influence_class_ids, influence_bbox, influence_mask
+
+
+def preprocess_samples(dataset, config, cache_dir):
+    """Writes prepare_image_gt() of every image of the dataset into a sample
+    cache in cache_dir, see utils/sample_cache.py."""
+    writer = SampleCacheWriter(cache_dir, config.SAMPLE_CACHE_SHARD_IMAGES)
+    for step, image_id in enumerate(dataset.image_ids):
+        print(str(step + 1) + "/" + str(len(dataset.image_ids)))
+        try:
+            arrays = prepare_image_gt(dataset, config, image_id, use_mini_mask=config.USE_MINI_MASK)
+        except Exception as e:
+            print(str(image_id) + " error")
+            print(e)
+            continue
+        writer.add(image_id, dict(zip(SAMPLE_ARRAYS, arrays)))
+    writer.close()
 
 
 def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
@@ -120,16 +156,17 @@ def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
         crowd_boxes = gt_boxes[crowd_ix]
         gt_class_ids = gt_class_ids[non_crowd_ix]
         gt_boxes = gt_boxes[non_crowd_ix]
-        # Compute overlaps with crowd boxes [anchors, crowds]
-        crowd_overlaps = compute_overlaps(anchors, crowd_boxes)
-        crowd_iou_max = np.amax(crowd_overlaps, axis=1)
+        # Max overlap of each anchor with the crowd boxes
+        _, crowd_iou_max, _ = compute_overlaps_max(anchors, crowd_boxes, config.RPN_OVERLAP_CHUNK)
         no_crowd_bool = (crowd_iou_max < 0.001)
     else:
         # All anchors don't intersect a crowd
         no_crowd_bool = np.ones([anchors.shape[0]], dtype=bool)
 
-    # Compute overlaps [num_anchors, num_gt_boxes]
-    overlaps = compute_overlaps(anchors, gt_boxes)
+    # Best GT box of each anchor and best anchor of each GT box, computed in
+    # blocks of anchors instead of the full [num_anchors, num_gt_boxes] matrix
+    anchor_iou_argmax, anchor_iou_max, gt_iou_argmax = compute_overlaps_max(anchors, gt_boxes,
+                                                                            config.RPN_OVERLAP_CHUNK)
 
     # Match anchors to GT Boxes
     # If an anchor overlaps a GT box with IoU >= 0.7 then it's positive.
@@ -141,12 +178,9 @@ def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
     #
     # 1. Set negative anchors first. They get overwritten below if a GT box is
     # matched to them. Skip boxes in crowd areas.
-    anchor_iou_argmax = np.argmax(overlaps, axis=1)
-    anchor_iou_max = overlaps[np.arange(overlaps.shape[0]), anchor_iou_argmax]
     rpn_match[(anchor_iou_max < 0.3) & (no_crowd_bool)] = -1
     # 2. Set an anchor for each GT box (regardless of IoU value).
     # TODO: If multiple anchors have the same IoU match all of them
-    gt_iou_argmax = np.argmax(overlaps, axis=0)
     rpn_match[gt_iou_argmax] = 1
     # 3. Set anchors with high overlap as positive.
     rpn_match[anchor_iou_max >= 0.7] = 1
@@ -171,40 +205,37 @@ def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
     # For positive anchors, compute shift and scale needed to transform them
     # to match the corresponding GT boxes.
     ids = np.where(rpn_match == 1)[0]
-    ix = 0  # index into rpn_bbox
-    # TODO: use box_refinment() rather than duplicating the code here
-    for i, a in zip(ids, anchors[ids]):
-        # Closest gt box (it might have IoU < 0.7)
-        gt = gt_boxes[anchor_iou_argmax[i]]
-
-        # Convert coordinates to center plus width/height.
-        # GT Box
-        gt_h = gt[2] - gt[0]
-        gt_w = gt[3] - gt[1]
-        gt_center_y = gt[0] + 0.5 * gt_h
-        gt_center_x = gt[1] + 0.5 * gt_w
-        # Anchor
-        a_h = a[2] - a[0]
-        a_w = a[3] - a[1]
-        a_center_y = a[0] + 0.5 * a_h
-        a_center_x = a[1] + 0.5 * a_w
-
-        # Compute the bbox refinement that the RPN should predict.
-        rpn_bbox[ix] = [
-            (gt_center_y - a_center_y) / a_h,
-            (gt_center_x - a_center_x) / a_w,
-            np.log(gt_h / a_h),
-            np.log(gt_w / a_w),
-        ]
-        # Normalize
-        rpn_bbox[ix] /= config.RPN_BBOX_STD_DEV
-        ix += 1
+    # Closest gt box of each positive anchor (it might have IoU < 0.7)
+    gt = gt_boxes[anchor_iou_argmax[ids]]
+    a = anchors[ids]
+
+    # Convert coordinates to center plus width/height.
+    # GT Box
+    gt_h = gt[:, 2] - gt[:, 0]
+    gt_w = gt[:, 3] - gt[:, 1]
+    gt_center_y = gt[:, 0] + 0.5 * gt_h
+    gt_center_x = gt[:, 1] + 0.5 * gt_w
+    # Anchor
+    a_h = a[:, 2] - a[:, 0]
+    a_w = a[:, 3] - a[:, 1]
+    a_center_y = a[:, 0] + 0.5 * a_h
+    a_center_x = a[:, 1] + 0.5 * a_w
+
+    # Compute the bbox refinement that the RPN should predict.
+    rpn_bbox[:ids.shape[0]] = np.stack([
+        (gt_center_y - a_center_y) / a_h,
+        (gt_center_x - a_center_x) / a_w,
+        np.log(gt_h / a_h),
+        np.log(gt_w / a_w),
+    ], axis=1)
+    # Normalize
+    rpn_bbox[:ids.shape[0]] /= config.RPN_BBOX_STD_DEV
 
     return rpn_match, rpn_bbox
 
 
 class Dataset(TorchDataset):
-    def __init__(self, dataset, config, augment=True):
+    def __init__(self, dataset, config, augment=True, sample_cache=None):
         self.b = 0  # batch item index
         self.image_index = -1
         self.image_ids = np.copy(dataset.image_ids)
@@ -213,6 +244,8 @@ class Dataset(TorchDataset):
         self.dataset = dataset
         self.config = config
         self.augment = augment
+        # Optional SampleCache with the preprocessed images and GT
+        self.sample_cache = sample_cache
 
         # Anchors
         # [anchor_count, (y1, x1, y2, x2)]
@@ -229,7 +262,8 @@ class Dataset(TorchDataset):
             gt_stuff_class_ids, gt_stuff_boxes, gt_stuff_masks, gt_semantic_label, gt_segmentation, \
             gt_image_instances, gt_influence_class_ids, gt_influence_boxes, gt_influence_masks = \
                 load_image_gt(self.dataset, self.config, image_id,
-                              augment=self.augment, use_mini_mask=self.config.USE_MINI_MASK)
+                              augment=self.augment, use_mini_mask=self.config.USE_MINI_MASK,
+                              sample_cache=self.sample_cache)
 
             if gt_thing_class_ids.shape[0] == 0 or gt_stuff_class_ids.shape[0] == 0 or gt_influence_class_ids.shape[0] == 0:
                 print(str(image_id)+" error")
@@ -251,7 +285,8 @@ class Dataset(TorchDataset):
             rpn_match = rpn_match[:, np.newaxis]
             images = mold_image(image.astype(np.float32), self.config)
 
-            # Convert
+            # Convert. The masks and labels stay uint8 and the segmentation an
+            # int32 id map until they reach the device, see compact_inputs()
             images = torch.from_numpy(images.transpose(2, 0, 1)).float()
             image_metas = torch.from_numpy(image_metas.astype(np.float32))
             rpn_match = torch.from_numpy(rpn_match)
@@ -260,57 +295,58 @@ class Dataset(TorchDataset):
             if gt_thing_class_ids.shape[0] > 0:
                 gt_thing_class_ids = torch.from_numpy(gt_thing_class_ids)
                 gt_thing_boxes = torch.from_numpy(gt_thing_boxes).float()
-                gt_thing_masks = gt_thing_masks.astype(int).transpose(2, 0, 1)
+                gt_thing_masks = np.ascontiguousarray(gt_thing_masks.transpose(2, 0, 1), dtype=np.uint8)
                 # for i in range(gt_thing_masks.shape[0]):
                 #     plt.figure()
                 #     plt.imshow(gt_thing_masks[i])
                 #     plt.show()
-                gt_thing_masks = torch.from_numpy(gt_thing_masks).float()
+                gt_thing_masks = torch.from_numpy(gt_thing_masks)
             else:
                 gt_thing_class_ids = torch.IntTensor()
                 gt_thing_boxes = torch.FloatTensor()
-                gt_thing_masks = torch.FloatTensor()
+                gt_thing_masks = torch.ByteTensor()
 
             if gt_stuff_class_ids.shape[0] > 0:
                 gt_stuff_class_ids = torch.from_numpy(gt_stuff_class_ids)
                 gt_stuff_boxes = torch.from_numpy(gt_stuff_boxes).float()
-                gt_stuff_masks = gt_stuff_masks.astype(int).transpose(2, 0, 1)
+                gt_stuff_masks = np.ascontiguousarray(gt_stuff_masks.transpose(2, 0, 1), dtype=np.uint8)
                 # for i in range(gt_stuff_masks.shape[0]):
                 #     plt.figure()
                 #     plt.imshow(gt_stuff_masks[i])
                 #     plt.show()
-                gt_stuff_masks = torch.from_numpy(gt_stuff_masks).float()
+                gt_stuff_masks = torch.from_numpy(gt_stuff_masks)
             else:
                 gt_stuff_class_ids = torch.IntTensor()
                 gt_stuff_boxes = torch.FloatTensor()
-                gt_stuff_masks = torch.FloatTensor()
+                gt_stuff_masks = torch.ByteTensor()
 
             gt_semantic_label = torch.from_numpy(
-                np.ascontiguousarray(gt_semantic_label, dtype=np.uint8)).long()
+                np.ascontiguousarray(gt_semantic_label, dtype=np.uint8))
 
+            # Panoptic ids are below 256 ** 3, so int32 holds them exactly
             gt_segmentation = torch.from_numpy(
-                np.ascontiguousarray(gt_segmentation, dtype=np.uint8)).long()
+                np.ascontiguousarray(rgb2id(gt_segmentation), dtype=np.int32))
 
             if gt_influence_class_ids.shape[0] > 0:
                 gt_influence_class_ids = torch.from_numpy(
                     gt_influence_class_ids)
                 gt_influence_boxes = torch.from_numpy(
                     gt_influence_boxes).float()
-                gt_influence_masks = gt_influence_masks.astype(
-                    int).transpose(2, 0, 1)
+                gt_influence_masks = np.ascontiguousarray(
+                    gt_influence_masks.transpose(2, 0, 1), dtype=np.uint8)
                 # for i in range(gt_stuff_masks.shape[0]):
                 #     plt.figure()
                 #     plt.imshow(gt_stuff_masks[i])
                 #     plt.show()
                 gt_influence_map = torch.from_numpy(
-                    np.max(gt_influence_masks, axis=0)).float()
+                    np.max(gt_influence_masks, axis=0))
                 gt_influence_masks = torch.from_numpy(
-                    gt_influence_masks).float()
+                    gt_influence_masks)
             else:
                 gt_influence_class_ids = torch.IntTensor()
                 gt_influence_boxes = torch.FloatTensor()
-                gt_influence_masks = torch.FloatTensor()
-                gt_influence_map = torch.FloatTensor()
+                gt_influence_masks = torch.ByteTensor()
+                gt_influence_map = torch.ByteTensor()
 
             # plt.figure()
             # plt.imshow(gt_segmentation)
@@ -334,6 +370,88 @@ class Dataset(TorchDataset):
         return self.image_ids.shape[0]
 
 
+def compact_inputs(gt_masks, gt_stuff_masks, gt_semantic_label, gt_influence_map, gt_interest_masks):
+    """Converts the uint8 masks and labels Dataset returns to the float masks
+    and long semantic label the losses expect. Called after the inputs are
+    moved to the device, so only the compact tensors cross the loader.
+    """
+    return gt_masks.float(), gt_stuff_masks.float(), gt_semantic_label.long(), \
+           gt_influence_map.float(), gt_interest_masks.float()
+
+
+def skip_none_collate(batch):
+    """Collates the valid items of the batch; Dataset returns None for the
+    images without annotations."""
+    batch = list(filter(lambda x: x is not None, batch))
+    if len(batch) == 0:
+        print("No valid data!!!")
+        batch = [[torch.from_numpy(np.zeros([1, 1]))]]
+    return default_collate(batch)
+
+
+# The Dataset items holding per-instance GT (thing, stuff and influence class
+# ids, boxes and masks), padded along their first dimension by pad_collate()
+GT_INSTANCE_ITEMS = [4, 5, 6, 7, 8, 9, 12, 13, 14]
+
+
+def pad_tensor(tensor, shape):
+    padded = tensor.new_zeros(tuple(shape))
+    padded[tuple(slice(0, size) for size in tensor.shape)] = tensor
+    return padded
+
+
+def pad_collate(batch):
+    """Collates a batch of several images. The GT instance tensors are zero
+    padded to the largest instance count of the batch, so class id 0 marks
+    the padding. The segmentation id maps are
+    padded to the largest image of the batch and gt_image_instances stays a
+    list of the per-image dicts.
+    """
+    batch = list(filter(lambda x: x is not None, batch))
+    if len(batch) == 0:
+        return skip_none_collate(batch)
+
+    collated = []
+    for index, items in enumerate(zip(*batch)):
+        if index in GT_INSTANCE_ITEMS:
+            count = max(item.shape[0] for item in items)
+            items = [pad_tensor(item, [count] + list(item.shape[1:])) for item in items]
+        elif index == 15:
+            shape = np.max([list(item.shape) for item in items], axis=0)
+            items = [pad_tensor(item, shape) for item in items]
+        elif index == 16:
+            collated.append(list(items))
+            continue
+        collated.append(torch.stack(items, 0))
+    return collated
+
+
+def seed_worker(worker_id):
+    """Gives every loader worker its own numpy and python random streams, so
+    the flips and the instance sub-sampling differ between workers."""
+    seed = torch.initial_seed() % 2 ** 32
+    np.random.seed(seed)
+    random.seed(seed)
+
+
+def build_data_loader(data_set, config, shuffle=True, batch_size=1):
+    """DataLoader over a Dataset that decodes and builds the targets in
+    config.DATA_LOADER_WORKERS worker processes. The batches come back
+    through shared memory and are pinned for the host to GPU copy. Batches of
+    more than one image are collated by pad_collate()."""
+    collate_fn = skip_none_collate
+    if batch_size > 1:
+        collate_fn = pad_collate
+    kwargs = {"collate_fn": collate_fn, "batch_size": batch_size, "shuffle": shuffle,
+              "num_workers": config.DATA_LOADER_WORKERS, "pin_memory": bool(config.GPU_COUNT)}
+    if config.DATA_LOADER_WORKERS > 0:
+        kwargs["worker_init_fn"] = seed_worker
+        # prefetch_factor only exists in newer torch, older versions prefetch 2 batches per worker
+        if "prefetch_factor" in inspect.signature(TorchDataLoader.__init__).parameters:
+            kwargs["prefetch_factor"] = config.DATA_LOADER_PREFETCH
+    return TorchDataLoader(data_set, **kwargs)
+
+
 ############################################################
 #  Dataset
 ############################################################
@@ -439,73 +557,73 @@ class OOIDataset(BaseDataset):
             open("data/" + mode + "_images_dict.json", 'r'))
         self.prepare()
 
-    def load_mask(self, image_id, type="thing"):
+        # category_id -> class_id lookup table
+        self.category_class_lut = np.zeros(max(int(category_id) for category_id in self.category_info) + 1, dtype=np.int32)
+        for category_id in self.category_info:
+            self.category_class_lut[int(category_id)] = self.category_info[category_id]['class_id']
+
+    def load_gt(self, image_id):
+        """Decodes the panoptic PNG once and builds every GT map of the image
+        from one labelled map, where pixel value i+1 is the i-th annotated
+        segment and 0 is unannotated.
+
+        Returns: thing_masks, thing_class_ids, stuff_masks, stuff_class_ids,
+        influence_masks, influence_class_ids as load_mask(), then the
+        semantic label [H, W] (uint8 class ids) and the decoded segmentation
+        [H, W, 3].
+        """
         image_info = self.image_info[str(image_id)]
-        # image_interest_info = self.interest_info[str(image_id)]
         annotations = image_info['instances']
         masks_file = image_info['image_name'].replace("jpg", "png")
-        masks_path = os.path.join(self.annotation_dir, masks_file)
-
-        segmentation = np.array(Image.open(masks_path), dtype=np.uint8)
-
+        segmentation = np.array(Image.open(os.path.join(self.annotation_dir, masks_file)), dtype=np.uint8)
         segmentation_id = rgb2id(segmentation)
 
-        thing_masks = []
-        thing_class_ids = []
-        stuff_masks = []
-        stuff_class_ids = []
-        influence_masks = []
-        influence_class_ids = []
-        for segment_info_id in annotations:
-            segment_info = annotations[segment_info_id]
-            category_id = segment_info['category_id']
-            # find the class_id if we know the category_id
-            class_id = 0
-            for key in self.class_info:
-                if self.class_info[key]['category_id'] == category_id:
-                    class_id = self.class_info[key]['class_id']
-            # class_id = self.category_info[str(category_id)]['idx']
-            id = segment_info['id']
-            islabel = segment_info['labeled']
-            iscrowd = segment_info['iscrowd']
-            isthing = self.class_info[str(class_id)]['isthing']
-            mask = (segmentation_id == segment_info['id'])
-            if isthing:
-                if iscrowd:
-                    thing_class_ids.append(-1 * class_id)
-                else:
-                    thing_class_ids.append(class_id)
-                thing_masks.append(mask)
+        segment_infos = [annotations[segment_info_id] for segment_info_id in annotations]
+        segment_ids = np.array([segment_info['id'] for segment_info in segment_infos], dtype=segmentation_id.dtype)
+        class_ids = self.category_class_lut[[segment_info['category_id'] for segment_info in segment_infos]] \
+            if segment_infos else np.empty([0], np.int32)
+
+        # Label every pixel with the index of its segment in one sorted lookup
+        label_map = np.zeros(segmentation_id.shape, dtype=np.int32)
+        if segment_infos:
+            order = np.argsort(segment_ids)
+            sorted_ids = segment_ids[order]
+            position = np.minimum(np.searchsorted(sorted_ids, segmentation_id), sorted_ids.shape[0] - 1)
+            found = sorted_ids[position] == segmentation_id
+            label_map[found] = order[position[found]] + 1
+
+        semantic_label = np.concatenate([[0], class_ids]).astype(np.uint8)[label_map]
+
+        def masks_of(indices, mask_class_ids):
+            if len(indices) == 0:
+                return np.empty([0, 0, 0]), np.empty([0], np.int32)
+            masks = label_map[:, :, np.newaxis] == (np.array(indices) + 1)[np.newaxis, np.newaxis, :]
+            return masks, np.array(mask_class_ids, dtype=np.int32)
+
+        thing_indices, thing_class_ids = [], []
+        stuff_indices, stuff_class_ids = [], []
+        influence_indices, influence_class_ids = [], []
+        for i, segment_info in enumerate(segment_infos):
+            class_id = int(class_ids[i])
+            if self.class_info[str(class_id)]['isthing']:
+                thing_indices.append(i)
+                thing_class_ids.append(-1 * class_id if segment_info['iscrowd'] else class_id)
             else:
+                stuff_indices.append(i)
                 stuff_class_ids.append(class_id)
-                stuff_masks.append(mask)
-            if islabel:
+            if segment_info['labeled']:
+                influence_indices.append(i)
                 influence_class_ids.append(class_id)
-                influence_masks.append(mask)
-
-        if thing_class_ids:
-            thing_masks = np.stack(thing_masks, axis=2)
-            thing_class_ids = np.array(thing_class_ids, dtype=np.int32)
-        else:
-            thing_masks = np.empty([0, 0, 0])
-            thing_class_ids = np.empty([0], np.int32)
-        if stuff_class_ids:
-            stuff_masks = np.stack(stuff_masks, axis=2)
-            stuff_class_ids = np.array(stuff_class_ids, dtype=np.int32)
-        else:
-            stuff_masks = np.empty([0, 0, 0])
-            stuff_class_ids = np.empty([0], np.int32)
-        if influence_class_ids:
-            influence_masks = np.stack(influence_masks, axis=2)
-            influence_class_ids = np.array(influence_class_ids, dtype=np.int32)
-        else:
-            influence_masks = np.empty([0, 0, 0])
-            influence_class_ids = np.empty([0], np.int32)
-
-        # print(thing_masks.shape)
-        # print(stuff_masks.shape)
-        # print(influence_masks.shape)
 
+        thing_masks, thing_class_ids = masks_of(thing_indices, thing_class_ids)
+        stuff_masks, stuff_class_ids = masks_of(stuff_indices, stuff_class_ids)
+        influence_masks, influence_class_ids = masks_of(influence_indices, influence_class_ids)
+        return thing_masks, thing_class_ids, stuff_masks, stuff_class_ids, influence_masks, influence_class_ids, \
+               semantic_label, segmentation
+
+    def load_mask(self, image_id, type="thing"):
+        thing_masks, thing_class_ids, stuff_masks, stuff_class_ids, influence_masks, influence_class_ids, \
+        semantic_label, segmentation = self.load_gt(image_id)
         return thing_masks, thing_class_ids, stuff_masks, stuff_class_ids, influence_masks, influence_class_ids
 
 
@@ -527,14 +645,7 @@ if __name__ == '__main__':
     # print("dataset_train", dataset_train.num_images)
     # print("train_set", train_set.__len__())
     #
-    def my_collate_fn(batch):
-        batch = list(filter(lambda x: x is not None, batch))
-        if len(batch) == 0:
-            print("No valid data!!!")
-            batch = [[torch.from_numpy(np.zeros([1, 1]))]]
-        return default_collate(batch)
-
-    val_generator = TorchDataLoader(val_set, collate_fn=my_collate_fn, batch_size=1, shuffle=True, num_workers=1)
+    val_generator = build_data_loader(val_set, config)
     step = 0
     for inputs in val_generator:
         if len(inputs) != 17:
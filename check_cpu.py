@@ -0,0 +1,178 @@
+import os
+
+# A CPU-only machine: any .cuda() call left on the inference path fails
+os.environ["CUDA_VISIBLE_DEVICES"] = ""
+
+import sys
+import time
+import types
+import importlib
+import numpy as np
+import torch
+
+
+def cpu_nms(keep, num_out, boxes, order, areas, thresh):
+    """numpy port of cpu_nms in nms/src/nms.c"""
+    boxes, order, areas = boxes.numpy(), order.numpy(), areas.numpy()
+    suppressed = np.zeros(boxes.shape[0], dtype=bool)
+    count = 0
+    for _i, i in enumerate(order):
+        if suppressed[i]:
+            continue
+        keep[count] = int(i)
+        count += 1
+        rest = order[_i + 1:]
+        xx1 = np.maximum(boxes[i, 0], boxes[rest, 0])
+        yy1 = np.maximum(boxes[i, 1], boxes[rest, 1])
+        xx2 = np.minimum(boxes[i, 2], boxes[rest, 2])
+        yy2 = np.minimum(boxes[i, 3], boxes[rest, 3])
+        inter = np.maximum(0.0, xx2 - xx1 + 1) * np.maximum(0.0, yy2 - yy1 + 1)
+        suppressed[rest[inter / (areas[i] + areas[rest] - inter) >= thresh]] = True
+    num_out[0] = count
+    return 1
+
+
+def crop_and_resize_forward(image, boxes, box_index, extrapolation_value, crop_height, crop_width, crops):
+    """numpy port of crop_and_resize_forward in
+    roialign/roi_align/src/crop_and_resize.c"""
+    image, boxes, box_index = image.numpy(), boxes.numpy(), box_index.numpy()
+    _, depth, image_height, image_width = image.shape
+    output = np.zeros((boxes.shape[0], depth, crop_height, crop_width), dtype=np.float32)
+
+    def coordinates(low, high, size, crop_size):
+        if crop_size > 1:
+            scale = (high - low) * (size - 1) / (crop_size - 1)
+            inside = low * (size - 1) + np.arange(crop_size, dtype=np.float32) * scale
+        else:
+            inside = np.array([0.5 * (low + high) * (size - 1)], dtype=np.float32)
+        valid = (inside >= 0) & (inside <= size - 1)
+        inside = np.clip(inside, 0, size - 1)
+        return np.floor(inside).astype(int), np.ceil(inside).astype(int), inside - np.floor(inside), valid
+
+    for b, (y1, x1, y2, x2) in enumerate(boxes):
+        top, bottom, y_lerp, valid_y = coordinates(y1, y2, image_height, crop_height)
+        left, right, x_lerp, valid_x = coordinates(x1, x2, image_width, crop_width)
+        channels = image[box_index[b]]
+        top_values = channels[:, top][:, :, left] + (channels[:, top][:, :, right] - channels[:, top][:, :, left]) * x_lerp
+        bottom_values = channels[:, bottom][:, :, left] + (channels[:, bottom][:, :, right] - channels[:, bottom][:, :, left]) * x_lerp
+        output[b] = top_values + (bottom_values - top_values) * y_lerp[:, None]
+        output[b][:, ~valid_y] = extrapolation_value
+        output[b][:, :, ~valid_x] = extrapolation_value
+    crops.resize_(output.shape).copy_(torch.from_numpy(output))
+
+
+def load_kernels():
+    """The nms and crop_and_resize kernels are torch 0.4 ffi extensions.
+    Where they cannot be loaded (torch.utils.ffi is gone since torch 1.0),
+    the numpy ports above stand in for their CPU functions, so the rest of
+    the inference path still runs unchanged.
+
+    Returns: the names of the kernels replaced by a port.
+    """
+    ports = {"nms._ext.nms": {"cpu_nms": cpu_nms},
+             "roialign.roi_align._ext.crop_and_resize": {"crop_and_resize_forward": crop_and_resize_forward}}
+    replaced = []
+    for name, functions in ports.items():
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            module = types.ModuleType(name)
+            for function_name, function in functions.items():
+                setattr(module, function_name, function)
+            package, _, attribute = name.rpartition(".")
+            sys.modules[name] = module
+            setattr(importlib.import_module(package), attribute, module)
+            replaced.append(name)
+    return replaced
+
+
+REPLACED_KERNELS = load_kernels()
+
+from config import Config
+from CIN import CIN
+
+import argparse
+import skimage.io
+
+
+class CINConfig(Config):
+    NAME = "ooi"
+    GPU_COUNT = 0
+    IMAGES_PER_GPU = 1
+    NUM_CLASSES = 1+133
+    THING_NUM_CLASSES = 1+80
+    STUFF_NUM_CLASSES = 1+53
+    # The weights are random: keep every detection and every stuff class,
+    # so the selection stages get instances to score
+    DETECTION_MIN_CONFIDENCE = 0
+    STUFF_THRESHOLD = 0
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Runs CIN.detect for every limit on the CPU with random weights")
+    parser.add_argument("--img", type=str,
+                        default=None,
+                        help="the image to detect, a random 480x640 image by default")
+    parser.add_argument("--seed", type=int,
+                        default=0,
+                        help="the seed of the random weights and image")
+    return parser
+
+
+def check_detection(result, image_shape):
+    assert result['semantic_segment'].shape == image_shape[:2], result['semantic_segment'].shape
+    for kind in ['thing', 'stuff']:
+        if kind + '_class_ids' in result:
+            masks = result[kind + '_masks']
+            assert len(masks) == len(result[kind + '_class_ids']) == len(result[kind + '_boxes'])
+            for mask in masks:
+                assert mask.shape == image_shape[:2], mask.shape
+
+
+def check_selection(result, image_shape):
+    CIRNN_pred_dict, ioid_result, segments_info, id_map, prediction_list, instance_list = result
+    assert len(segments_info) > 0, "no instances to select from"
+    assert len(prediction_list) == len(instance_list) == len(segments_info)
+    assert set(CIRNN_pred_dict) <= set(segments_info)
+    assert ioid_result.shape == image_shape and id_map.shape == image_shape[:2]
+
+
+def run(config, image, seed):
+    torch.manual_seed(seed)
+    model = CIN(config=config, model_dir="logs")
+    assert not any(param.is_cuda for param in model.parameters())
+    image_shape = image.shape
+
+    for limit in ["instance", "p_interest", "insttr", "selection", "all"]:
+        start = time.time()
+        results = model.detect([image], limit=limit)
+        assert len(results) == 1
+        result = results[0]
+        if limit in ["instance", "insttr"]:
+            check_detection(result, image_shape)
+        if limit in ["p_interest", "insttr"]:
+            assert result['influence_map'].shape[:2] == image_shape[:2], result['influence_map'].shape
+        if limit == "selection":
+            check_selection(result, image_shape)
+        if limit == "all":
+            check_detection(result, image_shape)
+            assert result['influence_map'].shape[:2] == image_shape[:2], result['influence_map'].shape
+            segments_info = result['segments_info']
+            assert len(segments_info) > 0, "no instances to select from"
+            assert len(result['prediction_list']) == len(result['instance_list']) == len(segments_info)
+            assert set(result['selection']) <= set(segments_info)
+            for name in ['semantic_result', 'panoptic_result', 'ioid_result']:
+                assert result[name].shape == image_shape, (name, result[name].shape)
+        print("{}: ok, {:.1f}s".format(limit, time.time() - start))
+
+
+if __name__ == '__main__':
+    args = get_parser().parse_args()
+    print("torch {}, kernels replaced by numpy ports: {}".format(torch.__version__, ", ".join(REPLACED_KERNELS) or "none"))
+    if args.img:
+        image = skimage.io.imread(args.img)
+        if len(image.shape) == 2:
+            image = np.stack([image, image, image], axis=2)
+    else:
+        image = np.random.RandomState(args.seed).randint(0, 256, (480, 640, 3)).astype(np.uint8)
+    run(CINConfig(), image, args.seed)
@@ -12,9 +12,10 @@ from matplotlib import pyplot as plt
 import config
 from config import Config
 from DatasetLib import OOIDataset,Dataset
-from ioi_selection.CIEDN import CIEDN
+from ioi_selection.CIEDN import CIEDN, pad_instance_groups
 from compute_metric import compare_mask
 from utils.utils import rgb2id
+from utils.pytorch_utils import get_device
 from middle_process import generate_images_dict
 import ioi_selection_binary
 from ioi_selection_rnn import LSTM_V
@@ -74,14 +75,37 @@ class CIN(nn.Module):
 
 def predict(config, panoptic_train_model, saliency_train_model, selection_train_model, panoptic_model, saliency_model, selection_model):
     # log_file="logs/CIN_ooi_100_selection.pth"
-    ciedn = CIN().cuda()
-    state_dict = torch.load(config.WEIGHT_PATH)
+    ciedn = CIN()
+    if config.GPU_COUNT:
+        ciedn = ciedn.cuda()
+    state_dict = torch.load(config.WEIGHT_PATH, map_location=get_device(config))
     ciedn.load_state_dict(state_dict, strict=False)
 
     images = json.load(open("results/ioi_"+panoptic_model+".json", 'r'))
     class_dict=json.load(open("data/class_dict.json", 'r'))
     prediction_list = []
     gt_list = []
+
+    # CIEDN scores several images per forward, see SELECTION_BATCH_IMAGES
+    pending = []
+    def score_pending():
+        if len(pending) == 0:
+            return
+        instance_groups, lengths = pad_instance_groups([groups for groups, _ in pending])
+        with torch.no_grad():
+            instance_groups = Variable(FloatTensor(instance_groups)).float()
+            if config.GPU_COUNT:
+                instance_groups = instance_groups.cuda()
+                scores = ciedn.ciedn.score_batch(instance_groups, lengths,
+                                                  folded=config.SELECTION_FOLD_DECODER).data.cpu().numpy()
+            else:
+                scores = ciedn.ciedn.score_batch(instance_groups, lengths,
+                                                  folded=config.SELECTION_FOLD_DECODER).data.numpy()
+        for b, (_, labels) in enumerate(pending):
+            prediction_list.extend(scores[b, :lengths[b]])
+            gt_list.extend(labels)
+        del pending[:]
+
     count=0
     for image_id in images:
         count+=1
@@ -161,18 +185,10 @@ def predict(config, panoptic_train_model, saliency_train_model, selection_train_
         instance_groups = np.stack(instance_groups)
         labels = np.array(labels, dtype=np.float32)
 
-        instance_groups = Variable(FloatTensor(instance_groups)).float().cuda().unsqueeze(0)
-        boxes = Variable(FloatTensor(boxes)).float().cuda().unsqueeze(0)
-        if config.GPU_COUNT:
-            predictions = ciedn(instance_groups).squeeze(1).data.cpu().numpy()
-        else:
-            predictions = ciedn(instance_groups).squeeze(1).data.numpy()
-
-        num = instance_groups.shape[1]
-        for i in range(0, num):
-            avg = np.sum(predictions[i * num:(i + 1) * num]) / num
-            prediction_list.append(avg)
-        gt_list.extend(labels)
+        pending.append((instance_groups, labels))
+        if len(pending) >= config.SELECTION_BATCH_IMAGES:
+            score_pending()
+    score_pending()
 
     prediction_list = np.array(prediction_list)
     gt_list = np.array(gt_list)
@@ -36,6 +36,8 @@ class Config(object):
     # handle 2 images of 1024x1024px.
     # Adjust based on your GPU memory and image sizes. Use the highest
     # number that your GPU can handle for best performance.
+    # The semantic and p_interest stages train on padded batches of this
+    # many images, the other stages still run one image at a time.
     IMAGES_PER_GPU = 1
 
     # Number of training steps per epoch
@@ -52,6 +54,46 @@ class Config(object):
     # down the training.
     VALIDATION_STEPS = 50
 
+    # If set, the semantic, p_interest and selection stages, which keep the
+    # backbone frozen, precompute its outputs once into this directory (fp16
+    # memory-mapped shards, see utils/feature_cache.py) and train from them.
+    # The cache holds the unflipped images, so flip augmentation is disabled.
+    FEATURE_CACHE_DIR = None
+
+    # If set, the datasets read the resized images, masks, boxes and semantic
+    # labels from the sample cache that preprocess.py writes into
+    # SAMPLE_CACHE_DIR/<subset>, and only flip and build the RPN targets online.
+    SAMPLE_CACHE_DIR = None
+    SAMPLE_CACHE_SHARD_IMAGES = 500
+
+    # Number of worker processes that decode the images and build the
+    # targets while the model trains (0 loads on the training thread, as
+    # before), and the number of batches each worker loads ahead. Workers
+    # need a dataset that pickles; e.g. 4 overlaps loading with training.
+    # The prefetch depth is only honoured by torch versions whose DataLoader
+    # has prefetch_factor.
+    DATA_LOADER_WORKERS = 0
+    DATA_LOADER_PREFETCH = 2
+
+    # predict.py (every mode) decodes the images and writes the results in
+    # thread pools around the model (see utils/pipeline.py). The queues
+    # between the stages hold PREDICT_QUEUE_SIZE entries, and the model
+    # takes up to PREDICT_BATCH_IMAGES decoded images per detect() call.
+    # validate.py --mode ioi detects PREDICT_BATCH_IMAGES images at a time.
+    PREDICT_DECODE_WORKERS = 4
+    PREDICT_WRITE_WORKERS = 4
+    PREDICT_QUEUE_SIZE = 8
+    PREDICT_BATCH_IMAGES = 1
+
+    # CPU inference (GPU_COUNT = 0). The intra-op and inter-op thread counts
+    # of torch (None keeps the torch defaults), and whether denormal floats
+    # are flushed to zero, which avoids slow paths in the small activations
+    # of the LSTM and attention layers. With predict.py --num_shards the
+    # CPU_THREADS are shared between the shard processes.
+    CPU_THREADS = None
+    CPU_INTEROP_THREADS = None
+    CPU_FLUSH_DENORMAL = True
+
     # The strides of each layer of the FPN Pyramid. These values
     # are based on a Resnet101 backbone.
     BACKBONE_STRIDES = [4, 8, 16, 32, 64]
@@ -119,6 +161,10 @@ class Config(object):
 
     # Bounding box refinement standard deviation for RPN and final detections.
     RPN_BBOX_STD_DEV = np.array([0.1, 0.1, 0.2, 0.2])
+
+    # Number of IoUs computed at once when matching the anchors to the GT
+    # boxes in build_rpn_targets (bounds its memory, not its result)
+    RPN_OVERLAP_CHUNK = 2 ** 22
     BBOX_STD_DEV = np.array([0.1, 0.1, 0.2, 0.2])
 
     # Max number of final detections
@@ -151,6 +197,46 @@ class Config(object):
     # The threshold when selecting IOIs
     SELECTION_THRESHOLD = 0.45 # according to STUFF_THRESHOLD
 
+    # If enabled, the CIEDN decoder is folded into a single affine map when
+    # the weights are loaded, and each instance is scored in O(n) instead of
+    # building all n^2 pairs. The scores match the pairwise ones up to float
+    # rounding.
+    SELECTION_FOLD_DECODER = False
+
+    # Maximum number of instance pairs the CIEDN decoder scores in one call.
+    # Larger images are decoded in blocks of rows so memory stays flat.
+    # None decodes all n^2 pairs at once.
+    SELECTION_MAX_PAIRS = None
+
+    # If set, each instance is paired with this many partners only instead of
+    # all n instances, which bounds the selection cost at O(n*k) on crowded
+    # images. None keeps the exact average over all partners.
+    SELECTION_PARTNERS = None
+    # How the partners are picked: "topk" takes the most salient instances,
+    # "stratified" draws one instance per saliency stratum using the seed
+    SELECTION_PARTNER_MODE = "topk"
+    SELECTION_PARTNER_SEED = 0
+
+    # If enabled, instances are first decided by the overlap of their mask
+    # with the top quartile of the saliency map: overlap <= LOW is rejected
+    # (score 0), overlap >= HIGH is selected (score 1), and only the instances
+    # in between are scored by CIEDN, among themselves.
+    SELECTION_CASCADE = False
+    SELECTION_CASCADE_LOW = 0.1
+    SELECTION_CASCADE_HIGH = 0.9
+
+    # If set, the selection stage packs its CIEDN samples (instance groups
+    # and labels) into this directory once and trains CIEDN from there on
+    # mini-batches of SELECTION_TRAIN_IMAGES images (see ioi_selection/corpus.py)
+    SELECTION_CORPUS_DIR = None
+    SELECTION_CORPUS_SHARD_IMAGES = 1000
+    SELECTION_TRAIN_IMAGES = 32
+
+    # Number of images whose instances are scored by CIEDN in one batched
+    # forward, when re-scoring offline and in the selection of the images of
+    # one detect() call (see CIEDN.score_batch)
+    SELECTION_BATCH_IMAGES = 16
+
     IMAGE_PATH = "../data/"
 
     JSON_PATH = "data/"
@@ -165,6 +251,15 @@ class Config(object):
 
     STUFF_THRESHOLD = 500 # cannot remember the original setting
 
+    # At inference, upsample only the background and stuff channels of the
+    # semantic head and a bound of the thing channels (54 + 1 of 134). The
+    # labels always equal the full argmax: an image where the bound of the
+    # thing channels is not below the best stuff logit on some pixel is
+    # upsampled again with all channels, which is slower than the full head.
+    # Only worth it when the thing channels never come close, see
+    # python -m instance_extraction.FPN_heads.
+    SEMANTIC_STUFF_ONLY = False
+
     THING_NUM_CLASSES = 1+80
 
     STUGG_NUM_CLASSES = 53
@@ -11,6 +11,7 @@ from config import Config
 from CIN import CIN
 from utils import visualize
 from utils.Dict2Obj import Dict2Obj
+from utils.pytorch_utils import get_device
 
 import torch
 
@@ -68,7 +69,7 @@ if config.GPU_COUNT:
     model = model.cuda()
 
 # Load weights
-state_dict = torch.load(config.WEIGHT_PATH)
+state_dict = torch.load(config.WEIGHT_PATH, map_location=get_device(config))
 model.load_state_dict(state_dict, strict=False)
 
 
@@ -103,14 +104,14 @@ image = skimage.io.imread(image_path)
 if len(image.shape) == 2:
     image = np.stack([image, image, image], axis=2)
 # Run detection
-results = model.detect([image], limit='selection')
+results = model.detect([image], limit='selection')[0]
 segments_info = results[0]
 boxes = []
 masks = []
 class_ids = []
 for key in segments_info:
     boxes.append(segments_info[key]['bbox'])
-    masks.append(segments_info[key]['mask'])
+    masks.append(segments_info[key]['mask'].to_full())
     class_name = segments_info[key]['category_name']
     class_id = class_names.index(class_name)
     class_ids.append(class_id)
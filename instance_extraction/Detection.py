@@ -1,13 +1,14 @@
 import numpy as np
+import scipy.ndimage
 
 import torch
+import torch.nn.functional as F
 from torch.autograd import Variable
 
 from instance_extraction.Proposal import apply_box_deltas
 from nms.nms_wrapper import nms
 from utils.pytorch_utils import unique1d,intersect1d
 from utils.formatting_utils import parse_image_meta
-from utils.utils import extract_bboxes
 
 
 ############################################################
@@ -85,7 +86,7 @@ def refine_detections(rois, probs, deltas, window, config):
     if len(keep.shape)>1:  # change 0 to 1
         keep = keep[:,0]
     else:
-        return Variable(torch.FloatTensor()).cuda()
+        return Variable(refined_rois.data.new())
 
     # Apply per-class NMS
     pre_nms_class_ids = class_ids[keep.data]
@@ -144,40 +145,68 @@ def detection_layer(config, rois, mrcnn_class, mrcnn_bbox, image_meta):
     return detections
 
 
-def generate_stuff(config, semantic_segmentation):
-    # [batch, num_detections, (y1, x1, y2, x2)]
-    # [batch, num_detections, h, w]
+def semantic_labels(semantic_segmentation, with_scores=False):
+    """Reduces the semantic logits [batch, num_classes, h, w] to the label
+    map [batch, h, w] (uint8) on their device, so only the labels need to be
+    copied to the host. If with_scores, also returns the probability of the
+    label [batch, h, w], the softmax of the max logit.
+    """
+    logits = semantic_segmentation.data
+    max_logits, labels = logits.max(1)
+    labels = labels.byte()  # fewer than 256 classes
+    if with_scores:
+        scores = 1.0 / torch.exp(logits - max_logits.unsqueeze(1)).sum(1)
+        return labels, scores
+    return labels
+
+def subset_semantic_labels(semantic_segmentation, classes, size=(500, 500)):
+    """semantic_labels() of the logits [batch, num_classes, h, w] bilinearly
+    upsampled to size, upsampling only the channels of classes and one
+    channel with the max of the other channels.
+
+    Upsampling is a weighted mean with non-negative weights, so the upsampled
+    max bounds every upsampled channel it covers. The labels of the pixels
+    where a channel of classes beats the bound are those of the full argmax.
+    An image with any other pixel is upsampled with all channels, so the
+    result always equals semantic_labels(F.upsample(semantic_segmentation)).
+    """
+    logits = semantic_segmentation.data
+    others = [c for c in range(logits.size(1)) if c not in classes]
+    subset = logits.index_select(1, logits.new_tensor(classes, dtype=torch.long))
+    bound = logits.index_select(1, logits.new_tensor(others, dtype=torch.long)).max(1, keepdim=True)[0]
+    upsampled = F.upsample(torch.cat([subset, bound], dim=1), size=size, mode='bilinear')
+    max_logits, labels = upsampled[:, :-1].max(1)
+    labels = logits.new_tensor(classes, dtype=torch.long)[labels].byte()
+    exact = (max_logits > upsampled[:, -1]).view(labels.size(0), -1).min(1)[0]
+    for i in range(labels.size(0)):
+        if not exact[i]:
+            labels[i] = semantic_labels(F.upsample(logits[i:i + 1], size=size, mode='bilinear'))[0]
+    return labels
+
+def generate_stuff(config, semantic_label):
+    """semantic_label: [1, h, w] label map of semantic_labels()
+
+    Returns: the label map [h, w] as numpy and the stuff detections
+    [y, (y1, x1, y2, x2, class_id)] of the stuff classes with more than
+    STUFF_THRESHOLD pixels. The masks are not built here, they are cut from
+    the label map by filter_stuff_masks.
+    """
     if config.GPU_COUNT:
-        segments = semantic_segmentation.squeeze(0).data.cpu().numpy()
-    else:
-        segments = semantic_segmentation.squeeze(0).data.numpy()
-
-    pred = np.argmax(segments, axis=0)
-
-    results=[]
-    masks=[]
-    for i in range(config.THING_NUM_CLASSES,config.THING_NUM_CLASSES+config.STUFF_NUM_CLASSES):
-        mask = (pred == i)
-        mask=np.where(mask,1,0)
-        count=np.sum(mask)
-        # if count>5000:
-        if count>config.STUFF_THRESHOLD:
-            mask=mask.reshape(1,mask.shape[0],mask.shape[1])
-            reshaped_mask = mask.transpose(1,2,0)
-            bbox=extract_bboxes(reshaped_mask) # 1,4
-
-            r=np.array([[i]],dtype=np.float32) # 1,1
-            r=np.concatenate((bbox,r),axis=1) # 1,5
-            results.append(r)
-            # plt.figure()
-            # plt.imshow(mask[0])
-            # plt.show()
-            masks.append(mask) # (1,500,500)
-
-    if len(results) > 0 and len(masks) > 0:
-        results=Variable(torch.from_numpy(np.concatenate(results)).float())
-        masks=Variable(torch.from_numpy(np.concatenate(masks)))
+        pred = semantic_label.squeeze(0).cpu().numpy()
     else:
-        results=Variable(torch.from_numpy(np.array(results)).float())
-        masks=Variable(torch.from_numpy(np.array(masks)).float())
-    return pred,results,masks
\ No newline at end of file
+        pred = semantic_label.squeeze(0).numpy()
+
+    # One pass over the label map for the areas and one for the boxes
+    first = config.THING_NUM_CLASSES
+    last = config.THING_NUM_CLASSES + config.STUFF_NUM_CLASSES
+    counts = np.bincount(pred.ravel(), minlength=last)
+    class_ids = first + np.where(counts[first:last] > config.STUFF_THRESHOLD)[0]
+    slices = scipy.ndimage.find_objects(pred, max_label=last)
+
+    results = np.zeros([len(class_ids), 5], dtype=np.float32)
+    for i, class_id in enumerate(class_ids):
+        y, x = slices[class_id - 1]
+        results[i] = [y.start, x.start, y.stop, x.stop, class_id]
+    if len(class_ids) == 0:
+        results = np.array([], dtype=np.float32)
+    return pred, Variable(torch.from_numpy(results))
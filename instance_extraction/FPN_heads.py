@@ -102,7 +102,9 @@ class Semantic(nn.Module):
         self.gn2 = GroupNorm(256,256)
 
 
-    def forward(self, mrcnn_feature_maps):
+    def forward(self, mrcnn_feature_maps, upsample=True):
+        """upsample: if False, return the logits before the upsampling to
+        500x500, at the size of p2 (see subset_semantic_labels)."""
         p2_out = mrcnn_feature_maps[0] #256
         p3_out = mrcnn_feature_maps[1] #128
         p4_out = mrcnn_feature_maps[2] #64
@@ -127,5 +129,42 @@ class Semantic(nn.Module):
 
         # 256, 256->256, 128
         s2 = F.relu(self.gn1(self.semantic_branch(p2_out)))
-        return F.upsample(self.conv3(s2 + s3 + s4 + s5), size=(500, 500),mode='bilinear') # 500
-
+        s = self.conv3(s2 + s3 + s4 + s5)
+        if not upsample:
+            return s # 256
+        return F.upsample(s, size=(500, 500),mode='bilinear') # 500
+
+
+if __name__ == '__main__':
+    # The labels of SEMANTIC_STUFF_ONLY (background and stuff channels plus
+    # the bound of the thing channels) against the full 134 channel argmax,
+    # with random weights and features. The thing logits are shifted down
+    # further and further, from thing channels that win on many pixels (the
+    # images fall back to all channels) to thing channels that never win.
+    import time
+    import torch
+    from torch.autograd import Variable
+    from instance_extraction.Detection import semantic_labels, subset_semantic_labels
+
+    torch.manual_seed(0)
+    semantic = Semantic(134)
+    semantic.eval()
+    classes = [0] + list(range(81, 134))
+    feature_maps = [Variable(torch.randn(2, 256, size, size)) for size in [256, 128, 64, 32]]
+    with torch.no_grad():
+        logits = semantic(feature_maps, upsample=False)
+        assert torch.equal(semantic(feature_maps), F.upsample(logits, size=(500, 500), mode='bilinear'))
+        for shift in [0.0, 0.5, 1.0, 2.0, 10.0]:
+            shifted = logits.clone()
+            shifted[:, 1:81] -= shift
+
+            start = time.time()
+            full = semantic_labels(F.upsample(shifted, size=(500, 500), mode='bilinear'))
+            full_time = time.time() - start
+            start = time.time()
+            subset = subset_semantic_labels(shifted, classes)
+            subset_time = time.time() - start
+
+            assert torch.equal(full, subset), shift
+            print("thing logits -{}: equal, thing pixels {}, full {:.3f}s, stuff only {:.3f}s".format(
+                shift, int(((full > 0) & (full < 81)).sum()), full_time, subset_time))
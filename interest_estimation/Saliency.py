@@ -134,22 +134,36 @@ class Renet(nn.Module):
 
     def forward(self, *input):
         x = input[0]
-        temp = []
-        # size = x.size()  # batch, in_channel, height, width
-        x = torch.transpose(x, 1, 3)  # batch, width, height, in_channel
-        for i in range(self.size):
-            h, _ = self.vertical(x[:, :, i, :])
-            temp.append(h)  # batch, width, 512
-        x = torch.stack(temp, dim=2)  # batch, width, height, 512
-        temp = []
-        for i in range(self.size):
-            h, _ = self.horizontal(x[:, i, :, :])
-            temp.append(h)  # batch, width, 512
-        x = torch.stack(temp, dim=3)  # batch, height, 512, width
-        x = torch.transpose(x, 1, 2)  # batch, 512, height, width
+        # The rows (and then the columns) are independent sequences, so they
+        # are folded into the batch and each LSTM runs once
+        batch, _, height, width = x.size()  # batch, in_channel, height, width
+        x = x.permute(0, 2, 3, 1).contiguous()  # batch, height, width, in_channel
+        x, _ = self.vertical(x.view(batch * height, width, self.in_channel))  # each row
+        x = x.view(batch, height, width, 512)
+        x = x.transpose(1, 2).contiguous()  # batch, width, height, 512
+        x, _ = self.horizontal(x.view(batch * width, height, 512))  # each column
+        x = x.view(batch, width, height, 512)
+        x = x.permute(0, 3, 2, 1)  # batch, 512, height, width
         x = self.conv(x)
         return x
 
+def renet_reference(renet, x):
+    """The former Renet.forward, one LSTM call per row and per column, kept
+    as the reference of the parity check below."""
+    temp = []
+    x = torch.transpose(x, 1, 3)  # batch, width, height, in_channel
+    for i in range(renet.size):
+        h, _ = renet.vertical(x[:, :, i, :])
+        temp.append(h)  # batch, width, 512
+    x = torch.stack(temp, dim=2)  # batch, width, height, 512
+    temp = []
+    for i in range(renet.size):
+        h, _ = renet.horizontal(x[:, i, :, :])
+        temp.append(h)  # batch, width, 512
+    x = torch.stack(temp, dim=3)  # batch, height, 512, width
+    x = torch.transpose(x, 1, 2)  # batch, 512, height, width
+    return renet.conv(x)
+
 class SaNet(nn.Module):
     def __init__(self):
         super(SaNet,self).__init__()
@@ -187,3 +201,62 @@ class SaNet(nn.Module):
             # print(_pred.shape)
             pred.append(_pred)
         return pred
+
+
+if __name__ == '__main__':
+    # python -m interest_estimation.Saliency
+    # Parity of Renet with its loop reference, then the latency of SaNet and
+    # of the p_interest forward (ResNet101 + SaNet on a 1024x1024 image,
+    # random weights) against the loop references of Renet and unfold
+    import time
+    from backbone.ResNet import ResNet
+    from utils.pytorch_utils import unfold_reference
+
+    torch.manual_seed(0)
+    resnet = ResNet("resnet101", stage5=True).eval()
+    sanet = SaNet().eval()
+    images = torch.randn(1, 3, 1024, 1024)
+    if torch.cuda.is_available():
+        resnet, sanet, images = resnet.cuda(), sanet.cuda(), images.cuda()
+
+    with torch.no_grad():
+        for batch, channels, size in [(1, 64, 16), (2, 32, 8), (1, 1024, 64)]:
+            renet = Renet(size, channels, 22 * 22).eval()
+            x = torch.randn(batch, channels, size, size)
+            assert torch.equal(renet(x), renet_reference(renet, x))
+
+    def p_interest(repeat=2):
+        best = None
+        with torch.no_grad():
+            for _ in range(repeat):
+                start = time.time()
+                features = resnet(images)
+                if images.is_cuda:
+                    torch.cuda.synchronize()
+                sanet_start = time.time()
+                influence_map = sanet(*features)[4]
+                if images.is_cuda:
+                    torch.cuda.synchronize()
+                sanet_elapsed = time.time() - sanet_start
+                if images.is_cuda:
+                    torch.cuda.synchronize()
+                elapsed = time.time() - start
+                if best is None or elapsed < best[0]:
+                    best = (elapsed, sanet_elapsed)
+        return influence_map, best
+
+    fast_unfold = unfold
+    fast_renet = Renet.forward
+    outputs = {}
+    for name, unfold_function, renet_forward in [
+            ("loop unfold, loop Renet", unfold_reference, lambda self, *input: renet_reference(self, input[0])),
+            ("unfold, loop Renet", fast_unfold, lambda self, *input: renet_reference(self, input[0])),
+            ("unfold, Renet", fast_unfold, fast_renet)]:
+        unfold = unfold_function  # the global PicanetG and PicanetL call
+        Renet.forward = renet_forward
+        outputs[name], (elapsed, sanet_elapsed) = p_interest()
+        print("{}: p_interest forward {:.2f}s, SaNet {:.2f}s".format(name, elapsed, sanet_elapsed))
+    unfold = fast_unfold
+    Renet.forward = fast_renet
+    for name in outputs:
+        assert torch.equal(outputs[name], outputs["unfold, Renet"])
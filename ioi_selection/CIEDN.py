@@ -28,7 +28,12 @@ class Encoder(nn.Module):
 
     def forward(self, embeddings):
         # print(embeddings.shape)
-        sa_c1_out=self.sa_conv1(embeddings[0,:,:1,:,:])
+        return self.encode(embeddings[0])
+
+    def encode(self, instance_groups):
+        """instance_groups: [t, 2, 56, 56] from one or several images"""
+        embeddings = instance_groups
+        sa_c1_out=self.sa_conv1(embeddings[:,:1,:,:])
         sa_c1_out=self.sa_ac1(sa_c1_out)
         # print(a_c1_out.data.cpu().numpy())
         sa_c2_out=self.sa_conv2(sa_c1_out)
@@ -43,7 +48,7 @@ class Encoder(nn.Module):
         sa_c4_out=sa_c3_out.view(-1,64*6*6)
         # print(sa_c4_out)
 
-        ca_c1_out=self.ca_conv1(embeddings[0,:,1:,:,:])
+        ca_c1_out=self.ca_conv1(embeddings[:,1:,:,:])
         ca_c1_out=self.ca_ac1(ca_c1_out)
         # print(a_c1_out.data.cpu().numpy())
         ca_c2_out=self.ca_conv2(ca_c1_out)
@@ -90,21 +95,297 @@ class Decoder(nn.Module):
         # print(output)
         return c7_out
 
+    def fold(self):
+        """The activations ac1/ac2/ac3 are computed but never fed forward, so
+        fc1..fc7 compose into a single affine map. Returns the equivalent
+        (weight [1, 2304*2*2], bias [1]) computed in double precision.
+        """
+        layers = [self.fc1, self.fc2, self.fc3, self.fc4, self.fc5, self.fc6, self.fc7]
+        weight = layers[0].weight.data.double()
+        bias = layers[0].bias.data.double()
+        for layer in layers[1:]:
+            bias = torch.mv(layer.weight.data.double(), bias) + layer.bias.data.double()
+            weight = torch.mm(layer.weight.data.double(), weight)
+        return weight.float(), bias.float()
+
+
+def build_pairs(a_groups, b_groups):
+    """Concatenates every row of a_groups with every row of b_groups.
+
+    a_groups: [m, d], b_groups: [n, d]
+    Returns: [m*n, 2d] where row i*n+j is cat(a_groups[i], b_groups[j]),
+    i.e. the same order as the nested loop over (i, j).
+    """
+    m, d = a_groups.size()
+    n = b_groups.size(0)
+    a_groups = a_groups.unsqueeze(1).expand(m, n, d)
+    b_groups = b_groups.unsqueeze(0).expand(m, n, d)
+    return torch.cat([a_groups, b_groups], dim=2).view(m * n, 2 * d)
+
+def iter_pair_chunks(encoder_output, max_pairs):
+    """Yields build_pairs(encoder_output, encoder_output) in blocks of whole
+    rows holding at most max_pairs pairs (at least one row per block).
+    """
+    n = encoder_output.size(0)
+    rows = max(1, max_pairs // n)
+    for start in range(0, n, rows):
+        yield build_pairs(encoder_output[start:start + rows], encoder_output)
+
+
+def pad_instance_groups(instance_groups_list):
+    """Stacks the instance groups of several images into one padded array.
+
+    instance_groups_list: list of [n_b, 2, 56, 56] numpy arrays
+    Returns:
+    instance_groups: [B, N_max, 2, 56, 56] float32, zero padded
+    lengths: list of the n_b
+    """
+    lengths = [groups.shape[0] for groups in instance_groups_list]
+    num = max(lengths) if lengths else 0
+    shape = instance_groups_list[0].shape[1:] if lengths else (2, 56, 56)
+    instance_groups = np.zeros((len(lengths), num) + tuple(shape), dtype=np.float32)
+    for b, groups in enumerate(instance_groups_list):
+        instance_groups[b, :lengths[b]] = groups
+    return instance_groups, lengths
+
+
+def select_partners(saliency, k, mode="topk", seed=0):
+    """Picks the k partners every instance is paired with when the row
+    averages are approximated.
+
+    saliency: [n] mean saliency of each instance
+    mode: "topk" takes the k most salient instances, "stratified" splits the
+        instances into k strata by saliency and draws one from each.
+    Returns: [k] sorted instance indices
+    """
+    order = np.argsort(-np.asarray(saliency), kind='mergesort')
+    if mode == "topk":
+        partners = order[:k]
+    elif mode == "stratified":
+        random_state = np.random.RandomState(seed)
+        partners = np.array([random_state.choice(stratum) for stratum in np.array_split(order, k)])
+    else:
+        raise Exception("partner mode not exists: " + str(mode))
+    return np.sort(partners)
+
 
 class CIEDN(nn.Module):
-    def __init__(self,):
+    def __init__(self, max_pairs=None):
         super(CIEDN, self).__init__()
         self.encoder = Encoder()
         self.decoder =Decoder()
         self.sig=nn.Sigmoid()
 
+        # Upper bound of pairs decoded at once, None for no bound
+        self.max_pairs = max_pairs
+
+        # Folded decoder (weight_a, weight_b, bias), see fold_decoder()
+        self.folded = None
+
+    def fold_decoder(self):
+        """Collapses the decoder into one weight vector so that the score of
+        the pair (i, j) is w_a.e_i + w_b.e_j + c. Call again after the
+        decoder weights change.
+        """
+        weight, bias = self.decoder.fold()
+        half = weight.size(1) // 2
+        self.folded = (weight[0, :half], weight[0, half:], bias[0])
+        return self.folded
+
+    def clear_folded_decoder(self):
+        self.folded = None
+
+    def score_instances(self, instance_groups):
+        """Row averages of the pairwise scores in O(n).
+
+        instance_groups: [1, n, 2, 56, 56]
+        Returns: [n] where entry i equals the mean over j of forward()[i*n+j]
+        """
+        if self.folded is None:
+            self.fold_decoder()
+        encoder_output = self.encoder(instance_groups)  # [n, 2304*2]
+        weight_a, weight_b, bias = [t.type_as(encoder_output.data) for t in self.folded]
+        a_scores = torch.mv(encoder_output, Variable(weight_a))
+        b_scores = torch.mv(encoder_output, Variable(weight_b))
+        return a_scores + b_scores.mean() + bias
+
+    def score_partners(self, instance_groups, partners, folded=False):
+        """Approximate row averages from n*k pairs instead of n^2.
+
+        instance_groups: [1, n, 2, 56, 56]
+        partners: [k] LongTensor of instance indices, see select_partners()
+        Returns: [n] where entry i is the mean score of the pairs (i, p) over
+        the partners p.
+        """
+        encoder_output = self.encoder(instance_groups)  # [n, d]
+        partner_output = encoder_output.index_select(0, partners)  # [k, d]
+        if folded:
+            if self.folded is None:
+                self.fold_decoder()
+            weight_a, weight_b, bias = [t.type_as(encoder_output.data) for t in self.folded]
+            a_scores = torch.mv(encoder_output, Variable(weight_a))
+            b_scores = torch.mv(partner_output, Variable(weight_b))
+            return a_scores + b_scores.mean() + bias
+        num, k = encoder_output.size(0), partner_output.size(0)
+        pair_groups = build_pairs(encoder_output, partner_output)
+        return self.decoder(pair_groups).view(num, k).mean(1)
+
+    def score_batch(self, instance_groups, lengths, folded=False):
+        """Row averages of the pairwise scores for several images at once.
+
+        instance_groups: [B, N_max, 2, 56, 56], image b is valid in [:lengths[b]]
+        lengths: the number of instances of each image
+        folded: use the O(n) folded decoder instead of decoding all pairs
+
+        Returns: [B, N_max], entry (b, i) is the mean score of instance i
+        paired with the valid instances of image b. Padding entries are 0.
+        """
+        batch, num = instance_groups.size(0), instance_groups.size(1)
+        encoder_output = self.encoder.encode(instance_groups.view((batch * num,) + tuple(instance_groups.size()[2:])))
+        encoder_output = encoder_output.view(batch, num, -1)  # [B, N, d]
+        d = encoder_output.size(2)
+
+        # Padding mask [B, N]
+        positions = torch.arange(0, num).type_as(encoder_output.data)
+        lengths = torch.Tensor([float(length) for length in lengths]).type_as(encoder_output.data)
+        mask = Variable((positions.unsqueeze(0) < lengths.unsqueeze(1)).type_as(encoder_output.data))
+        counts = Variable(lengths.clamp(min=1))
+
+        if folded:
+            if self.folded is None:
+                self.fold_decoder()
+            weight_a, weight_b, bias = [t.type_as(encoder_output.data) for t in self.folded]
+            a_scores = torch.matmul(encoder_output, Variable(weight_a))  # [B, N]
+            b_scores = torch.matmul(encoder_output, Variable(weight_b))  # [B, N]
+            b_mean = (b_scores * mask).sum(1) / counts
+            scores = a_scores + b_mean.unsqueeze(1) + bias
+            return scores * mask
+
+        outputs = []
+        if self.max_pairs and num * num > self.max_pairs:
+            # Even one image is over the pair budget: decode each image in
+            # blocks of rows
+            for b in range(batch):
+                output = torch.cat([self.decoder(pair_groups) for pair_groups in
+                                    iter_pair_chunks(encoder_output[b], self.max_pairs)], dim=0)
+                outputs.append(output.view(1, num, num))
+        else:
+            # Decode whole images at a time, within the pair budget if any
+            images = batch
+            if self.max_pairs:
+                images = max(1, self.max_pairs // max(1, num * num))
+            for start in range(0, batch, images):
+                chunk = encoder_output[start:start + images]
+                chunk_size = chunk.size(0)
+                a_groups = chunk.unsqueeze(2).expand(chunk_size, num, num, d)
+                b_groups = chunk.unsqueeze(1).expand(chunk_size, num, num, d)
+                pair_groups = torch.cat([a_groups, b_groups], dim=3).view(-1, 2 * d)
+                outputs.append(self.decoder(pair_groups).view(chunk_size, num, num))
+        output = torch.cat(outputs, dim=0)  # [B, N, N]
+        scores = (output * mask.unsqueeze(1)).sum(2) / counts.unsqueeze(1)
+        return scores * mask
+
+    def forward_images(self, instance_groups, lengths):
+        """Pairwise scores of several images with one encoder and one decoder
+        call, for training on mini-batches of images.
+
+        instance_groups: [t, 2, 56, 56], the instances of the images one after
+            the other
+        lengths: the number of instances of each image
+        Returns: list with the [n_b*n_b] scores of each image, in the order of
+        forward() and pair_label.
+        """
+        encoder_output = self.encoder.encode(instance_groups)
+        pair_groups = []
+        start = 0
+        for length in lengths:
+            image_output = encoder_output[start:start + length]
+            pair_groups.append(build_pairs(image_output, image_output))
+            start += length
+        output = self.decoder(torch.cat(pair_groups, dim=0)).squeeze(1)
+        outputs = []
+        start = 0
+        for length in lengths:
+            outputs.append(output[start:start + length * length])
+            start += length * length
+        return outputs
+
     def forward(self, instance_groups):
         encoder_output = self.encoder(instance_groups) #[t, 2304]
-        pair_groups=[]
-        for i,a_group in enumerate(encoder_output):
-            for j,b_group in enumerate(encoder_output):
-                b_group=encoder_output[j]
-                pair_groups.append(torch.cat([a_group,b_group]))
-        pair_groups=torch.stack(pair_groups)
+        num = encoder_output.size(0)
+        if self.max_pairs and num * num > self.max_pairs:
+            outputs = [self.decoder(pair_groups) for pair_groups in iter_pair_chunks(encoder_output, self.max_pairs)]
+            return torch.cat(outputs, dim=0)
+        pair_groups = build_pairs(encoder_output, encoder_output)
         output = self.decoder(pair_groups)
         return output
+
+
+if __name__ == '__main__':
+    torch.manual_seed(0)
+    model = CIEDN()
+    for m in model.modules():
+        if isinstance(m, nn.Linear):
+            m.weight.data.normal_(0, 0.01)
+    model.eval()
+
+    # Parity check of the vectorized and chunked pair builders against the
+    # nested loop, which fixes the order pair_label is built in
+    for n in [1, 2, 7, 40]:
+        encoder_output = Variable(torch.rand(n, 16))
+        pair_groups = []
+        for i, a_group in enumerate(encoder_output):
+            for j, b_group in enumerate(encoder_output):
+                pair_groups.append(torch.cat([a_group, b_group]))
+        pair_groups = torch.stack(pair_groups).data.numpy()
+        assert np.array_equal(pair_groups, build_pairs(encoder_output, encoder_output).data.numpy())
+        for max_pairs in [1, 5, n * n]:
+            chunked = torch.cat(list(iter_pair_chunks(encoder_output, max_pairs)), dim=0).data.numpy()
+            assert np.array_equal(pair_groups, chunked)
+
+    # Parity check of chunked decoding and of the folded O(n) scorer against
+    # the pairwise decoder
+    for n in [1, 2, 7, 40]:
+        instance_groups = Variable(torch.rand(1, n, 2, 56, 56))
+        pairwise = model(instance_groups).squeeze(1).data.numpy()
+        model.max_pairs = 64
+        assert np.allclose(pairwise, model(instance_groups).squeeze(1).data.numpy(), rtol=1e-5, atol=1e-7)
+        model.max_pairs = None
+
+        expected = np.array([np.sum(pairwise[i * n:(i + 1) * n]) / n for i in range(n)])
+        folded = model.score_instances(instance_groups).data.numpy()
+        assert np.allclose(expected, folded, rtol=1e-4, atol=1e-6)
+
+    # Parity check of batched scoring against scoring image by image
+    instance_groups_list = [np.random.rand(n, 2, 56, 56).astype(np.float32) for n in [3, 1, 9, 5]]
+    padded, lengths = pad_instance_groups(instance_groups_list)
+    for folded in [False, True]:
+        # 20 pairs is below the 9*9 of the largest image, which then is
+        # decoded in blocks of rows
+        for max_pairs in [None, 100, 20]:
+            model.max_pairs = max_pairs
+            scores = model.score_batch(Variable(torch.from_numpy(padded)), lengths, folded=folded).data.numpy()
+            for b, groups in enumerate(instance_groups_list):
+                expected = model.score_instances(Variable(torch.from_numpy(groups)).unsqueeze(0)).data.numpy()
+                assert np.allclose(scores[b, :lengths[b]], expected, rtol=1e-4, atol=1e-6)
+                assert not np.any(scores[b, lengths[b]:])
+    model.max_pairs = None
+
+    # With all instances as partners the approximation is exact
+    instance_groups = Variable(torch.rand(1, 12, 2, 56, 56))
+    partners = Variable(torch.arange(0, 12).long())
+    expected = model.score_instances(instance_groups).data.numpy()
+    for folded in [False, True]:
+        approx = model.score_partners(instance_groups, partners, folded=folded).data.numpy()
+        assert np.allclose(approx, expected, rtol=1e-4, atol=1e-6)
+    saliency = instance_groups[0, :, 1].mean(2).mean(1).data.numpy()
+    assert len(select_partners(saliency, 4, "topk")) == 4
+    assert len(set(select_partners(saliency, 4, "stratified"))) == 4
+
+    # Parity check of the multi-image training forward against forward()
+    instance_groups_list = [torch.rand(n, 2, 56, 56) for n in [4, 1, 7]]
+    outputs = model.forward_images(Variable(torch.cat(instance_groups_list, dim=0)),
+                                   [groups.size(0) for groups in instance_groups_list])
+    for groups, output in zip(instance_groups_list, outputs):
+        expected = model(Variable(groups.unsqueeze(0))).squeeze(1).data.numpy()
+        assert np.allclose(output.data.numpy(), expected, rtol=1e-4, atol=1e-6)
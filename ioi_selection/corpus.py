@@ -0,0 +1,113 @@
+import os
+import json
+
+import numpy as np
+
+############################################################
+#  Packed CIEDN Training Corpus
+############################################################
+
+# construct_dataset() divides the semantic label by 134 and the saliency by
+# 255, both read from uint8 maps, so the instance groups are stored as uint8
+# and restored exactly.
+CHANNEL_SCALES = np.array([134.0, 255.0]).reshape(1, 2, 1, 1)
+
+
+def pack_instance_groups(instance_groups):
+    return np.round(instance_groups * CHANNEL_SCALES).astype(np.uint8)
+
+
+def unpack_instance_groups(packed):
+    return (packed / CHANNEL_SCALES).astype(np.float32)
+
+
+def build_pair_label(labels):
+    """pair_label as construct_dataset() builds it: entry i*n+j is the mean of
+    labels i and j."""
+    labels = np.asarray(labels, dtype=np.float32)
+    return ((labels[:, np.newaxis] + labels[np.newaxis, :]) / 2.0).reshape(-1)
+
+
+class SelectionCorpusWriter(object):
+    """Writes the CIEDN training samples of a dataset into shards of
+    shard_images images: shard_XXXXX_groups.npy holds the uint8 instance
+    groups of the shard one image after the other, shard_XXXXX_labels.npy
+    their labels. index.json, written by close(), lists each shard with the
+    image ids and instance offsets.
+    """
+
+    def __init__(self, corpus_dir, shard_images=1000):
+        self.corpus_dir = corpus_dir
+        self.shard_images = shard_images
+        self.shards = []
+        self.groups = []
+        self.labels = []
+        self.image_ids = []
+        if not os.path.exists(corpus_dir):
+            os.makedirs(corpus_dir)
+        index_path = os.path.join(corpus_dir, "index.json")
+        if os.path.exists(index_path):
+            os.remove(index_path)
+
+    def add(self, image_id, instance_groups, labels):
+        self.image_ids.append(int(image_id))
+        self.groups.append(pack_instance_groups(instance_groups))
+        self.labels.append(np.asarray(labels, dtype=np.uint8))
+        if len(self.image_ids) >= self.shard_images:
+            self.flush()
+
+    def flush(self):
+        if len(self.image_ids) == 0:
+            return
+        name = "shard_{:05d}".format(len(self.shards))
+        np.save(os.path.join(self.corpus_dir, name + "_groups.npy"), np.concatenate(self.groups, axis=0))
+        np.save(os.path.join(self.corpus_dir, name + "_labels.npy"), np.concatenate(self.labels, axis=0))
+        offsets = np.cumsum([0] + [labels.shape[0] for labels in self.labels])
+        self.shards.append({"name": name, "image_ids": self.image_ids, "offsets": offsets.tolist()})
+        self.groups = []
+        self.labels = []
+        self.image_ids = []
+
+    def close(self):
+        self.flush()
+        json.dump({"shards": self.shards}, open(os.path.join(self.corpus_dir, "index.json"), 'w'))
+
+
+class SelectionCorpus(object):
+    """Reads a corpus written by SelectionCorpusWriter."""
+
+    def __init__(self, corpus_dir):
+        self.corpus_dir = corpus_dir
+        self.shards = json.load(open(os.path.join(corpus_dir, "index.json"), 'r'))['shards']
+
+    @staticmethod
+    def exists(corpus_dir):
+        return os.path.exists(os.path.join(corpus_dir, "index.json"))
+
+    def __len__(self):
+        return sum(len(shard['image_ids']) for shard in self.shards)
+
+    def iter_batches(self, batch_images, shuffle=True):
+        """Yields mini-batches of at most batch_images images as lists of
+        (instance_groups [n, 2, 56, 56] float32, labels [n] float32).
+
+        With shuffle the shards and the images inside each shard are visited
+        in random order, so every shard is still read sequentially once.
+        """
+        shard_order = np.random.permutation(len(self.shards)) if shuffle else np.arange(len(self.shards))
+        batch = []
+        for shard_index in shard_order:
+            shard = self.shards[shard_index]
+            groups = np.load(os.path.join(self.corpus_dir, shard['name'] + "_groups.npy"), mmap_mode='r')
+            labels = np.load(os.path.join(self.corpus_dir, shard['name'] + "_labels.npy"))
+            offsets = shard['offsets']
+            num = len(shard['image_ids'])
+            image_order = np.random.permutation(num) if shuffle else np.arange(num)
+            for i in image_order:
+                start, end = offsets[i], offsets[i + 1]
+                batch.append((unpack_instance_groups(groups[start:end]), labels[start:end].astype(np.float32)))
+                if len(batch) == batch_images:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
@@ -2,8 +2,8 @@ import json
 import numpy as np
 from PIL import Image
 from utils.utils import rgb2id
+from utils.Selection import saliency_overlap
 from matplotlib import pyplot as plt
-import math
 import os
 
 def predict(panoptic_model,saliency_model):
@@ -20,17 +20,11 @@ def predict(panoptic_model,saliency_model):
         panoptic_img = Image.open("../" + panoptic_model+"/"+ image_name.replace("jpg","png")).convert('RGB')
 
         sal_img = np.array(saliency_img, dtype=np.uint8)
-        sal_vals_ordered = np.sort(sal_img, axis=None)
-        threshold = sal_vals_ordered[math.ceil(sal_img.size * 3 / 4) - 1]
-        sal_mask = sal_img > threshold
-
         seg_img = rgb2id(np.array(panoptic_img, dtype=np.uint8))
         instances = image_dict[image_id]['segments_info']
-        for instance_id in instances:
-            instance_mask = seg_img == int(instance_id)
-            intersection = instance_mask * sal_mask
-
-            if np.count_nonzero(intersection) / np.count_nonzero(instance_mask) > 0.5:
+        overlaps = saliency_overlap(sal_img, seg_img, list(instances))
+        for instance_id, overlap in zip(instances, overlaps):
+            if overlap > 0.5:
                 score = 1.0
             else:
                 score = 0.0
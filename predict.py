@@ -1,5 +1,9 @@
 import os
+import sys
 import json
+import subprocess
+import threading
+import torch
 import skimage.io
 import numpy as np
 
@@ -11,6 +15,8 @@ from PIL import Image
 from matplotlib import pyplot as plt
 from utils import visualize
 from middle_process import map_instance_to_gt
+from utils.pipeline import PredictionPipeline
+from utils.journal import PredictionJournal
 
 import argparse
 import yaml
@@ -32,6 +38,31 @@ class CINConfig(Config):
     THING_NUM_CLASSES = 1+80
     STUFF_NUM_CLASSES = 1+53
 
+# The writer threads of the pipeline share id_generator
+id_lock = threading.Lock()
+
+def paint_instances(result):
+    """The panoptic and semantic images of the stuff and thing masks of an
+    instance/insttr result, and their segments info."""
+    image_shape = result['semantic_segment'].shape[:2] + (3,)
+    panoptic_result = np.zeros(image_shape)
+    semantic_result = np.zeros(image_shape)
+    information_collector = {}
+    for kind in ['stuff', 'thing']:
+        if kind+'_class_ids' not in result:
+            continue
+        class_ids, boxes, masks = result[kind+'_class_ids'], result[kind+'_boxes'], result[kind+'_masks']
+        for i,class_id in enumerate(class_ids):
+            category_id=class_dict[str(int(class_id))]['category_id']
+            category_name=class_dict[str(int(class_id))]['name']
+            with id_lock:
+                id, color = id_generator.get_id_and_color(str(category_id))
+            mask=masks[i]  # utils.BoxMask
+            mask.paint(panoptic_result, [int(color[0]),int(color[1]),int(color[2])])
+            mask.paint(semantic_result, [int(class_id),int(class_id),int(class_id)])
+            information_collector[str(id)]={"id": int(id), "bbox": [int(boxes[i][0]),int(boxes[i][1]),int(boxes[i][2]),int(boxes[i][3])], "category_id": int(category_id),"class_id":int(class_id),"category_name":category_name}
+    return panoptic_result, semantic_result, information_collector
+
 def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("--train_val_mode", type=str,
@@ -39,199 +70,187 @@ def get_parser():
                         help="val or train")
     parser.add_argument("--mode", type=str,
                         default="selection",
-                        help = "the mode of the predict")
+                        help = "the mode of the predict: insttr, instance, p_interest, selection or all")
     parser.add_argument("--config", type=str,
                         default="configs/predict_config.yaml",
                         help="the config file path")
+    parser.add_argument("--num_shards", "--num-shards", type=int,
+                        default=1,
+                        help="split the images into this many shards; without --shard_index, "
+                             "run one process per shard and merge their results")
+    parser.add_argument("--shard_index", "--shard-index", type=int,
+                        default=None,
+                        help="predict only this shard, the launcher merges the shards")
     return parser
 
-def run(mode, config,train_val_mode="val"):
-    model = CIN(model_dir=MODEL_DIR, config=config)
-    if config.GPU_COUNT:
-        model = model.cuda()
+def open_journal(mode, train_val_mode, num_shards=1, shard_index=0):
+    """The journal of the finished images of a mode, subset and shard, see
+    utils/journal.py. Delete it to predict everything again."""
+    name = "journal_" + mode + "_" + train_val_mode
+    if num_shards > 1:
+        name += "_shard{}of{}".format(shard_index, num_shards)
+    return PredictionJournal(os.path.join("results", name + ".jsonl"))
 
-    if mode=="insttr":
-        if not os.path.exists("../CIN_panoptic_"+train_val_mode):
-            os.makedirs("../CIN_panoptic_"+train_val_mode)
-        if not os.path.exists("../CIN_semantic_"+train_val_mode):
-            os.makedirs("../CIN_semantic_"+train_val_mode)
-        if not os.path.exists("../CIN_saliency_"+train_val_mode):
-            os.makedirs("../CIN_saliency_"+train_val_mode)
-
-        model.load_weights(config.WEIGHT_PATH)
-        images_dict=json.load(open(os.path.join(config.JSON_PATH, train_val_mode+"_images_dict.json"),'r'))
-        image_collector=dict()
-        count=0
-        exist=os.listdir("../CIN_saliency_"+train_val_mode)
-        for image_id in images_dict:
-            try:
-                count+=1
-                image = images_dict[image_id]
-                image_name = image['image_name']
-                if image_name.replace(".jpg",".png") in exist:
-                    continue
-
-                img=skimage.io.imread(os.path.join(config.IMAGE_PATH, "ioid_images/"+image_name))
-                if len(img.shape)==2:
-                    img = np.stack([img,img,img],axis=2)
-                result=model.detect([img],limit="insttr")[0]
-
-                semantic_labels=result['semantic_segment']
-                influence_map=result['influence_map']
-                scipy.misc.toimage(influence_map, cmin=0, cmax=1).save("../CIN_saliency_"+train_val_mode+"/" + image_name.replace(".jpg",".png"))
-                panoptic_result=np.zeros(img.shape)
-                semantic_result = np.zeros(img.shape)
-
-                information_collector={}
-                if 'stuff_class_ids' in result:
-                    stuff_class_ids, stuff_boxes, stuff_masks = result['stuff_class_ids'], result['stuff_boxes'], result['stuff_masks']
-                    for i,class_id in enumerate(stuff_class_ids):
-                        category_id=class_dict[str(int(class_id))]['category_id']
-                        category_name=class_dict[str(int(class_id))]['name']
-                        id,color = id_generator.get_id_and_color(str(category_id))
-                        mask=stuff_masks[i]==1
-                        panoptic_result[mask]=[int(color[0]),int(color[1]),int(color[2])]
-                        semantic_result[mask] = [int(class_id),int(class_id),int(class_id)]
-                        information_collector[str(id)]={"id":int(id),"bbox":[int(stuff_boxes[i][0]),int(stuff_boxes[i][1]),int(stuff_boxes[i][2]),int(stuff_boxes[i][3])],"category_id":category_id,"class_id":int(class_id),"category_name":category_name}
-
-                if 'thing_class_ids' in result:
-                    thing_class_ids, thing_boxes, thing_masks = result['thing_class_ids'], result['thing_boxes'], result['thing_masks']
-                    for i,class_id in enumerate(thing_class_ids):
-                        category_id=class_dict[str(int(class_id))]['category_id']
-                        category_name=class_dict[str(int(class_id))]['name']
-                        id, color = id_generator.get_id_and_color(str(category_id))
-                        mask=thing_masks[i]==1
-                        panoptic_result[mask]=[int(color[0]),int(color[1]),int(color[2])]
-                        semantic_result[mask] = [int(class_id),int(class_id),int(class_id)]
-                        information_collector[str(id)]={"id": int(id), "bbox": [int(thing_boxes[i][0]),int(thing_boxes[i][1]),int(thing_boxes[i][2]),int(thing_boxes[i][3])], "category_id": category_id,"class_id":int(class_id),"category_name":category_name}
-
-                Image.fromarray(panoptic_result.astype(np.uint8)).save("../CIN_panoptic_"+train_val_mode+"/" + image_name.replace(".jpg",".png"))
-                Image.fromarray(semantic_result.astype(np.uint8)).save("../CIN_semantic_"+train_val_mode+"/" + image_name.replace(".jpg", ".png"))
-                image['predictions'] = information_collector
-                print(str(count)+"/"+str(len(images_dict)))
-            except Exception as e:
-                print("ERROR: "+image_name)
-                print(e)
-        map_instance_to_gt(images_dict,"CIN_panoptic_"+train_val_mode)
-    elif mode=="instance":
-        if not os.path.exists("../CIN_panoptic_"+train_val_mode):
-            os.makedirs("../CIN_panoptic_"+train_val_mode)
-        if not os.path.exists("../CIN_semantic_"+train_val_mode):
-            os.makedirs("../CIN_semantic_"+train_val_mode)
-        model.load_weights(config.WEIGHT_PATH)
-        images_dict=json.load(open(os.path.join(config.JSON_PATH, train_val_mode+"_images_dict.json"),'r'))
-        count=0
-        exist=os.listdir("../CIN_panoptic_"+train_val_mode)
-        for image_id in images_dict:
-            try:
-                count+=1
-                image = images_dict[image_id]
-                image_name=image['image_name']
-                if image_name.replace(".jpg",".png") in exist:
-                   continue
-
-                img=skimage.io.imread(os.path.join(config.IMAGE_PATH, "ioid_images/"+image_name))
-                if len(img.shape)==2:
-                    img = np.stack([img,img,img],axis=2)
-                result=model.detect([img],limit="instance")[0]
-
-                semantic_labels=result['semantic_segment']
-                panoptic_result=np.zeros(img.shape)
-                semantic_result=np.zeros(img.shape)
-                information_collector={}
-                if 'stuff_class_ids' in result:
-                    stuff_class_ids,stuff_boxes,stuff_masks=result['stuff_class_ids'],result['stuff_boxes'],result['stuff_masks']
-                    for i,class_id in enumerate(stuff_class_ids):
-                        category_id=class_dict[str(int(class_id))]['category_id']
-                        category_name=class_dict[str(int(class_id))]['name']
-                        id,color = id_generator.get_id_and_color(str(category_id))
-                        mask=stuff_masks[i]==1
-                        panoptic_result[mask]=[int(color[0]),int(color[1]),int(color[2])]
-                        semantic_result[mask]=[int(class_id),int(class_id),int(class_id)]
-                        information_collector[str(id)]={"id":int(id),"bbox":[int(stuff_boxes[i][0]),int(stuff_boxes[i][1]),int(stuff_boxes[i][2]),int(stuff_boxes[i][3])],"category_id":int(category_id),"class_id":int(class_id),"category_name":category_name}
-                if 'thing_class_ids' in result:
-                    thing_class_ids, thing_boxes, thing_masks = result['thing_class_ids'], result['thing_boxes'], result['thing_masks']
-                    for i,class_id in enumerate(thing_class_ids):
-                        category_id=class_dict[str(int(class_id))]['category_id']
-                        category_name=class_dict[str(int(class_id))]['name']
-                        id, color = id_generator.get_id_and_color(str(category_id))
-                        mask=thing_masks[i]==1
-                        panoptic_result[mask]=[int(color[0]),int(color[1]),int(color[2])]
-                        semantic_result[mask]=[int(class_id),int(class_id),int(class_id)]
-                        information_collector[str(id)]={"id": int(id), "bbox": [int(thing_boxes[i][0]),int(thing_boxes[i][1]),int(thing_boxes[i][2]),int(thing_boxes[i][3])], "category_id": int(category_id),"class_id":int(class_id),"category_name":category_name}
-                Image.fromarray(panoptic_result.astype(np.uint8)).save("../CIN_panoptic_"+train_val_mode+"/" + image_name.replace(".jpg",".png"))
-                Image.fromarray(semantic_result.astype(np.uint8)).save("../CIN_semantic_"+train_val_mode+"/" + image_name.replace(".jpg",".png"))
-                image['predictions']=information_collector
-                print(str(count)+"/"+str(len(images_dict)))
-            except Exception as e:
-                print("ERROR: "+image_name)
-                print(e)
-        map_instance_to_gt(images_dict,"CIN_panoptic_"+train_val_mode)
-    elif mode=="p_interest":
-        if not os.path.exists("../CIN_saliency_"+train_val_mode):
-            os.makedirs("../CIN_saliency_"+train_val_mode)
-        print("generate p_interest")
-        model.load_weights(config.WEIGHT_PATH)
-        images_dict = json.load(open(os.path.join(config.JSON_PATH, train_val_mode+"_images_dict.json"), 'r'))
-        count = 0
-        exist = os.listdir("../CIN_saliency_"+train_val_mode)
-        for image_id in images_dict:
-            try:
-                count += 1
-                image = images_dict[image_id]
-                image_name = image['image_name']
-                if image_name.replace(".jpg", ".png") in exist:
-                    continue
-
-                img = skimage.io.imread(os.path.join(config.IMAGE_PATH, "ioid_images/"+image_name))
-                if len(img.shape)==2:
-                    img = np.stack([img,img,img],axis=2)
-                influence_map = model.detect([img], limit="p_interest")[0]["influence_map"]
-                scipy.misc.toimage(influence_map, cmin=0, cmax=1).save("../CIN_saliency_"+train_val_mode+"/" + image_name.replace(".jpg", ".png"))
-                print(str(count) + "/" + str(len(images_dict)))
-            except Exception as e:
-                print("ERROR: " + image_name)
-                print(e)
-    elif mode=="selection":
-        model.load_weights(config.WEIGHT_PATH)
-        images_dict=json.load(open(os.path.join(config.JSON_PATH, train_val_mode+"_images_dict.json"),'r'))
+def shard_image_ids(images_dict, num_shards, shard_index):
+    """The image ids of a shard: the ids are sorted numerically and split
+    into num_shards contiguous ranges."""
+    image_ids = sorted(images_dict.keys(), key=int)
+    start = len(image_ids) * shard_index // num_shards
+    end = len(image_ids) * (shard_index + 1) // num_shards
+    return image_ids[start:end]
 
+def merge_journals(mode, train_val_mode, images_dict, journals):
+    """Writes the final JSONs of the mode from the journals of its shards.
+    The images are taken in the order of images_dict, so the result does not
+    depend on the sharding or on the order the shards finished in."""
+    entries = {}
+    for journal in journals:
+        entries.update(journal.entries)
+    done = [image_id for image_id in images_dict if image_id in entries]
+    print("merge: {}/{} images predicted".format(len(done), len(images_dict)))
+
+    if mode in ["selection", "all"]:
         CIEDN_pred_dict = {}
-        count = 0
-        for image_id in images_dict:
-            try:
-                print(image_id)
-                count+=1
-                print(str(count)+"/"+str(len(images_dict)))
-                image = images_dict[image_id]
-                image_name=image['image_name']
-                img=skimage.io.imread(os.path.join(config.IMAGE_PATH, "ioid_images/")+image_name)
-                if len(img.shape)==2:
-                    img = np.stack([img,img,img],axis=2)
-
-                pred_dict,ioid_result,segments_info,panoptic_result_instance_id_map,prediction_list,instance_list=model.detect([img], limit="selection")
-                scipy.misc.imsave("results/CIEDN_pred/" + image_name.replace(".jpg", ".png"), ioid_result)
-                CIEDN_pred_dict[str(image_id)] = pred_dict
-                print("{}/{}".format(count,len(images_dict)))
-            except Exception as e:
-                print("ERROR: "+image_name)
-                print(e)
+        for image_id in done:
+            CIEDN_pred_dict[image_id] = entries[image_id]['selection'] if mode == "all" else entries[image_id]
         json.dump(CIEDN_pred_dict, open("results/CIEDN_pred_dict.json", 'w'))
 
-    else:
+    if mode in ["insttr", "instance", "all"]:
+        predicted_dict = {}
+        for image_id in done:
+            images_dict[image_id]['predictions'] = entries[image_id]['predictions'] if mode == "all" else entries[image_id]
+            predicted_dict[image_id] = images_dict[image_id]
+        map_instance_to_gt(predicted_dict, "CIN_panoptic_"+train_val_mode)
+
+def launch(args, num_shards):
+    """Runs num_shards predict.py processes, one per shard, with the CPU
+    threads split between them, then merges their journals. If a shard
+    fails nothing is merged: run again, the journals skip the finished images."""
+    threads = max(1, (os.cpu_count() or 1) // num_shards)
+    env = dict(os.environ, OMP_NUM_THREADS=str(threads), MKL_NUM_THREADS=str(threads))
+    processes = []
+    for shard_index in range(num_shards):
+        command = [sys.executable, os.path.abspath(__file__), "--mode", args.mode, "--train_val_mode", args.train_val_mode,
+                   "--config", args.config, "--num_shards", str(num_shards), "--shard_index", str(shard_index)]
+        processes.append(subprocess.Popen(command, env=env))
+    failed = [shard_index for shard_index, process in enumerate(processes) if process.wait() != 0]
+    if failed:
+        print("shards failed: " + ", ".join(str(shard_index) for shard_index in failed))
+        sys.exit(1)
+
+    config = load_config(args.config)
+    images_dict = json.load(open(os.path.join(config.JSON_PATH, args.train_val_mode+"_images_dict.json"), 'r'))
+    journals = [open_journal(args.mode, args.train_val_mode, num_shards, shard_index) for shard_index in range(num_shards)]
+    merge_journals(args.mode, args.train_val_mode, images_dict, journals)
+    for journal in journals:
+        journal.close()
+
+def run(mode, config,train_val_mode="val", num_shards=1, shard_index=0):
+    """Predicts the images of the shard. With one shard the final JSONs are
+    written too, with more the launcher merges the shard journals."""
+    if num_shards > 1:
+        # Share the cores of the machine between the shard processes, also
+        # the CPU_THREADS of the config, which CIN applies on the CPU
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // num_shards))
+        if config.CPU_THREADS:
+            config.CPU_THREADS = max(1, config.CPU_THREADS // num_shards)
+    model = CIN(model_dir=MODEL_DIR, config=config)
+    if config.GPU_COUNT:
+        model = model.cuda()
+
+    # The output directories of each mode
+    directories = {"insttr": ["../CIN_panoptic_"+train_val_mode, "../CIN_semantic_"+train_val_mode,
+                              "../CIN_saliency_"+train_val_mode],
+                   "instance": ["../CIN_panoptic_"+train_val_mode, "../CIN_semantic_"+train_val_mode],
+                   "p_interest": ["../CIN_saliency_"+train_val_mode],
+                   "selection": ["results/CIEDN_pred"]}
+    directories["all"] = directories["insttr"] + directories["selection"]
+    if mode not in directories:
         print(mode+" does not exist")
+        return
+    for directory in directories[mode]:
+        if not os.path.exists(directory):
+            os.makedirs(directory)
 
-import sys
-if __name__=='__main__':
-    args = get_parser().parse_args()
-    if args.mode:
-        mode = args.mode
-    if args.subset:
-        subset = args.subset
-    if args.config:
-        with open(args.config, 'r') as config:
-            config_dict = yaml.load(config)
-            config = CINConfig()
+    # Every mode runs through the pipeline: the images are decoded and the
+    # results written in thread pools while the model runs on the next batch
+    model.load_weights(config.WEIGHT_PATH)
+    images_dict=json.load(open(os.path.join(config.JSON_PATH, train_val_mode+"_images_dict.json"),'r'))
+    shard_ids = shard_image_ids(images_dict, num_shards, shard_index)
+
+    journal = open_journal(mode, train_val_mode, num_shards, shard_index)
+
+    def decode(image_id):
+        img=skimage.io.imread(os.path.join(config.IMAGE_PATH, "ioid_images/"+images_dict[image_id]['image_name']))
+        if len(img.shape)==2:
+            img = np.stack([img,img,img],axis=2)
+        return img
+
+    def infer(image_ids, imgs):
+        return model.detect(imgs, limit=mode)
+
+    def write_saliency(png_name, result):
+        scipy.misc.toimage(result['influence_map'], cmin=0, cmax=1).save("../CIN_saliency_"+train_val_mode+"/" + png_name)
+
+    def write_instances(image_id, png_name, result):
+        panoptic_result, semantic_result, information_collector = paint_instances(result)
+        Image.fromarray(panoptic_result.astype(np.uint8)).save("../CIN_panoptic_"+train_val_mode+"/" + png_name)
+        Image.fromarray(semantic_result.astype(np.uint8)).save("../CIN_semantic_"+train_val_mode+"/" + png_name)
+        journal.record(image_id, information_collector)
+
+    def write(image_id, result):
+        png_name = images_dict[image_id]['image_name'].replace(".jpg",".png")
+        if mode=="insttr":
+            write_saliency(png_name, result)
+            write_instances(image_id, png_name, result)
+        elif mode=="instance":
+            write_instances(image_id, png_name, result)
+        elif mode=="p_interest":
+            write_saliency(png_name, result)
+            journal.record(image_id)
+        elif mode=="selection":
+            pred_dict,ioid_result,segments_info,panoptic_result_instance_id_map,prediction_list,instance_list=result
+            scipy.misc.imsave("results/CIEDN_pred/" + png_name, ioid_result)
+            # The masks are in the CIEDN_pred image, the JSON keeps the rest
+            pred_dict = {id: {key: pred_dict[id][key] for key in pred_dict[id] if key != 'mask'} for id in pred_dict}
+            journal.record(image_id, pred_dict)
+        elif mode=="all":
+            # The outputs of the insttr and selection modes from one pass
+            write_saliency(png_name, result)
+            Image.fromarray(result['panoptic_result'].astype(np.uint8)).save("../CIN_panoptic_"+train_val_mode+"/" + png_name)
+            Image.fromarray(result['semantic_result'].astype(np.uint8)).save("../CIN_semantic_"+train_val_mode+"/" + png_name)
+            scipy.misc.imsave("results/CIEDN_pred/" + png_name, result['ioid_result'])
+
+            # The masks are in the panoptic image, the JSON keeps the rest
+            segments_info = result['segments_info']
+            predictions = {id: {key: segments_info[id][key] for key in segments_info[id] if key != 'mask'}
+                           for id in segments_info}
+            selection = {id: predictions[id] for id in result['selection']}
+            journal.record(image_id, {"predictions": predictions, "selection": selection})
+
+    print(mode + ": " + str(len(shard_ids)) + " images")
+    pipeline = PredictionPipeline(decode, infer, write,
+                                  decode_workers=config.PREDICT_DECODE_WORKERS,
+                                  write_workers=config.PREDICT_WRITE_WORKERS,
+                                  queue_size=config.PREDICT_QUEUE_SIZE,
+                                  batch_images=config.PREDICT_BATCH_IMAGES)
+    pipeline.run([image_id for image_id in shard_ids if image_id not in journal])
+    if num_shards == 1 and mode != "p_interest":
+        merge_journals(mode, train_val_mode, images_dict, [journal])
+    journal.close()
+
+def load_config(config_path):
+    config = CINConfig()
+    if config_path:
+        with open(config_path, 'r') as config_file:
+            config_dict = yaml.load(config_file)
             for key in config_dict:
                 setattr(config,key,config_dict[key])
-    run(mode, config, subset)
\ No newline at end of file
+    return config
+
+if __name__=='__main__':
+    args = get_parser().parse_args()
+    if args.num_shards > 1 and args.shard_index is None:
+        launch(args, args.num_shards)
+    else:
+        run(args.mode, load_config(args.config), args.train_val_mode, args.num_shards, args.shard_index or 0)
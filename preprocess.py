@@ -0,0 +1,52 @@
+import os
+
+from config import Config
+from DatasetLib import OOIDataset, preprocess_samples
+
+import argparse
+import yaml
+
+
+class CINConfig(Config):
+    NAME = "ooi"
+    GPU_COUNT = 1
+    IMAGES_PER_GPU = 1 #10
+    NUM_CLASSES = 1+133
+    THING_NUM_CLASSES = 1+80
+    STUFF_NUM_CLASSES = 1+53
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--subset", type=str,
+                        default="train,val",
+                        help="the subsets to preprocess, separated by commas")
+    parser.add_argument("--cache_dir", type=str,
+                        default=None,
+                        help="the sample cache directory, SAMPLE_CACHE_DIR of the config by default")
+    parser.add_argument("--config", type=str,
+                        default="configs/train_config.yaml",
+                        help="the config file path")
+    return parser
+
+def run(subsets, cache_dir, config):
+    for subset in subsets:
+        print("Preprocess " + subset)
+        dataset = OOIDataset(subset)
+        preprocess_samples(dataset, config, os.path.join(cache_dir, subset))
+
+if __name__=='__main__':
+    args = get_parser().parse_args()
+    if args.config:
+        with open(args.config, 'r') as config:
+            config_dict = yaml.load(config)
+            config = CINConfig()
+            for key in config_dict:
+                setattr(config,key,config_dict[key])
+    else:
+        config = CINConfig()
+    cache_dir = args.cache_dir or config.SAMPLE_CACHE_DIR
+    if not cache_dir:
+        print("no sample cache directory, set SAMPLE_CACHE_DIR or --cache_dir")
+        exit()
+    run(args.subset.split(','), cache_dir, config)
@@ -263,6 +263,8 @@ def resize_stuff_masks(stuff_detections,stuff_masks):
     return stuff_class_ids,stuff_boxes,stuff_mask_mini
 
 def filter_thing_masks(thing_detections,mrcnn_mask,image_shape,window):
+    """Returns: class ids [n, 1], boxes [n, 4], the masks as utils.BoxMask
+    and the scores"""
     if (thing_detections.shape[0] == 0):
         thing_class_ids = []
         thing_boxes = []
@@ -296,6 +298,7 @@ def filter_thing_masks(thing_detections,mrcnn_mask,image_shape,window):
     thing_class_ids = thing_class_ids.reshape([-1, 1])
 
     #resize
+    h, w = int(image_shape[0]), int(image_shape[1])
     thing_masks_unmold = []
     final_thing_class_ids = []
     final_thing_boxes = []
@@ -303,50 +306,63 @@ def filter_thing_masks(thing_detections,mrcnn_mask,image_shape,window):
     for i in range(thing_class_ids.shape[0]):
         threshold = 0.5
         y1, x1, y2, x2 = thing_boxes[i].astype(np.int32)
+        if y2 <= y1 or x2 <= x1:
+            # under a pixel once scaled to the image, the mask would be empty
+            continue
 
         mask = scipy.misc.imresize(thing_masks[i], (y2 - y1, x2 - x1), interp='bilinear').astype(np.float32) / 255.0
         mask = np.where(mask >= threshold, 1, 0).astype(np.uint8)
-        full_image = np.zeros(image_shape[:2], dtype=np.uint8)
-        full_image[y1:y2,x1:x2]=mask
-        thing_box=utils.extract_bbox(full_image)
+        # Keep the part inside the image, tightened to the mask pixels
+        top, left = max(y1, 0), max(x1, 0)
+        mask = mask[top - y1:min(y2, h) - y1, left - x1:min(x2, w) - x1]
+        box = utils.extract_bbox(mask)
+        thing_box = box + np.array([top, left, top, left])
         if (thing_box[2]-thing_box[0])*(thing_box[3]-thing_box[1])>0:
             final_thing_class_ids.append(thing_class_ids[i])
             final_thing_boxes.append(thing_box)
-            thing_masks_unmold.append(full_image)
+            thing_masks_unmold.append(utils.BoxMask(thing_box, mask[box[0]:box[2], box[1]:box[3]], (h, w)))
             final_thing_scores=thing_scores[i]
-    thing_masks_unmold=np.stack(thing_masks_unmold)
     final_thing_class_ids=np.array(final_thing_class_ids)
     final_thing_boxes=np.stack(final_thing_boxes)
     final_thing_scores=np.array(final_thing_scores)
     return final_thing_class_ids,final_thing_boxes,thing_masks_unmold,final_thing_scores
 
-def filter_stuff_masks(stuff_detections,stuff_masks,image_shape,window):
-    if(stuff_detections.shape[0] == 0 and stuff_masks.shape[0] == 0):
+def filter_stuff_masks(stuff_detections,semantic_label,image_shape,window):
+    """stuff_detections: [y, 5] of generate_stuff
+    semantic_label: [500, 500] label map the stuff masks are cut from
+
+    Returns: class ids [n, 1], boxes [n, 4] and the masks as utils.BoxMask
+    """
+    if stuff_detections.shape[0] == 0:
         stuff_class_ids = []
         stuff_boxes = []
         stuff_masks_umold = []
         return stuff_class_ids, stuff_boxes, stuff_masks_umold
     stuff_class_ids=stuff_detections[:,4:5]
-    stuff_boxes=stuff_detections[:,:4]
 
     h, w = image_shape[:2]
     mask_scale = max(h,w)/500.0
     top_pad = (max(h,w) - h) // 2
     left_pad = (max(h,w) - w) // 2
-    shifts = np.array([top_pad, left_pad, top_pad, left_pad])
-    stuff_boxes = stuff_boxes * mask_scale - shifts#np.multiply(, scales)
-    stuff_masks=scipy.ndimage.zoom(stuff_masks, zoom=[1, mask_scale, mask_scale], order=0)
-    stuff_masks_umold=[]
+    # Nearest-neighbour zoom of the label map once equals the zoom of each
+    # class mask
+    label_map=scipy.ndimage.zoom(semantic_label, zoom=mask_scale, order=0)
+    label_map=label_map[top_pad:h+top_pad,left_pad:w+left_pad]
+    slices=scipy.ndimage.find_objects(label_map, max_label=int(stuff_class_ids.max()))
     final_stuff_class_ids = []
     final_stuff_boxes = []
+    stuff_masks_umold=[]
     for i in range(stuff_class_ids.shape[0]):
-        stuff_mask=stuff_masks[i][top_pad:h+top_pad,left_pad:w+left_pad]
-        stuff_box=utils.extract_bbox(stuff_mask)
-        if (stuff_box[2]-stuff_box[0])*(stuff_box[3]-stuff_box[1])>0:
+        class_id=int(stuff_class_ids[i][0])
+        box_slices=slices[class_id - 1]
+        if box_slices is not None:
+            y, x = box_slices
+            stuff_box=np.array([y.start, x.start, y.stop, x.stop])
             final_stuff_class_ids.append(stuff_class_ids[i])
             final_stuff_boxes.append(stuff_box)
-            stuff_masks_umold.append(stuff_mask)
-    stuff_masks_umold=np.stack(stuff_masks_umold)
+            stuff_masks_umold.append(utils.BoxMask(stuff_box, label_map[box_slices] == class_id, (h, w)))
+    if len(final_stuff_boxes) == 0:
+        return [], [], []
     final_stuff_class_ids=np.array(final_stuff_class_ids)
     final_stuff_boxes=np.stack(final_stuff_boxes)
     return final_stuff_class_ids,final_stuff_boxes,stuff_masks_umold
@@ -409,6 +425,33 @@ def extract_piece_group(thing_detections,thing_masks,stuff_detections,stuff_mask
     instance_piece_groups = np.stack(instance_piece_groups)
 
     return instance_piece_groups, instance_class_ids, instance_boxes,instance_masks
+
+def saliency_overlap(saliency_map, instance_id_map, instance_ids):
+    """Fraction of the pixels of each instance that fall in the top quartile
+    of the saliency map, the heuristic of ioi_selection_binary.
+
+    saliency_map: [H, W] saliency values
+    instance_id_map: [H, W] instance ids, e.g. rgb2id of a panoptic result
+    instance_ids: the ids to measure, in the order of the returned array
+
+    Returns: [n] overlaps in [0, 1], 0 for ids absent from the map.
+    """
+    sal_vals = saliency_map.ravel()
+    k = math.ceil(sal_vals.size * 3 / 4) - 1
+    threshold = np.partition(sal_vals, k)[k]
+    sal_mask = saliency_map > threshold
+
+    ids, inverse = np.unique(instance_id_map, return_inverse=True)
+    areas = np.bincount(inverse.ravel(), minlength=ids.shape[0])
+    salient = np.bincount(inverse.ravel(), weights=sal_mask.ravel(), minlength=ids.shape[0])
+
+    instance_ids = np.array([int(instance_id) for instance_id in instance_ids], dtype=ids.dtype)
+    index = np.minimum(np.searchsorted(ids, instance_ids), ids.shape[0] - 1)
+    found = ids[index] == instance_ids
+    overlaps = np.zeros(instance_ids.shape[0])
+    overlaps[found] = salient[index[found]] / areas[index[found]]
+    return overlaps
+
 if __name__=='__main__':
     class_ids_sort=np.array([1,2,3,4])
     masks_sort=np.array([[[0,1,1,0],
@@ -0,0 +1,79 @@
+import os
+import json
+
+import numpy as np
+
+############################################################
+#  Backbone Feature Cache
+############################################################
+
+# The feature maps stored for each group, in the order the network returns them
+FEATURE_LEVELS = {"c": ["c1", "c2", "c3", "c4", "c5"],
+                  "p": ["p2", "p3", "p4", "p5"]}
+
+
+class FeatureCache(object):
+    """Stores the backbone (c1..c5) and/or FPN (p2..p5) outputs of every image
+    of a dataset as fp16 memory-mapped shards, one .npy per feature map with
+    shape [num_images, C, H, W], plus an index.json mapping image ids to rows.
+
+    index.json is written last, so a cache without it is incomplete and is
+    rebuilt.
+    """
+
+    def __init__(self, cache_dir, groups):
+        self.cache_dir = cache_dir
+        self.groups = list(groups)
+        self.names = [name for group in self.groups for name in FEATURE_LEVELS[group]]
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.rows = {}
+        self.shards = {}
+
+    def exists(self):
+        if not os.path.exists(self.index_path):
+            return False
+        index = json.load(open(self.index_path, 'r'))
+        return all(name in index['shapes'] for name in self.names)
+
+    def open(self):
+        index = json.load(open(self.index_path, 'r'))
+        self.rows = index['rows']
+        for name in self.names:
+            self.shards[name] = np.load(os.path.join(self.cache_dir, name + ".npy"), mmap_mode='r')
+
+    def create(self, image_ids, shapes):
+        """image_ids: the ids of the images to store
+        shapes: dict of feature map name -> [C, H, W]
+        """
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        if os.path.exists(self.index_path):
+            os.remove(self.index_path)
+        self.rows = {str(image_id): row for row, image_id in enumerate(image_ids)}
+        for name in self.names:
+            self.shards[name] = np.lib.format.open_memmap(os.path.join(self.cache_dir, name + ".npy"), mode='w+',
+                                                          dtype=np.float16,
+                                                          shape=tuple([len(image_ids)] + list(shapes[name])))
+
+    def write(self, image_id, features):
+        """features: dict of feature map name -> [C, H, W] numpy array"""
+        row = self.rows[str(image_id)]
+        for name in self.names:
+            self.shards[name][row] = features[name]
+
+    def close(self, written_ids):
+        """Flushes the shards and writes the index of the images stored."""
+        for name in self.names:
+            self.shards[name].flush()
+        index = {"rows": {str(image_id): self.rows[str(image_id)] for image_id in written_ids},
+                 "shapes": {name: list(self.shards[name].shape[1:]) for name in self.names}}
+        json.dump(index, open(self.index_path, 'w'))
+        self.open()
+
+    def read(self, image_id, group):
+        """Returns the list of [C, H, W] float32 arrays of the group, or None
+        if the image is not cached."""
+        row = self.rows.get(str(image_id))
+        if row is None:
+            return None
+        return [np.asarray(self.shards[name][row], dtype=np.float32) for name in FEATURE_LEVELS[group]]
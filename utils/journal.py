@@ -0,0 +1,63 @@
+import os
+import json
+import threading
+
+############################################################
+#  Prediction Journal
+############################################################
+
+
+class PredictionJournal(object):
+    """Append-only record of the images a prediction run has finished. Each
+    line of the file is one JSON object {"image_id": ..., "entry": ...}
+    holding the per-image metadata (e.g. the predictions) that the run
+    writes into its final JSON, so a restarted run skips the finished
+    images and still rebuilds the complete JSON from the journal.
+
+    The finished ids are kept in a dict, so the done test is O(1). A line
+    cut short by a crash is ignored and its image is predicted again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        complete = True
+        if os.path.exists(path):
+            with open(path, 'r') as journal:
+                for line in journal:
+                    complete = line.endswith("\n")
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.entries[str(record['image_id'])] = record['entry']
+        self.file = open(path, 'a')
+        if not complete:
+            # Start the next record on its own line
+            self.file.write("\n")
+
+    def __contains__(self, image_id):
+        return str(image_id) in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, image_id):
+        return self.entries.get(str(image_id))
+
+    def record(self, image_id, entry=None):
+        """Marks the image as finished, after its outputs are written. Safe
+        to call from several writer threads."""
+        line = json.dumps({"image_id": str(image_id), "entry": entry}) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+            self.entries[str(image_id)] = entry
+
+    def close(self):
+        with self.lock:
+            self.file.close()
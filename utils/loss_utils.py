@@ -140,7 +140,7 @@ def compute_mrcnn_mask_loss(target_masks, target_class_ids, pred_masks):
 
     return loss
 def compute_saliency_loss(saliency_pred,saliency_tar,loss_ratio=[0.5,0.5, 0.5, 0.8, 1]):
-    saliency_tar = saliency_tar.unsqueeze(0)
+    saliency_tar = saliency_tar.unsqueeze(1) # [batch, 1, 128, 128]
     loss = 0
     for i in range(5):
         # print(saliency_pred[4-i].shape)
@@ -152,7 +152,7 @@ def compute_saliency_loss(saliency_pred,saliency_tar,loss_ratio=[0.5,0.5, 0.5, 0
     return loss
 
 def compute_saliency_loss_finetune(saliency_pred,saliency_tar,loss_ratio=[0.5,0.5, 0.5, 0.8,0.8, 1]):
-    saliency_tar = saliency_tar.unsqueeze(0)
+    saliency_tar = saliency_tar.unsqueeze(1) # [batch, 1, 128, 128]
     loss = 0
     for i in range(6):
         # print(saliency_pred[5-i].shape)
@@ -164,7 +164,7 @@ def compute_saliency_loss_finetune(saliency_pred,saliency_tar,loss_ratio=[0.5,0.
     return loss
 
 def compute_semantic_loss(semantic_segment,semantic_target):
-    semantic_thing=Variable(torch.zeros((semantic_segment.shape[0],81,semantic_segment.shape[2],semantic_segment.shape[3]))).cuda()
+    semantic_thing=Variable(semantic_segment.data.new_zeros((semantic_segment.shape[0],81,semantic_segment.shape[2],semantic_segment.shape[3])))
     semantic_segment=semantic_segment[:,81:,:,:]
     semantic_segment=torch.cat([semantic_thing,semantic_segment],dim=1)
     loss = nn.CrossEntropyLoss(weight=None, ignore_index=0, size_average=True)(semantic_segment,semantic_target)
@@ -0,0 +1,185 @@
+import time
+import queue
+import threading
+
+############################################################
+#  Decode / Infer / Write Pipeline
+############################################################
+
+# Marks the end of the stream on a queue
+_DONE = object()
+
+
+class StageStats(object):
+    """Busy time and item count of a pipeline stage, summed over its
+    workers. The utilisation is the busy share of workers x wall time."""
+
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.busy = 0.0
+        self.items = 0
+        self.lock = threading.Lock()
+
+    def add(self, seconds, items=1):
+        with self.lock:
+            self.busy += seconds
+            self.items += items
+
+    def report(self, elapsed):
+        utilisation = self.busy / max(elapsed * self.workers, 1e-9)
+        return "{}: {} items, {} workers, {:.1%} busy".format(self.name, self.items, self.workers, utilisation)
+
+
+class PredictionPipeline(object):
+    """Runs decode -> infer -> write over a list of items. A pool of decode
+    threads feeds the model stage, which runs in the calling thread, and the
+    model stage feeds a pool of writer threads. The queues between the
+    stages hold at most queue_size entries, so a slow stage blocks the one
+    before it instead of letting decoded images or results pile up.
+
+    decode(item): returns the input of the item, e.g. the decoded image
+    infer(items, inputs): returns the list of outputs of a batch of at most
+        batch_images items
+    write(item, output): stores the output of the item
+
+    An exception in decode or write skips the item, an exception in infer
+    skips the batch; both are printed like the sequential loops did. Any
+    other error stops every stage before it is raised.
+    """
+
+    def __init__(self, decode, infer, write, decode_workers=4, write_workers=4, queue_size=8,
+                 batch_images=1, log_interval=100):
+        self.decode = decode
+        self.infer = infer
+        self.write = write
+        self.decode_workers = decode_workers
+        self.write_workers = write_workers
+        self.queue_size = queue_size
+        self.batch_images = batch_images
+        self.log_interval = log_interval
+        self.stop = threading.Event()
+
+    def put(self, target, entry):
+        # Wait for room, but give up once the pipeline is stopped
+        while not self.stop.is_set():
+            try:
+                target.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(self, source):
+        while not self.stop.is_set():
+            try:
+                return source.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def decode_worker(self, todo, decoded, stats):
+        while True:
+            item = self.get(todo)
+            if item is _DONE:
+                break
+            start = time.time()
+            try:
+                data = self.decode(item)
+            except Exception as e:
+                print("ERROR: decode " + str(item))
+                print(e)
+                continue
+            finally:
+                stats.add(time.time() - start)
+            if not self.put(decoded, (item, data)):
+                return
+        self.put(decoded, _DONE)
+
+    def write_worker(self, results, stats):
+        while True:
+            entry = self.get(results)
+            if entry is _DONE:
+                break
+            item, output = entry
+            start = time.time()
+            try:
+                self.write(item, output)
+            except Exception as e:
+                print("ERROR: write " + str(item))
+                print(e)
+            finally:
+                stats.add(time.time() - start)
+
+    def run(self, items):
+        """Processes all items and prints the utilisation of each stage
+        every log_interval items and at the end."""
+        self.stop.clear()
+        todo = queue.Queue()
+        for item in items:
+            todo.put(item)
+        for _ in range(self.decode_workers):
+            todo.put(_DONE)
+        decoded = queue.Queue(maxsize=self.queue_size)
+        results = queue.Queue(maxsize=self.queue_size)
+
+        decode_stats = StageStats("decode", self.decode_workers)
+        infer_stats = StageStats("infer", 1)
+        write_stats = StageStats("write", self.write_workers)
+        all_stats = [decode_stats, infer_stats, write_stats]
+
+        decoders = [threading.Thread(target=self.decode_worker, args=(todo, decoded, decode_stats))
+                    for _ in range(self.decode_workers)]
+        writers = [threading.Thread(target=self.write_worker, args=(results, write_stats))
+                   for _ in range(self.write_workers)]
+        for thread in decoders + writers:
+            thread.daemon = True
+            thread.start()
+
+        started = time.time()
+        try:
+            finished_decoders = 0
+            batch = []
+            while finished_decoders < self.decode_workers or batch:
+                # Take what is ready, up to batch_images, but never wait for a full batch
+                while finished_decoders < self.decode_workers and len(batch) < self.batch_images:
+                    if batch and decoded.empty():
+                        break
+                    entry = self.get(decoded)
+                    if entry is _DONE:
+                        finished_decoders += 1
+                        continue
+                    batch.append(entry)
+                if not batch:
+                    continue
+
+                batch_items = [item for item, data in batch]
+                start = time.time()
+                try:
+                    outputs = self.infer(batch_items, [data for item, data in batch])
+                except Exception as e:
+                    print("ERROR: infer " + ", ".join(str(item) for item in batch_items))
+                    print(e)
+                    outputs = None
+                infer_stats.add(time.time() - start, len(batch))
+                batch = []
+
+                if outputs is not None:
+                    for item, output in zip(batch_items, outputs):
+                        self.put(results, (item, output))
+
+                if self.log_interval and infer_stats.items // self.log_interval != \
+                        (infer_stats.items - len(batch_items)) // self.log_interval:
+                    elapsed = time.time() - started
+                    print(" | ".join(stats.report(elapsed) for stats in all_stats))
+
+            for _ in range(self.write_workers):
+                self.put(results, _DONE)
+            for thread in writers:
+                thread.join()
+        finally:
+            self.stop.set()
+            for thread in decoders + writers:
+                thread.join()
+            elapsed = time.time() - started
+            print("pipeline {:.1f}s: ".format(elapsed) + " | ".join(stats.report(elapsed) for stats in all_stats))
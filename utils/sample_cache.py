@@ -0,0 +1,104 @@
+import os
+import json
+
+import numpy as np
+
+############################################################
+#  Preprocessed Sample Cache
+############################################################
+
+
+class SampleCacheWriter(object):
+    """Writes named numpy arrays per image into shards of shard_images
+    images. Each shard is one flat byte file; boolean arrays (the masks) are
+    bit-packed. index.json, written by close(), maps every image id to its
+    shard and to the offset, shape and dtype of each array.
+    """
+
+    def __init__(self, cache_dir, shard_images=500):
+        self.cache_dir = cache_dir
+        self.shard_images = shard_images
+        self.images = {}
+        self.shard_count = 0
+        self.shard_file = None
+        self.shard_name = None
+        self.shard_size = 0
+        self.shard_offset = 0
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        index_path = os.path.join(cache_dir, "index.json")
+        if os.path.exists(index_path):
+            os.remove(index_path)
+
+    def add(self, image_id, arrays):
+        if self.shard_file is None:
+            self.shard_name = "shard_{:05d}.bin".format(self.shard_count)
+            self.shard_file = open(os.path.join(self.cache_dir, self.shard_name), 'wb')
+            self.shard_count += 1
+            self.shard_size = 0
+            self.shard_offset = 0
+
+        entries = {}
+        for name in arrays:
+            array = np.asarray(arrays[name])
+            packed = array.dtype == np.bool_
+            data = np.packbits(array.ravel()) if packed else np.ascontiguousarray(array)
+            data = data.tobytes()
+            entries[name] = [self.shard_offset, list(array.shape), array.dtype.str, packed]
+            self.shard_file.write(data)
+            self.shard_offset += len(data)
+        self.images[str(image_id)] = {"shard": self.shard_name, "arrays": entries}
+
+        self.shard_size += 1
+        if self.shard_size >= self.shard_images:
+            self.shard_file.close()
+            self.shard_file = None
+
+    def close(self):
+        if self.shard_file is not None:
+            self.shard_file.close()
+            self.shard_file = None
+        json.dump({"images": self.images}, open(os.path.join(self.cache_dir, "index.json"), 'w'))
+
+
+class SampleCache(object):
+    """Reads a cache written by SampleCacheWriter. The shards are
+    memory-mapped on first use in each process, so the cache can be handed
+    to DataLoader workers."""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.images = json.load(open(os.path.join(cache_dir, "index.json"), 'r'))['images']
+        self.shards = {}
+
+    @staticmethod
+    def exists(cache_dir):
+        return os.path.exists(os.path.join(cache_dir, "index.json"))
+
+    def __contains__(self, image_id):
+        return str(image_id) in self.images
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['shards'] = {}
+        return state
+
+    def read(self, image_id):
+        """Returns the dict of arrays stored for the image."""
+        image = self.images[str(image_id)]
+        shard = self.shards.get(image['shard'])
+        if shard is None:
+            shard = np.memmap(os.path.join(self.cache_dir, image['shard']), dtype=np.uint8, mode='r')
+            self.shards[image['shard']] = shard
+
+        arrays = {}
+        for name in image['arrays']:
+            offset, shape, dtype, packed = image['arrays'][name]
+            count = int(np.prod(shape))
+            if packed:
+                data = np.unpackbits(shard[offset:offset + (count + 7) // 8])[:count].astype(np.bool_)
+            else:
+                dtype = np.dtype(dtype)
+                data = np.array(shard[offset:offset + count * dtype.itemsize]).view(dtype)
+            arrays[name] = data.reshape(shape)
+        return arrays
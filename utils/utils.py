@@ -92,6 +92,48 @@ def compute_overlaps(boxes1, boxes2):
         overlaps[:, i] = compute_iou(box2, boxes1, area2[i], area1)
     return overlaps
 
+def compute_overlaps_max(boxes1, boxes2, max_elements=2 ** 22):
+    """Row and column maxima of compute_overlaps(boxes1, boxes2), computed on
+    blocks of boxes1 rows of at most max_elements IoUs so the full
+    [N1, N2] matrix is never built. The IoUs are computed with the same
+    float operations as compute_iou(), so the results are identical.
+
+    Returns:
+    row_argmax: [N1] index of the best boxes2 box for each boxes1 box
+    row_max: [N1] its IoU
+    col_argmax: [N2] index of the best boxes1 box for each boxes2 box (the
+        first one on ties, as np.argmax)
+    """
+    area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+    area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+
+    n1, n2 = boxes1.shape[0], boxes2.shape[0]
+    rows = max(1, max_elements // max(n2, 1))
+    row_argmax = np.zeros([n1], dtype=np.int64)
+    row_max = np.zeros([n1])
+    col_argmax = np.zeros([n2], dtype=np.int64)
+    col_max = np.full([n2], -np.inf)
+    for start in range(0, n1, rows):
+        chunk = boxes1[start:start + rows]
+        y1 = np.maximum(boxes2[np.newaxis, :, 0], chunk[:, np.newaxis, 0])
+        y2 = np.minimum(boxes2[np.newaxis, :, 2], chunk[:, np.newaxis, 2])
+        x1 = np.maximum(boxes2[np.newaxis, :, 1], chunk[:, np.newaxis, 1])
+        x2 = np.minimum(boxes2[np.newaxis, :, 3], chunk[:, np.newaxis, 3])
+        intersection = np.maximum(x2 - x1, 0) * np.maximum(y2 - y1, 0)
+        union = area2[np.newaxis, :] + area1[start:start + rows, np.newaxis] - intersection
+        overlaps = intersection / union
+
+        chunk_argmax = np.argmax(overlaps, axis=1)
+        row_argmax[start:start + rows] = chunk_argmax
+        row_max[start:start + rows] = overlaps[np.arange(overlaps.shape[0]), chunk_argmax]
+
+        chunk_col_argmax = np.argmax(overlaps, axis=0)
+        chunk_col_max = overlaps[chunk_col_argmax, np.arange(n2)]
+        better = chunk_col_max > col_max
+        col_argmax[better] = chunk_col_argmax[better] + start
+        col_max[better] = chunk_col_max[better]
+    return row_argmax, row_max, col_argmax
+
 def box_refinement(box, gt_box):
     """Compute refinement needed to transform box to gt_box.
     box and gt_box are [N, (y1, x1, y2, x2)]
@@ -280,6 +322,40 @@ def unmold_mask(mask, bbox, image_shape):
     return full_mask
 
 
+class BoxMask(object):
+    """A binary mask of an image kept as its box and the bitmap inside the
+    box, so it costs the box area instead of the image area. The full-size
+    mask is only built by to_full() (or np.asarray) when it is needed.
+
+    box: (y1, x1, y2, x2) in image pixels
+    bitmap: [y2 - y1, x2 - x1] bool
+    image_shape: the (height, width) of the image
+    """
+
+    def __init__(self, box, bitmap, image_shape):
+        self.box = tuple(int(v) for v in box)
+        self.bitmap = bitmap.astype(bool)
+        self.shape = tuple(int(v) for v in image_shape[:2])
+
+    def area(self):
+        return int(np.count_nonzero(self.bitmap))
+
+    def paint(self, image, value):
+        """Sets the pixels of the mask in image [height, width, ...] to value."""
+        y1, x1, y2, x2 = self.box
+        image[y1:y2, x1:x2][self.bitmap] = value
+
+    def to_full(self):
+        y1, x1, y2, x2 = self.box
+        mask = np.zeros(self.shape, dtype=bool)
+        mask[y1:y2, x1:x2] = self.bitmap
+        return mask
+
+    def __array__(self, dtype=None):
+        mask = self.to_full()
+        return mask if dtype is None else mask.astype(dtype)
+
+
 ############################################################
 #  Anchors
 ############################################################
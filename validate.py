@@ -1,8 +1,10 @@
 import os
 import json
+import time
 import skimage.io
 import torch
 import scipy.misc
+from scipy.stats import spearmanr
 
 import config
 from config import Config
@@ -13,6 +15,7 @@ from torch.autograd import Variable
 from compute_metric import compare_mask
 from CIN import CIN
 from utils import utils
+from utils.pytorch_utils import get_device
 import numpy as np
 
 import argparse
@@ -38,6 +41,9 @@ def get_parser():
     parser.add_argument("--config", type=str,
                         default="configs/validate_config.yaml",
                         help="the config file path")
+    parser.add_argument("--mode", type=str,
+                        default="ioi",
+                        help="ioi: evaluate the selection; approx: compare SELECTION_PARTNERS/SELECTION_CASCADE against the exact scores")
     return parser
 
 def maxminnorm(array):
@@ -51,6 +57,64 @@ def compute_pixel_iou(bool_mask_pred, bool_mask_gt):
     union = bool_mask_pred + bool_mask_gt
     return np.count_nonzero(intersection) / np.count_nonzero(union)
 
+def label_instances(instance_dict, gt_instance_dict, instance_id_map, gt_segmentation_id):
+    """Marks each predicted instance as labeled if it matches a labeled GT
+    instance (IoU >= 0.5, same category).
+
+    Returns: the number of labeled GT instances matched by no prediction.
+    """
+    for instance_id in instance_dict:
+        mask = instance_id_map == int(instance_id)
+        instance_dict[instance_id]['mask'] = mask
+
+    for gt_instance_id in gt_instance_dict:
+        gt_mask = gt_segmentation_id == int(gt_instance_id)
+        gt_instance_dict[gt_instance_id]['mask'] = gt_mask
+
+    instance_pred_gt_dict = {}
+    instance_gt_pred_dict = {}
+    if len(instance_dict) == 0:
+        for gt_instance_id in gt_instance_dict:
+            instance_gt_pred_dict[gt_instance_id] = {"labeled": gt_instance_dict[gt_instance_id]['labeled'],"pred": []}
+    else:
+        for instance_id in instance_dict:
+            max_iou = -1
+            max_gt_instance_id = ""
+            for gt_instance_id in gt_instance_dict:
+                i_iou = compute_pixel_iou(instance_dict[instance_id]['mask'],gt_instance_dict[gt_instance_id]['mask'])
+                if gt_instance_id not in instance_gt_pred_dict:
+                    instance_gt_pred_dict[gt_instance_id] = {"labeled": gt_instance_dict[gt_instance_id]['labeled'],
+                                                             "pred": []}
+                if i_iou >= 0.5 and instance_dict[instance_id]['category_id'] == gt_instance_dict[gt_instance_id][
+                    'category_id'] and i_iou > max_iou:
+                    max_gt_instance_id = gt_instance_id
+                    max_iou = i_iou
+                    instance_gt_pred_dict[gt_instance_id]['pred'].append(instance_id)
+            if max_gt_instance_id != "":
+                instance_pred_gt_dict[instance_id] = {"gt_instance_id": max_gt_instance_id,
+                                                      "label": gt_instance_dict[max_gt_instance_id]['labeled']}
+            else:
+                instance_pred_gt_dict[instance_id] = {"gt_instance_id": "", "label": False}
+
+    image_base = 0
+    for instance_id in instance_gt_pred_dict:
+        if instance_gt_pred_dict[instance_id]['labeled'] == True and len(instance_gt_pred_dict[instance_id]['pred']) == 0:
+            image_base += 1
+
+    for instance_id in instance_dict:
+        del instance_dict[instance_id]['mask']
+
+    for gt_instance_id in gt_instance_dict:
+        del gt_instance_dict[gt_instance_id]['mask']
+
+    for instance_id in instance_dict:
+        instance = instance_dict[instance_id]
+        if instance_id in instance_pred_gt_dict:
+            instance['labeled'] = instance_pred_gt_dict[instance_id]['label']
+        else:
+            instance['labeled'] = False
+    return image_base
+
 def run(config):
     model = CIN(model_dir=MODEL_DIR, config=config)
 
@@ -64,7 +128,7 @@ def run(config):
             batch = [[torch.from_numpy(np.zeros([1, 1]))]]
         return default_collate(batch)
 
-    state_dict = torch.load(config.WEIGHT_PATH)
+    state_dict = torch.load(config.WEIGHT_PATH, map_location=get_device(config))
     model.load_state_dict(state_dict, strict=False)
     for param in model.named_parameters():
         param[1].requires_grad = False
@@ -74,81 +138,39 @@ def run(config):
     gt_list=[]
     base=0
     step=0
-    for image_id in gt_images_dict:
-        step += 1
-        print(str(step) + "/" + str(len(gt_images_dict)))
-
-        inner_prediction_list=[]
-        inner_gt_list=[]
+    # detect() scores the selection of a batch of images with one CIEDN call
+    image_ids = list(gt_images_dict.keys())
+    for start in range(0, len(image_ids), config.PREDICT_BATCH_IMAGES):
+        batch_ids = image_ids[start:start + config.PREDICT_BATCH_IMAGES]
+        imgs = []
+        for image_id in batch_ids:
+            img = skimage.io.imread(os.path.join(config.IMAGE_PATH, "ioid_images/") + gt_images_dict[image_id]['image_name'])
+            if len(img.shape) == 2:
+                img = np.stack([img, img, img], axis=2)
+            imgs.append(img)
+        results = model.detect(imgs, limit="selection")
 
-        image = gt_images_dict[image_id]
-        gt_instance_dict=image['instances']
-        image_name = image['image_name']
-        img = skimage.io.imread(os.path.join(config.IMAGE_PATH, "ioid_images/") + image_name)
-        if len(img.shape) == 2:
-            img = np.stack([img, img, img], axis=2)
+        for image_id, result in zip(batch_ids, results):
+            step += 1
+            print(str(step) + "/" + str(len(gt_images_dict)))
 
-        pred_dict, ioid_result, instance_dict,panoptic_result_instance_id_map, predictions, instance_list = model.detect([img], limit="selection")
-        inner_prediction_list=predictions
+            inner_prediction_list=[]
+            inner_gt_list=[]
 
-        for instance_id in instance_dict:
-            mask = panoptic_result_instance_id_map == int(instance_id)
-            instance_dict[instance_id]['mask'] = mask
+            image = gt_images_dict[image_id]
+            gt_instance_dict=image['instances']
 
-        gt_segmentation_id = utils.rgb2id(scipy.misc.imread("../data/ioid_panoptic/" + image_id.zfill(12) + ".png"))
-        for gt_instance_id in gt_instance_dict:
-            gt_mask = gt_segmentation_id == int(gt_instance_id)
-            gt_instance_dict[gt_instance_id]['mask'] = gt_mask
+            pred_dict, ioid_result, instance_dict,panoptic_result_instance_id_map, predictions, instance_list = result
+            inner_prediction_list=predictions
 
-        instance_pred_gt_dict = {}
-        instance_gt_pred_dict = {}
-        if len(instance_dict) == 0:
-            for gt_instance_id in gt_instance_dict:
-                instance_gt_pred_dict[gt_instance_id] = {"labeled": gt_instance_dict[gt_instance_id]['labeled'],"pred": []}
-        else:
-            for instance_id in instance_dict:
-                max_iou = -1
-                max_gt_instance_id = ""
-                for gt_instance_id in gt_instance_dict:
-                    i_iou = compute_pixel_iou(instance_dict[instance_id]['mask'],gt_instance_dict[gt_instance_id]['mask'])
-                    if gt_instance_id not in instance_gt_pred_dict:
-                        instance_gt_pred_dict[gt_instance_id] = {"labeled": gt_instance_dict[gt_instance_id]['labeled'],
-                                                                 "pred": []}
-                    if i_iou >= 0.5 and instance_dict[instance_id]['category_id'] == gt_instance_dict[gt_instance_id][
-                        'category_id'] and i_iou > max_iou:
-                        max_gt_instance_id = gt_instance_id
-                        max_iou = i_iou
-                        instance_gt_pred_dict[gt_instance_id]['pred'].append(instance_id)
-                if max_gt_instance_id != "":
-                    instance_pred_gt_dict[instance_id] = {"gt_instance_id": max_gt_instance_id,
-                                                          "label": gt_instance_dict[max_gt_instance_id]['labeled']}
-                else:
-                    instance_pred_gt_dict[instance_id] = {"gt_instance_id": "", "label": False}
-
-        image_base = 0
-        for instance_id in instance_gt_pred_dict:
-            if instance_gt_pred_dict[instance_id]['labeled'] == True and len(instance_gt_pred_dict[instance_id]['pred']) == 0:
-                image_base += 1
-        base+=image_base
-
-        for instance_id in instance_dict:
-            del instance_dict[instance_id]['mask']
-
-        for gt_instance_id in gt_instance_dict:
-            del gt_instance_dict[gt_instance_id]['mask']
-
-        for instance_id in instance_dict:
-            instance = instance_dict[instance_id]
-            if instance_id in instance_pred_gt_dict:
-                instance['labeled'] = instance_pred_gt_dict[instance_id]['label']
-            else:
-                instance['labeled'] = False
+            gt_segmentation_id = utils.rgb2id(scipy.misc.imread("../data/ioid_panoptic/" + image_id.zfill(12) + ".png"))
+            base += label_instances(instance_dict, gt_instance_dict, panoptic_result_instance_id_map, gt_segmentation_id)
 
-        for instance_id in instance_list:
-            inner_gt_list.append(1 if instance_dict[instance_id]['labeled'] else 0)
+            for instance_id in instance_list:
+                inner_gt_list.append(1 if instance_dict[instance_id]['labeled'] else 0)
 
-        prediction_list.extend(inner_prediction_list)
-        gt_list.extend(inner_gt_list)
+            prediction_list.extend(inner_prediction_list)
+            gt_list.extend(inner_gt_list)
 
         pl=maxminnorm(np.array(prediction_list))
         gl=np.array(gt_list)
@@ -173,6 +195,113 @@ def run(config):
     result = {"precision": precision, "recall": recall, "f": f, "_recall": _recall, "_f": _f}
     print(result)
 
+def run_approximation(config):
+    """Compares the approximate selection (SELECTION_PARTNERS and/or
+    SELECTION_CASCADE) with the exact CIEDN scores.
+
+    Both scorers share one predict_segment result per image, so the instance
+    ids and instance_groups are identical and only the selection differs.
+    Reports the score error, the agreement of the decisions at
+    SELECTION_THRESHOLD, the accuracy of both against the GT labels, the
+    cascade skip rate and the scoring time.
+    """
+    model = CIN(model_dir=MODEL_DIR, config=config)
+
+    if config.GPU_COUNT:
+        model = model.cuda()
+
+    state_dict = torch.load(config.WEIGHT_PATH, map_location=get_device(config))
+    model.load_state_dict(state_dict, strict=False)
+    for param in model.named_parameters():
+        param[1].requires_grad = False
+
+    gt_images_dict=json.load(open("data/val_images_dict.json"))
+    exact_list=[]
+    approx_list=[]
+    gt_list=[]
+    exact_time=0
+    approx_time=0
+    correlations=[]
+    step=0
+    for image_id in gt_images_dict:
+        step += 1
+        print(str(step) + "/" + str(len(gt_images_dict)))
+        image = gt_images_dict[image_id]
+        image_name = image['image_name']
+        try:
+            img = skimage.io.imread(os.path.join(config.IMAGE_PATH, "ioid_images/") + image_name)
+            if len(img.shape) == 2:
+                img = np.stack([img, img, img], axis=2)
+
+            molded_images, image_metas = model.mold_inputs([img])
+            image_metas = image_metas.int().data.numpy()
+            if config.GPU_COUNT:
+                molded_images = Variable(molded_images, volatile=True).cuda()
+            else:
+                molded_images = Variable(molded_images, volatile=True)
+
+            result = model.predict_front([molded_images, image_metas], mode='inference', limit="insttr")
+            semantic_labels, panoptic_result, segments_info = model.predict_segment(result, image_metas)
+            image_shape = image_metas[0][1:4].astype('int32')
+            instance_groups, _, _, _, _, instance_list = model.construct_dataset(semantic_labels, result['influence_map'],
+                                                                                 panoptic_result, segments_info,
+                                                                                 image_shape, 'inference')
+            if len(instance_groups) == 0:
+                continue
+
+            start = time.time()
+            exact = np.array(model.score_selection(instance_groups, exact=True))
+            exact_time += time.time() - start
+            start = time.time()
+            if config.SELECTION_CASCADE:
+                approx = np.array(model.cascade_selection(instance_groups, result['influence_map'],
+                                                          panoptic_result, instance_list))
+            else:
+                approx = np.array(model.score_selection(instance_groups))
+            approx_time += time.time() - start
+
+            gt_segmentation_id = utils.rgb2id(scipy.misc.imread("../data/ioid_panoptic/" + image_id.zfill(12) + ".png"))
+            label_instances(segments_info, image['instances'], utils.rgb2id(panoptic_result), gt_segmentation_id)
+        except Exception as e:
+            print(image_name, e)
+            continue
+
+        exact_list.extend(exact)
+        approx_list.extend(approx)
+        gt_list.extend([1 if segments_info[instance_id]['labeled'] else 0 for instance_id in instance_list])
+        if len(exact) > 1:
+            correlation = spearmanr(exact, approx)[0]
+            if not np.isnan(correlation):
+                correlations.append(correlation)
+
+    if len(exact_list) == 0:
+        print("No valid data!!!")
+        return
+    exact_list = np.array(exact_list)
+    approx_list = np.array(approx_list)
+    gt_list = np.array(gt_list)
+    error = np.abs(exact_list - approx_list)
+    exact_decision = exact_list > config.SELECTION_THRESHOLD
+    approx_decision = approx_list > config.SELECTION_THRESHOLD
+    exact_accuracy = float(np.mean(exact_decision == gt_list))
+    approx_accuracy = float(np.mean(approx_decision == gt_list))
+    cascade_stats = model.cascade_stats
+    result = {"partners": config.SELECTION_PARTNERS,
+              "partner_mode": config.SELECTION_PARTNER_MODE,
+              "cascade": config.SELECTION_CASCADE,
+              "instances": len(exact_list),
+              "mean_abs_error": float(np.mean(error)),
+              "max_abs_error": float(np.max(error)),
+              "decision_agreement": float(np.mean(exact_decision == approx_decision)),
+              "rank_correlation": float(np.mean(correlations)) if correlations else 1.0,
+              "exact_accuracy": exact_accuracy,
+              "approx_accuracy": approx_accuracy,
+              "accuracy_delta": approx_accuracy - exact_accuracy,
+              "skip_rate": cascade_stats["skipped"] / cascade_stats["instances"] if cascade_stats["instances"] else 0.0,
+              "exact_time": exact_time,
+              "approx_time": approx_time}
+    print(result)
+
 if __name__=='__main__':
     args = get_parser().parse_args()
     if args.config:
@@ -183,7 +312,12 @@ if __name__=='__main__':
                 setattr(config,key,config_dict[key])
     else:
         config = CINConfig()
-    run(config)
+    if args.mode == "approx":
+        run_approximation(config)
+    elif args.mode == "ioi":
+        run(config)
+    else:
+        print("mode not exists: " + args.mode)
     # gt=np.load("results/validate/gt.npy")
     # pred=np.nan_to_num(np.load("results/validate/pred.npy"))
     # precision, recall, f, _recall, _f =compare_mask(gt,pred,0.3,16046)